@@ -30,8 +30,10 @@ __version__ = '4.0.3'
 
 try:
     import pwem
+    from pyworkflow.utils import strToBoolean
     from reliontomo.constants import RELIONTOMO_HOME, RELIONTOMO_DEFAULT, RELION, RELIONTOMO_CUDA_LIB, V4_0, \
-    RELION_ENV_ACTIVATION, V5_0
+    RELION_ENV_ACTIVATION, V5_0, RELIONTOMO_LAZY_PARTICLES, RELIONTOMO_STAR_CACHE_SIZE, RELIONTOMO_GAIN_CACHE_SIZE, \
+    RELIONTOMO_COMPACT_PARTICLES
     import relion
 
     class Plugin(relion.Plugin):
@@ -43,6 +45,10 @@ try:
         def _defineVariables(cls):
             cls._defineEmVar(RELIONTOMO_HOME, 'relion-%s' % relion.V5_0)
             cls._defineVar(RELIONTOMO_CUDA_LIB, pwem.Config.CUDA_LIB)
+            cls._defineVar(RELIONTOMO_LAZY_PARTICLES, 'False')
+            cls._defineVar(RELIONTOMO_COMPACT_PARTICLES, 'False')
+            cls._defineVar(RELIONTOMO_STAR_CACHE_SIZE, '2')
+            cls._defineVar(RELIONTOMO_GAIN_CACHE_SIZE, '4')
 
         @staticmethod
         def isRe50():
@@ -53,6 +59,25 @@ try:
         def isRe40(cls):
             return not cls.isRe50()
 
+        @classmethod
+        def useLazyParticles(cls):
+            return strToBoolean(cls.getVar(RELIONTOMO_LAZY_PARTICLES))
+
+        @classmethod
+        def useCompactParticles(cls):
+            return strToBoolean(cls.getVar(RELIONTOMO_COMPACT_PARTICLES))
+
+        @classmethod
+        def getStarCacheMaxBytes(cls):
+            """Max size of the cache of STAR files shared by the protocols of a project. 0 if it is disabled."""
+            return int(float(cls.getVar(RELIONTOMO_STAR_CACHE_SIZE)) * 1024 ** 3)
+
+        @classmethod
+        def getGainCacheMaxBytes(cls):
+            """Max size of the cache of gain references converted to MRC shared by the protocols of a project. 0 if it
+            is disabled."""
+            return int(float(cls.getVar(RELIONTOMO_GAIN_CACHE_SIZE)) * 1024 ** 3)
+
         @classmethod
         def runRelionTomo(cls, protocol, program, args, cwd=None, numberOfMpi=1):
             """ Run Relion command from a given protocol. """
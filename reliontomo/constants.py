@@ -33,6 +33,14 @@ V5_0 = '5.0'
 RELION_ENV_ACTIVATION = 'RELION_ENV_ACTIVATION'
 RELIONTOMO_HOME = 'RELIONTOMO_HOME'
 RELIONTOMO_CUDA_LIB = 'RELION_CUDA_LIB'
+# If True, the particles generated by the Relion protocols are read from their star file instead of being copied into
+# the sqlite of the output set (see RelionSetOfPseudoSubtomograms.setLazy)
+RELIONTOMO_LAZY_PARTICLES = 'RELIONTOMO_LAZY_PARTICLES'
+# If True, the particles generated by the Relion protocols are stored with their Relion fields packed into a single
+# column of the sqlite of the output set (see RelionPSubtomogramCompact)
+RELIONTOMO_COMPACT_PARTICLES = 'RELIONTOMO_COMPACT_PARTICLES'
+RELIONTOMO_STAR_CACHE_SIZE = 'RELIONTOMO_STAR_CACHE_SIZE'  # In GB. 0 disables the cache
+RELIONTOMO_GAIN_CACHE_SIZE = 'RELIONTOMO_GAIN_CACHE_SIZE'  # In GB. 0 disables the cache
 RELIONTOMO_DEFAULT_VERSION = V4_0
 RELIONTOMO_DEFAULT = RELION + '-' + RELIONTOMO_DEFAULT_VERSION
 V30_VALIDATION_MSG = 'This version of Reliontomo plugin requires Relion 3.0 binaries. ' \
@@ -178,6 +186,8 @@ PSUBTOMOS_SQLITE = 'pseudosubtomograms%s.sqlite'
 # Initial models
 REC_PARTICLES_DIR = 'recParticles'
 PSEUDO_SUBTOMOS_DIR = 'pseudoSubtomos'
+STAR_CACHE_DIR = 'reliontomoStarCache'  # In the Tmp directory of the project
+GAIN_CACHE_DIR = 'reliontomoGainCache'  # In the Tmp directory of the project
 
 # Refine - angular sampling
 ANGULAR_SAMPLING_LIST = ['30', '15', '7.5', '3.7', '1.8', '0.9', '0.5',
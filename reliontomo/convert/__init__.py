@@ -23,11 +23,18 @@
 # *
 # **************************************************************************
 
-from emtable import Table
+import logging
+import numpy as np
+from os.path import exists
+from pyworkflow.utils import createLink, cleanPath
 from reliontomo import Plugin
 from reliontomo.constants import TOMO_NAME_30, PARTICLES_TABLE, RELION_30_TOMO_LABELS, RELION_40_TOMO_LABELS, \
-    GENERAL_TABLE, TOMO_PARTICLE_ID
+    GENERAL_TABLE, TOMO_PARTICLE_ID, TOMO_PARTICLE_NAME
 from reliontomo.convert import convert40_tomo, convert30_tomo, convert50_tomo
+from reliontomo.convert.convertBase import getTransformMatricesFromTable
+from reliontomo.convert.starTable import readStarTable, filterStarTable, STAR_VALUES_TOLERANCE
+
+logger = logging.getLogger(__name__)
 
 
 def createWriterTomo(isPyseg=False, **kwargs):
@@ -78,12 +85,12 @@ def writeSetOfTomograms(imgSet, starFile, whiteList=None, **kwargs):
     return createWriterTomo40(**kwargs).tiltSeries2Star(imgSet, starFile, whiteList=whiteList, **kwargs)
 
 
-def createReaderTomo(starFile, isRelion5, tableName=PARTICLES_TABLE, isCoordsStar=False,  **kwargs):
-    dataTable = Table()
+def createReaderTomo(starFile, isRelion5, tableName=PARTICLES_TABLE, isCoordsStar=False, useSidecar=False,
+                     sidecarDirs=(), **kwargs):
     try:
-        dataTable.read(starFile, tableName=tableName)
+        dataTable = readStarTable(starFile, tableName=tableName, useSidecar=useSidecar, sidecarDirs=sidecarDirs)
     except:
-        dataTable.read(starFile, tableName=None)
+        dataTable = readStarTable(starFile, tableName=None)
 
     labels = dataTable.getColumnNames()
     if TOMO_NAME_30 in labels:
@@ -107,17 +114,96 @@ def createReaderTomo(starFile, isRelion5, tableName=PARTICLES_TABLE, isCoordsSta
     return reader, readerVersion
 
 
-def readSetOfPseudoSubtomograms(outputSet, isRelion5=True, calculateWarpCoords=False, coordFactor=1):
-    """ Convenience function to write a SetOfPseudoSubtomograms as Relion metadata using a Reader."""
+def readSetOfPseudoSubtomograms(outputSet, isRelion5=True, calculateWarpCoords=False, coordFactor=1,
+                                sidecarDirs=()):
+    """ Convenience function to write a SetOfPseudoSubtomograms as Relion metadata using a Reader.
+    The sidecar of the particles table is only written if the star file is inside one of sidecarDirs."""
     # Subtomograms are represented in Relion 4 as Pseudosubtomograms
-    reader, _ = createReaderTomo(outputSet.getParticlesStar(), isRelion5=isRelion5)
+    # The particles file generated by Relion is read by each downstream protocol, so its binary sidecar is used
+    reader, _ = createReaderTomo(outputSet.getParticlesStar(), isRelion5=isRelion5, useSidecar=True,
+                                 sidecarDirs=sidecarDirs)
     return reader.starFile2PseudoSubtomograms(outputSet,
                                               calculateWarpCoords=calculateWarpCoords,
                                               coordFactor=coordFactor)
 
 
-def readTsStarFile(inTs, outTs, starFile, outStackName, extraPath, isEvenOdd=False):
-    dataTable = Table()
-    dataTable.read(starFile, tableName=outTs.getTsId())
+def areTransformsInStar(particlesSet, starFile, sidecarDirs=()):
+    """ Checks that all the particles of the given RelionSetOfPseudoSubtomograms are in the particles table of
+    starFile with the same transformation matrix, i.e. that they have not been modified since they were read from it.
+    The Relion 5 particles are identified by their name and the Relion 4 ones by their id."""
+    isRe5 = bool(particlesSet.areRe5Particles())
+    label = TOMO_PARTICLE_NAME if isRe5 else TOMO_PARTICLE_ID
+    try:
+        reader, _ = createReaderTomo(starFile, isRelion5=isRe5, useSidecar=True, sidecarDirs=sidecarDirs)
+        # Without ids, the particles are numbered as in the readers
+        starKeys = reader.getColumnList(label, list(range(1, reader.dataTable.size() + 1)))
+        starMatrices = getTransformMatricesFromTable(reader, sRate=particlesSet.getSamplingRate(), isRe5Star=isRe5)
+    except Exception as e:
+        logger.debug('Unable to read the transformations of %s: %s' % (starFile, e))
+        return False
+    rowIndices = {str(key): index for index, key in enumerate(starKeys)}
+    if len(rowIndices) != len(starKeys):
+        return False
+    indices = []
+    matrices = []
+    for particle in particlesSet.iterItems():
+        index = rowIndices.get(str(particle.getRelionParticleName() if isRe5 else particle.getObjId()))
+        transform = particle.getTransform()
+        if index is None or transform is None:
+            return False
+        indices.append(index)
+        # Copy it, as the items of the set may be reused while iterating
+        matrices.append(np.array(transform.getMatrix()))
+    return bool(indices) and np.allclose(np.array(matrices), starMatrices[indices], rtol=0, atol=STAR_VALUES_TOLERANCE)
+
+
+def reuseParticlesStar(particlesSet, outStarFile, are2dParticles=False, sidecarDirs=()):
+    """ Generates the particles star file of the given RelionSetOfPseudoSubtomograms from the one it was read from,
+    instead of from its particles. If the set contains all of them, the file is linked. If it is a subset, the rows of
+    the particles not present in the set are filtered out. Returns False if the file could not be generated this way,
+    including when the particles of the set have been modified (see areTransformsInStar)."""
+    inParticlesStar = particlesSet.getParticlesStar()
+    if not inParticlesStar or not exists(inParticlesStar):
+        return False
+    if particlesSet.areRe5Particles() and bool(are2dParticles) != bool(particlesSet.are2dStacks()):
+        # The fields of the requested file are not the ones of the existing one
+        return False
+    if not areTransformsInStar(particlesSet, inParticlesStar, sidecarDirs=sidecarDirs):
+        logger.info("The particles of the input set are not the ones of %s. Writing the new particles file."
+                    % inParticlesStar)
+        return False
+    nParticles = particlesSet.getSize()
+    if nParticles == particlesSet.getNReParticles():
+        logger.info("Using existing star (%s) file instead of generating a new one." % inParticlesStar)
+        createLink(inParticlesStar, outStarFile)
+        return True
+
+    logger.info("Less particles detected in the input set respecting to it associated star file. Assuming "
+                "that a subset was made. Filtering the particles file %s." % inParticlesStar)
+    if particlesSet.areRe5Particles():
+        label = TOMO_PARTICLE_NAME
+        values = particlesSet.getUniqueValues('_relionParticleName')
+    else:
+        label = TOMO_PARTICLE_ID
+        values = particlesSet.getIdSet()
+    values = {str(value) for value in values if value is not None}
+    try:
+        nRows = filterStarTable(inParticlesStar, outStarFile, PARTICLES_TABLE, label, values)
+    except Exception as e:
+        logger.debug('Unable to filter %s: %s' % (inParticlesStar, e))
+        nRows = -1
+    if nRows == nParticles:
+        return True
+    logger.info("The particles of the input set could not be identified in %s. Writing the new particles file."
+                % inParticlesStar)
+    cleanPath(outStarFile)
+    return False
+
+
+def readTsStarFile(inTs, outTs, starFile, outStackName, extraPath, isEvenOdd=False, dataTable=None):
+    """ Fills outTs with the tilt-images of the given tilt-series star file. If its table has been already read, it
+    can be provided as dataTable to avoid reading it again."""
+    if dataTable is None:
+        dataTable = readStarTable(starFile, tableName=outTs.getTsId())
     reader = convert50_tomo.Reader(starFile, dataTable)
     return reader.starFile2Ts(inTs, outTs, outStackName, extraPath, isEvenOdd=isEvenOdd)
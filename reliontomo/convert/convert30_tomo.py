@@ -37,7 +37,7 @@ from reliontomo.constants import FILE_NOT_FOUND, COORD_X, COORD_Y, COORD_Z, SUBT
     CLASS_NUMBER, MRC, PARTICLES_TABLE
 from reliontomo.convert.convertBase import WriterTomo, getTransformInfoFromCoordOrSubtomo, ReaderTomo, \
     getTransformMatrixFromRow
-from reliontomo.utils import getAbsPath, _gen2LevelBaseName
+from reliontomo.utils import getAbsPath, _gen2LevelBaseName, convertStats
 from scipion.install.funcs import mkdir
 from os.path import join
 from tomo.constants import BOTTOM_LEFT_CORNER
@@ -148,6 +148,8 @@ class Reader(ReaderTomo):
         precedentDict = {removeBaseExt(tomo.getFileName()): tomo.clone() for tomo in precedentsSet}
         for row in self.dataTable:
             coordsSet.append(self.gen3dCoordFromStarRow(row, precedentDict, scaleFactor))
+        # Counted once per table instead of once per row, as each count takes the lock of the stats
+        convertStats.count('convert30_tomo.starFile2Coords3D', self.dataTable.size())
 
     def starFile2SubtomogramsImport(self, subtomoSet, coordSet, linkedSubtomosDir, starFilePath):
         samplingRate = subtomoSet.getSamplingRate()
@@ -31,15 +31,17 @@ from pwem import ALIGN_NONE
 from pwem.convert.headers import fixVolume
 from pwem.objects import Transform
 from pyworkflow.object import Integer, Float
-from pyworkflow.utils import getParentFolder, yellowStr, createLink, makePath
+from pyworkflow.utils import getParentFolder, yellowStr, createLink, makePath, cleanPath
 from relion.convert import OpticsGroups
 from reliontomo.constants import *
 import numpy as np
-from os.path import join, basename
+from os.path import join, basename, islink
 from reliontomo.convert.convertBase import (checkSubtomogramFormat,
-                                            getTransformInfoFromCoordOrSubtomo,
-                                            WriterTomo, ReaderTomo, getTransformMatrixFromRow)
-from reliontomo.objects import RelionPSubtomogram
+                                            getTransformInfoFromCoordOrSubtomo, getTransformInfoFromMatrices,
+                                            getTransformMatricesFromTable, getRelionMatrix,
+                                            WriterTomo, ReaderTomo)
+from reliontomo.objects import RelionPSubtomogram, INSERT_BATCH_SIZE
+from reliontomo.utils import convertStats
 from tomo.constants import BOTTOM_LEFT_CORNER, TR_RELION, SCIPION
 from tomo.objects import Coordinate3D, SubTomogram, TomoAcquisition
 
@@ -52,6 +54,7 @@ class Writer(WriterTomo):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    @convertStats.timed('convert40_tomo.tiltSeries2Star')
     def tiltSeries2Star(self, tsSet, outStarFileName, prot=None, ctfPlotterParentDir=None, eTomoParentDir=None,
                         whiteList=None):
         """Writes the needed tomograms.star file for relion prepare
@@ -80,9 +83,14 @@ class Writer(WriterTomo):
         # Write the STAR file
         tsTable.write(outStarFileName)
 
+    @convertStats.timed('convert40_tomo.coordinates2Star')
     def coordinates2Star(self, coordSet, subtomosStar, whitelist, sRate=1, coordsScale=1):
         """Input coordsScale is used to scale the coordinates so they are expressed in bin 1, as expected by Relion 4"""
         tomoTable = Table(columns=self._getCoordinatesStarFileLabels())
+        # The shifts and angles are calculated for all the coordinates at once, so their positions in the rows are
+        # left empty until then
+        rows = []
+        matrices = []
         i = 0
         for coord in coordSet.iterCoordinates():
             tsId = coord.getTomoId()
@@ -90,9 +98,8 @@ class Writer(WriterTomo):
             if tsId not in whitelist:
                 continue
 
-            angles, shifts = getTransformInfoFromCoordOrSubtomo(coord, coordSet.getSamplingRate())
-            # Add row to the table which will be used to generate the STAR file
-            tomoTable.addRow(
+            matrices.append(np.array(getRelionMatrix(coord)))
+            rows.append([
                 tsId,  # 1 _rlnTomoName
                 coord.getObjId(),  # 2 _rlnTomoParticleId
                 coord.getGroupId() if coord.getGroupId() else 1,  # 3 _rlnTomoManifoldIndex
@@ -101,13 +108,13 @@ class Writer(WriterTomo):
                 coord.getY(RELION_3D_COORD_ORIGIN) * coordsScale,  # 5 _rlnCoordinateY
                 coord.getZ(RELION_3D_COORD_ORIGIN) * coordsScale,  # 6 _rlnCoordinateZ
                 # pix * Å/pix = [shifts in Å]
-                shifts[0], #* sRate,  # 7 _rlnOriginXAngst
-                shifts[1], #* sRate,  # 8 _rlnOriginYAngst
-                shifts[2], #* sRate,  # 9 _rlnOriginZAngst
+                None,  # 7 _rlnOriginXAngst
+                None,  # 8 _rlnOriginYAngst
+                None,  # 9 _rlnOriginZAngst
                 # Angles in degrees
-                angles[0],  # 10 _rlnAngleRot
-                angles[1],  # 11 _rlnAngleTilt
-                angles[2],  # 12 _rlnAnglePsi
+                None,  # 10 _rlnAngleRot
+                None,  # 11 _rlnAngleTilt
+                None,  # 12 _rlnAnglePsi
                 # Extended fields
                 int(getattr(coord, '_classNumber', -1)),  # 13_rlnClassNumber
                 # Alternated 1 and 2 values
@@ -116,11 +123,17 @@ class Writer(WriterTomo):
                 coord.getY(SCIPION),  # 16 _sciYCoord
                 coord.getZ(SCIPION),   # 17 _sciZCoord
                 coord.getGroupId()  # 18 _sciGroupId
-            )
+            ])
             i += 1
+        anglesList, shiftsList = getTransformInfoFromMatrices(matrices, coordSet.getSamplingRate())
+        for row, angles, shifts in zip(rows, anglesList.tolist(), shiftsList.tolist()):
+            row[6:9] = shifts
+            row[9:12] = angles
+            tomoTable.addRow(*row)
         # Write the STAR file
         tomoTable.write(subtomosStar)
 
+    @convertStats.timed('convert40_tomo.pseudoSubtomograms2Star')
     def pseudoSubtomograms2Star(self, pSubtomoSet, outStar, withPriors=False):
 
         logger.info("Generating particles file (%s) from pseudosubtomogram set." % outStar)
@@ -128,7 +141,9 @@ class Writer(WriterTomo):
         hasCoords = pSubtomoSet.getFirstItem().hasCoordinate3D()
         tomoTable = Table(columns=self._getPseudoSubtomogramStarFileLabels(hasCoords, withPriors=withPriors))
 
-        # Write the STAR file
+        # Write the STAR file. It may be a link to the particles file of the input set, which must not be modified
+        if islink(outStar):
+            cleanPath(outStar)
         optGroup = OpticsGroups.fromString(pSubtomoSet.getAcquisition().opticsGroupInfo.get())
         with open(outStar, 'w') as f:
             optGroup.toStar(f)
@@ -336,104 +351,142 @@ class Reader(ReaderTomo):
         self._alignType = kwargs.get('alignType', ALIGN_NONE)
         self._pixelSize = kwargs.get('pixelSize', 1.0)
 
-    @staticmethod
-    def gen3dCoordFromStarRow(row, sRate, precedentIdDict, factor=1):
-        coordinate3d = None
-        tomoId = row.get(TOMO_NAME)
-        vol = precedentIdDict.get(tomoId, None)
-        if vol:
-            coordinate3d = Coordinate3D()
-            x = row.get(COORD_X, 0)
-            y = row.get(COORD_Y, 0)
-            z = row.get(COORD_Z, 0)
-            coordinate3d.setVolume(vol)
-            coordinate3d.setX(float(x) * factor, RELION_3D_COORD_ORIGIN)
-            coordinate3d.setY(float(y) * factor, RELION_3D_COORD_ORIGIN)
-            coordinate3d.setZ(float(z) * factor, RELION_3D_COORD_ORIGIN)
-            coordinate3d.setMatrix(getTransformMatrixFromRow(row, sRate=sRate), convention=TR_RELION)
-            coordinate3d.setGroupId(row.get(MANIFOLD_INDEX, 1))
+    @convertStats.timed('convert40_tomo.starFile2Coords3D')
+    def starFile2Coords3D(self, coordsSet, precedentsSet, scaleFactor, batchSize=INSERT_BATCH_SIZE):
+        getColumn = self.getColumnList
+        # Transformation matrices, all of them generated at once
+        matrices = getTransformMatricesFromTable(self, sRate=coordsSet.getSamplingRate())
+        extraColumns = {
+            Coordinate3D.GROUP_ID_ATTR: (Integer, getColumn(MANIFOLD_INDEX, 1)),
             # Extended fields
-            coordinate3d._classNumber = Integer(row.get(CLASS_NUMBER, -1))
-            coordinate3d._randomSubset = Integer(row.get(RANDOM_SUBSET, 1))
-
-        return coordinate3d, tomoId
-
-    def starFile2Coords3D(self, coordsSet, precedentsSet, scaleFactor):
-        precedentIdDict = {}
-        for tomo in precedentsSet:
-            precedentIdDict[tomo.getTsId()] = tomo.clone()
-
-        nonMatchingTomoIds = ''
-        for row in self.dataTable:
-            # Consider that there can be coordinates in the star file that does not belong to any of the tomograms
-            # introduced
-            coord, tomoId = self.gen3dCoordFromStarRow(row, coordsSet.getSamplingRate(),
-                                                       precedentIdDict, factor=scaleFactor)
-            if coord:
-                coordsSet.append(coord)
-            else:
-                if tomoId not in nonMatchingTomoIds:
-                    nonMatchingTomoIds += '%s ' % tomoId
-
+            '_classNumber': (Integer, getColumn(CLASS_NUMBER, -1)),
+            '_randomSubset': (Integer, getColumn(RANDOM_SUBSET, 1)),
+        }
+        # Consider that there can be coordinates in the star file that does not belong to any of the tomograms
+        # introduced
+        nonMatchingTomoIds = self.appendCoords3D(coordsSet, precedentsSet, matrices, extraColumns,
+                                                 scaleFactor=scaleFactor, batchSize=batchSize)
         if nonMatchingTomoIds:
             logger.info(yellowStr('The star file contains coordinates that belong to tomograms not present '
-                            'in the introduced set of tomograms: %s' % nonMatchingTomoIds))
+                            'in the introduced set of tomograms: %s' % ' '.join(nonMatchingTomoIds)))
 
-    def starFile2PseudoSubtomograms(self, outputSet):
-        sRate = outputSet.getSamplingRate()
-        listOfFilesToFixVolume = []
-        for counter, row in enumerate(self.dataTable):
-            t = Transform()
-            particleFile = row.get(SUBTOMO_NAME, None)
-            ctfFile = row.get(CTF_IMAGE, None)
-            psubtomo = RelionPSubtomogram(fileName=particleFile,
-                                          samplingRate=sRate,
-                                          ctfFile=ctfFile,
-                                          tsId=row.get(TOMO_NAME),
-                                          classId=row.get(CLASS_NUMBER, -1),
-                                          x=row.get(COORD_X),
-                                          y=row.get(COORD_Y),
-                                          z=row.get(COORD_Z),
-                                          rdnSubset=row.get(RANDOM_SUBSET, counter % 2),  # 1 and 2 alt. by default
-                                          re4ParticleName=row.get(TOMO_PARTICLE_NAME),
-                                          opticsGroupId=row.get(OPTICS_GROUP, 1),
-                                          manifoldIndex=row.get(MANIFOLD_INDEX, 1 if counter % 2 else -1),  # 1 and -1
-                                          logLikeliCont=row.get(LOG_LIKELI_CONTRIB, -1),
-                                          maxValProbDist=row.get(MAX_VALUE_PROB_DISTRIB, -1),
-                                          noSignifSamples=row.get(NO_SIGNIFICANT_SAMPLES, -1)
-                                          )
-
-            # Keeping particle id
-            psubtomo.setObjId(row.get(TOMO_PARTICLE_ID))
-
-            # Set the coordinate3D
-            if row.get(SCIPION_COORD_X) is not None:  # Assume that the coordinates exists
-                sciCoord = Coordinate3D()
-                sciCoord.setX(row.get(SCIPION_COORD_X), SCIPION)
-                sciCoord.setY(row.get(SCIPION_COORD_Y), SCIPION)
-                sciCoord.setZ(row.get(SCIPION_COORD_Z), SCIPION)
-                sciCoord.setGroupId(row.get(SCIPION_COORD_GROUP_ID,1))
-                sciCoord.setTomoId(row.get(TOMO_NAME))
-                psubtomo.setCoordinate3D(sciCoord)
-
-            # Set the transformation matrix
-            t.setMatrix(getTransformMatrixFromRow(row, sRate=sRate))
-            psubtomo.setTransform(t)
-
-            # Add the files to the list of files whose header has to be corrected to be interpreted as volumes
-            if particleFile is not None and particleFile != FILE_NOT_FOUND:
-                listOfFilesToFixVolume.append(particleFile)
-            if ctfFile is not None and ctfFile!=FILE_NOT_FOUND:
-                listOfFilesToFixVolume.append(ctfFile)
-            # Add current pseudosubtomogram to the output set
-            outputSet.append(psubtomo)
+    def starFile2PseudoSubtomograms(self, outputSet, batchSize=INSERT_BATCH_SIZE):
+        psubtomo, columns, nParticles, objIds = self.getPseudoSubtomogramsColumns(outputSet)
+        if nParticles > 0:
+            # Add the pseudosubtomograms to the output set
+            outputSet.appendFromColumns(psubtomo, columns, nParticles, objIds=objIds, batchSize=batchSize)
 
         # Keep the number of particles to compare sizes in case of subset
-        outputSet.setNReParticles(self.dataTable.size())
-        # Fix volume headers
+        outputSet.setNReParticles(nParticles)
+        # Fix volume headers of the particles and their CTFs, as they have to be interpreted as volumes
+        listOfFilesToFixVolume = [fileName for particleFile, ctfFile in zip(columns.get('_filename', []),
+                                                                            columns.get('_ctfFile', []))
+                                  for fileName in (particleFile, ctfFile)
+                                  if fileName is not None and fileName != FILE_NOT_FOUND]
         if listOfFilesToFixVolume:
             fixVolume(listOfFilesToFixVolume)
 
+    @convertStats.timed('convert40_tomo.getPseudoSubtomogramsColumns')
+    def getPseudoSubtomogramsColumns(self, outputSet):
+        """Reads the pseudosubtomograms of the star file as columns. It returns the first pseudosubtomogram, a
+        dictionary {attribute: values} with the values of the rest of them, as expected by
+        RelionSetOfPseudoSubtomograms.appendFromColumns, the number of pseudosubtomograms and their ids (None if
+        the star file does not contain them)."""
+        sRate = outputSet.getSamplingRate()
+        nParticles = self.dataTable.size()
+        counters = np.arange(nParticles)
+        getColumn = self.getColumnList
+        # Read the columns once instead of accessing the row objects field by field
+        particleFiles = getColumn(SUBTOMO_NAME)
+        ctfFiles = getColumn(CTF_IMAGE)
+        tsIds = getColumn(TOMO_NAME)
+        classIds = getColumn(CLASS_NUMBER, -1)
+        xList = getColumn(COORD_X)
+        yList = getColumn(COORD_Y)
+        zList = getColumn(COORD_Z)
+        rdnSubsets = getColumn(RANDOM_SUBSET, counters % 2)  # 1 and 2 alt. by default
+        opticsGroupIds = getColumn(OPTICS_GROUP, 1)
+        manifoldIndices = getColumn(MANIFOLD_INDEX, np.where(counters % 2, 1, -1))  # 1 and -1
+        logLikeliConts = getColumn(LOG_LIKELI_CONTRIB, -1)
+        maxValProbDists = getColumn(MAX_VALUE_PROB_DISTRIB, -1)
+        noSignifSamplesList = getColumn(NO_SIGNIFICANT_SAMPLES, -1)
+        # Keeping particle id
+        objIds = getColumn(TOMO_PARTICLE_ID) if self.dataTable.hasColumn(TOMO_PARTICLE_ID) else None
+        # Transformation matrices, all of them generated at once
+        matrices = getTransformMatricesFromTable(self, sRate=sRate)
+        # Scipion coordinates
+        hasSciCoords = self.dataTable.hasColumn(SCIPION_COORD_X)
+        if hasSciCoords:
+            sciXList = getColumn(SCIPION_COORD_X)
+            sciYList = getColumn(SCIPION_COORD_Y)
+            sciZList = getColumn(SCIPION_COORD_Z)
+            sciGroupIds = getColumn(SCIPION_COORD_GROUP_ID, 1)
+
+        # Only the first particle is created as an object. The rest of them are inserted in the set directly from
+        # the columns read
+        if nParticles == 0:
+            return None, {}, 0, None
+        t = Transform()
+        itemType = outputSet.getItemType()
+        psubtomo = itemType(fileName=particleFiles[0],
+                            samplingRate=sRate,
+                            ctfFile=ctfFiles[0],
+                            tsId=tsIds[0],
+                            classId=classIds[0],
+                            x=xList[0],
+                            y=yList[0],
+                            z=zList[0],
+                            rdnSubset=rdnSubsets[0],
+                            opticsGroupId=opticsGroupIds[0],
+                            manifoldIndex=manifoldIndices[0],
+                            logLikeliCont=logLikeliConts[0],
+                            maxValProbDist=maxValProbDists[0],
+                            noSignifSamples=noSignifSamplesList[0]
+                            )
+
+        # Set the coordinate3D
+        if hasSciCoords:  # Assume that the coordinates exists
+            sciCoord = Coordinate3D()
+            sciCoord.setX(sciXList[0], SCIPION)
+            sciCoord.setY(sciYList[0], SCIPION)
+            sciCoord.setZ(sciZList[0], SCIPION)
+            sciCoord.setGroupId(sciGroupIds[0])
+            sciCoord.setTomoId(tsIds[0])
+            psubtomo.setCoordinate3D(sciCoord)
+
+        # Set the transformation matrix
+        t.setMatrix(matrices[0].copy())
+        psubtomo.setTransform(t)
+        if objIds is not None:
+            psubtomo.setObjId(objIds[0])
+
+        columns = {
+            '_filename': particleFiles,
+            '_ctfFile': ctfFiles,
+            RelionPSubtomogram.TS_ID_ATTRIBUTE: tsIds,
+            '_classId': classIds,
+            '_x': xList,
+            '_y': yList,
+            '_z': zList,
+            '_rdnSubset': rdnSubsets,
+            '_opticsGroupId': opticsGroupIds,
+            '_manifoldIndex': manifoldIndices,
+            '_logLikeliContribution': logLikeliConts,
+            '_maxValueProbDistribution': maxValProbDists,
+            '_nrOfSignificantSamples': noSignifSamplesList,
+            '_transform._matrix': matrices,
+        }
+        if hasSciCoords:
+            columns.update({
+                '_coordinate._x': sciXList,
+                '_coordinate._y': sciYList,
+                '_coordinate._z': sciZList,
+                '_coordinate._groupId': sciGroupIds,
+                '_coordinate._tomoId': tsIds,
+            })
+        convertStats.count('convert40_tomo.getPseudoSubtomogramsColumns', nParticles)
+        return psubtomo, columns, nParticles, objIds
+
     def starFile2SubtomogramsImport(self, subtomoSet, coordSet, linkedSubtomosDir, starFilePath):
         samplingRate = subtomoSet.getSamplingRate()
         precedentsDict = {tomo.getTsId(): tomo for tomo in coordSet.getPrecedents()}
@@ -24,27 +24,33 @@
 # **************************************************************************
 import logging
 import os.path
-from typing import Dict, Union, List, Set, Tuple
+from itertools import islice, groupby
+from typing import Dict, Union, List, Set, Tuple, Optional, Callable
 from emtable import Table
 from pwem import ALIGN_NONE
 from pwem.emlib.image import ImageHandler
 from pwem.objects import Transform
 from pyworkflow.object import Float, String, Integer
-from pyworkflow.utils import yellowStr, createLink
+from pyworkflow.utils import yellowStr, createLink, cleanPath
 from relion.convert import OpticsGroups
 from reliontomo.constants import *
 import numpy as np
 from os.path import join, basename, exists
-from reliontomo.convert.convertBase import (getTransformInfoFromCoordOrSubtomo,
-                                            WriterTomo, ReaderTomo, getTransformMatrixFromRow, genTransformMatrix)
-from reliontomo.objects import RelionPSubtomogram, RelionSetOfPseudoSubtomograms
-from tomo.constants import TR_RELION, SCIPION
-from tomo.objects import Coordinate3D, Tomogram, TiltSeries, CTFTomoSeries, SetOfCoordinates3D, SetOfTomograms, \
+from reliontomo.convert.convertBase import (getTransformInfoFromMatrices,
+                                            getTransformMatricesFromTable, getRelionMatrix,
+                                            WriterTomo, ReaderTomo, genTransformMatrices, invertMatrices)
+from reliontomo.convert.fileCache import getFileStamp
+from reliontomo.convert.starTable import StarTable, readStarTable, removeStarTableSidecars
+from reliontomo.objects import RelionPSubtomogram, RelionSetOfPseudoSubtomograms, INSERT_BATCH_SIZE
+from reliontomo.utils import convertStats
+from tomo.constants import SCIPION
+from tomo.objects import Coordinate3D, Tomogram, TiltSeries, CTFTomoSeries, CTFTomo, SetOfCoordinates3D, SetOfTomograms, \
     TiltSeriesM, SetOfTiltSeriesM, TiltImage
 from tomo.utils import getCommonTsAndCtfElements
 
 logger = logging.getLogger(__name__)
 eyeMatrix3x3 = np.eye(3)
+PARTICLES_FLUSH_CHUNK = 10000  # Number of particles written to the particles.star file between flushes
 
 
 def getTsStarFile(tsId: str, outPath: str, prefix: str = '') -> str:
@@ -59,6 +65,30 @@ def getTsStarFile(tsId: str, outPath: str, prefix: str = '') -> str:
     return join(outPath, bName + '.star')
 
 
+def getCtfTomoDict(ctf: CTFTomoSeries) -> Tuple[Dict[int, CTFTomo], Callable[[TiltImage], int]]:
+    """
+    It reads the enabled CTFTomo of the given series in a single pass, so they do not have to be looked up for each
+    tilt-image. It returns:
+        - A dictionary of type {acquisition order: CTFTomo}, or {index: CTFTomo} if the series does not have the
+          attribute acquisition order (old versions, backwards compatibility).
+        - The function that gets the corresponding key from a tilt-image.
+    """
+    ctfTomoDict = {}
+    byAcqOrder = True
+    for i, ctfTomo in enumerate(ctf.iterItems()):
+        if i == 0:
+            # Same criterion as tomo.utils.getCommonTsAndCtfElements, so the keys match the present acq orders
+            byAcqOrder = bool(getattr(ctfTomo, CTFTomo.ACQ_ORDER_FIELD, None))
+            if not byAcqOrder:
+                logger.warning(f'WARNING! The CTF series {ctf.getTsId()} does not have the attribute "acquisition '
+                               f'order" (_acqOrder). The matching between the CTF and the tilt-images is carried '
+                               f'out using the index --> LESS RELIABLE. CHECK THE RESULTS CAREFULLY')
+        if ctfTomo.isEnabled():
+            ctfTomoDict[ctfTomo.getAcquisitionOrder() if byAcqOrder else ctfTomo.getIndex()] = ctfTomo.clone()
+    getTiKey = TiltImage.getAcquisitionOrder if byAcqOrder else TiltImage.getIndex
+    return ctfTomoDict, getTiKey
+
+
 # TODO: update these lines with the ones generated by relion5 and check the values to be updated, concretely
 #  batchruntomo.a.align.AngleOffset=12.91
 def writeEtomoEdf(fn, paramsDict):
@@ -185,6 +215,8 @@ class Writer(WriterTomo):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # ProjectFileCache of the generated files. They are only generated if they are not in it
+        self.fileCache = kwargs.get('fileCache', None)
 
     @staticmethod
     def tsMSet2Star(tsMSet: SetOfTiltSeriesM,
@@ -264,6 +296,7 @@ class Writer(WriterTomo):
             # Write the STAR file
             tsMMainTable.writeStar(f, tableName=GLOBAL_TABLE)
 
+    @convertStats.timed('convert50_tomo.tsSet2Star')
     def tsSet2Star(self,
                    tsDict: Dict[str, TiltSeries],
                    ctfDict: Dict[str, CTFTomoSeries],
@@ -280,7 +313,26 @@ class Writer(WriterTomo):
             ctf = ctfDict.get(tsId, None)
             if ctf:
                 presentAcqOrders = getCommonTsAndCtfElements(ts, ctf)
+                tsStarFile = getTsStarFile(tsId, outPath)
+                cacheKey = self._getTsCacheKey(ts, ctf, presentAcqOrders)
+                if self.fileCache and self.fileCache.fetch(cacheKey, [tsStarFile]):
+                    continue
                 self.ts2Star(ts, ctf, outPath, presentAcqOrders)
+                if self.fileCache:
+                    self.fileCache.store(cacheKey, [tsStarFile])
+
+    def _getTsCacheKey(self, ts: TiltSeries, ctf: CTFTomoSeries, presentAcqOrders: Set[int]) -> Optional[str]:
+        if not self.fileCache:
+            return None
+        return self.fileCache.getKey('ts2Star',
+                                     ts.getTsId(),
+                                     getFileStamp(ts.getFileName()),
+                                     ts.getObjId(),
+                                     ts.getSamplingRate(),
+                                     ts.getAcquisition().getTiltAxisAngle(),
+                                     getFileStamp(ctf.getFileName()),
+                                     ctf.getObjId(),
+                                     sorted(presentAcqOrders))
 
     @staticmethod
     def ts2Star(ts: TiltSeries,
@@ -340,89 +392,94 @@ class Writer(WriterTomo):
         #  to think that the initial ones are there for tracking from the upper part of the pipeline and that the ones
         #  used are the refined ones.
         tsId = ts.getTsId()
-        with open(getTsStarFile(tsId, outPath), 'w') as f:
+        tsStarFile = getTsStarFile(tsId, outPath)
+        # It may be a hardlink to a cached file, which must not be modified
+        cleanPath(tsStarFile)
+        with open(tsStarFile, 'w') as f:
             Writer._writeScipionCommentLine(f)  # Initial comment
             sRate = ts.getSamplingRate()
             tiltAxisAngle = ts.getAcquisition().getTiltAxisAngle()
             tsTable = Table(columns=tsStarFields)
-            for ti in ts.iterItems():
-                ctfTomo = ctf.getCtfTomoFromTi(ti)
-                acqOrder = ti.getAcquisitionOrder()
-                if ctfTomo and acqOrder in presentAcqOrders:
-                    acqTi = ti.getAcquisition()
-                    tiltAngle = ti.getTiltAngle()
-                    oddEven = ti.getOddEven()
-                    if oddEven:
-                        oddTi, evenTi = oddEven
-                    else:
-                        oddTi = FILE_NOT_FOUND
-                        evenTi = FILE_NOT_FOUND
-
-                    defocusU = ctfTomo.getDefocusU()
-                    defocusV = ctfTomo.getDefocusV()
-                    trMatrix = ti.getTransform().getMatrix() if ti.getTransform() is not None else eyeMatrix3x3
-                    iTrMatrix = np.linalg.inv(trMatrix)
-                    rotAngle = np.rad2deg(np.arctan2(trMatrix[0, 1], trMatrix[0, 0]))
-                    sxAngst = iTrMatrix[0, 2] * sRate
-                    syAngst = iTrMatrix[1, 2] * sRate
-                    tsTable.addRow(
-                        FILE_NOT_FOUND,  # 1, rlnMicrographMovieName
-                        1,  # 2, rlnTomoTiltMovieFrameCount
-                        tiltAngle,  # 3, rlnTomoNominalStageTiltAngle
-                        tiltAxisAngle,  # 4, rlnTomoNominalTiltAxisAngle
-                        acqTi.getDoseInitial(),  # 5, rlnMicrographPreExposure
-                        # TODO: it has to be read from the mdoc from label TargetDefocus
-                        -1.5,  # 6, rlnTomoNominalDefocus
-                        # TODO: manage this
-                        FILE_NOT_FOUND,  # 7, rlnCtfPowerSpectrum
-                        # TODO: the tilt-images are expexted to be unstacked, as there is no index field
-                        evenTi,  # 8, rlnMicrographNameEven
-                        oddTi,  # 9, rlnMicrographNameOdd
-                        f'{ti.getIndex()}@{ti.getFileName()}:mrcs',  # 10, rlnMicrographName
-                        # TODO: check if it's used for other calculations apart from the Bayesian polishing
-                        FILE_NOT_FOUND,  # 11, rlnMicrographMetadata
-                        # TODO: check if it's used for other calculations apart from the Bayesian polishing. If True,
-                        #  we would have to add it to our data model
-                        0,  # 12, rlnAccumMotionTotal
-                        0,  # 13, rlnAccumMotionEarly
-                        0,  # 14, rlnAccumMotionLate
-                        # TODO: check if it's used for something or if it's just an internal metric
-                        # src/reconstructor.cpp
-                        # C++
-                        # ·
-                        # master
-                        # 			Image<RFLOAT> Ictf;
-                        # 			FileName fn_ctf;
-                        # 			if (!DF.getValue(EMDL_CTF_IMAGE, fn_ctf, p))
-                        # 				REPORT_ERROR("ERROR: cannot find rlnCtfImage for 3D CTF correction!");
-                        # 			Ictf.read(fn_ctf);
-                        # 			// If there is a redundant half, get rid of it
-                        ctfTomo.getPsdFile() if ctfTomo.getPsdFile() else FILE_NOT_FOUND,  # 15, rlnCtfImage
-                        defocusU,  # 16, rlnDefocusU
-                        defocusV,  # 17, rlnDefocusV
-                        abs(defocusU - defocusV),  # 18, rlnCtfAstigmatism
-                        ctfTomo.getDefocusAngle(),  # 19, rlnDefocusAngle
-                        # TODO: from Relion label definition: "not used inside relion_refine", but may be _fitQuality from
-                        #  our model
-                        0,  # 20, rlnCtfFigureOfMerit
-                        # TODO: check if CTFFind's Estimated maximum resolution (in A) of significant CTF Thon rings is the
-                        #  same in other plugins that estimate the CTF
-                        ctfTomo.getResolution(),  # 21, rlnCtfMaxResolution
-                        # TODO: check if this value is used and, in that case, if we have this somewhere or have to store it
-                        #  in the data model
-                        ctfTomo.getFitQuality() if ctfTomo.getFitQuality() is not None else 0,  # 22, rlnCtfIceRingDensity
-                        # TODO: I've only seen this off tilt axis estimated in EMAN...
-                        0,  # 23, rlnTomoXTilt
-                        tiltAngle,  # 24, rlnTomoYTilt
-                        rotAngle,  # 25, rlnTomoZRot
-                        sxAngst,  # 26, rlnTomoXShiftAngst
-                        syAngst,  # 27, rlnTomoYShiftAngst
-                        np.cos(np.deg2rad(tiltAngle))  # 28, rlnCtfScalefactor
-                    )
+            ctfTomoDict, getTiKey = getCtfTomoDict(ctf)
+            tiList = [ti.clone() for ti in ts.iterItems()
+                      if ti.isEnabled() and getTiKey(ti) in presentAcqOrders and getTiKey(ti) in ctfTomoDict]
+            trMatrices = [ti.getTransform().getMatrix() if ti.getTransform() is not None else eyeMatrix3x3
+                          for ti in tiList]
+            for ti, trMatrix, iTrMatrix in zip(tiList, trMatrices, invertMatrices(trMatrices)):
+                ctfTomo = ctfTomoDict[getTiKey(ti)]
+                rotAngle = np.rad2deg(np.arctan2(trMatrix[0, 1], trMatrix[0, 0]))
+                sxAngst = iTrMatrix[0, 2] * sRate
+                syAngst = iTrMatrix[1, 2] * sRate
+                acqTi = ti.getAcquisition()
+                tiltAngle = ti.getTiltAngle()
+                oddEven = ti.getOddEven()
+                if oddEven:
+                    oddTi, evenTi = oddEven
+                else:
+                    oddTi = FILE_NOT_FOUND
+                    evenTi = FILE_NOT_FOUND
+
+                defocusU = ctfTomo.getDefocusU()
+                defocusV = ctfTomo.getDefocusV()
+                tsTable.addRow(
+                    FILE_NOT_FOUND,  # 1, rlnMicrographMovieName
+                    1,  # 2, rlnTomoTiltMovieFrameCount
+                    tiltAngle,  # 3, rlnTomoNominalStageTiltAngle
+                    tiltAxisAngle,  # 4, rlnTomoNominalTiltAxisAngle
+                    acqTi.getDoseInitial(),  # 5, rlnMicrographPreExposure
+                    # TODO: it has to be read from the mdoc from label TargetDefocus
+                    -1.5,  # 6, rlnTomoNominalDefocus
+                    # TODO: manage this
+                    FILE_NOT_FOUND,  # 7, rlnCtfPowerSpectrum
+                    # TODO: the tilt-images are expexted to be unstacked, as there is no index field
+                    evenTi,  # 8, rlnMicrographNameEven
+                    oddTi,  # 9, rlnMicrographNameOdd
+                    f'{ti.getIndex()}@{ti.getFileName()}:mrcs',  # 10, rlnMicrographName
+                    # TODO: check if it's used for other calculations apart from the Bayesian polishing
+                    FILE_NOT_FOUND,  # 11, rlnMicrographMetadata
+                    # TODO: check if it's used for other calculations apart from the Bayesian polishing. If True,
+                    #  we would have to add it to our data model
+                    0,  # 12, rlnAccumMotionTotal
+                    0,  # 13, rlnAccumMotionEarly
+                    0,  # 14, rlnAccumMotionLate
+                    # TODO: check if it's used for something or if it's just an internal metric
+                    # src/reconstructor.cpp
+                    # C++
+                    # ·
+                    # master
+                    # 			Image<RFLOAT> Ictf;
+                    # 			FileName fn_ctf;
+                    # 			if (!DF.getValue(EMDL_CTF_IMAGE, fn_ctf, p))
+                    # 				REPORT_ERROR("ERROR: cannot find rlnCtfImage for 3D CTF correction!");
+                    # 			Ictf.read(fn_ctf);
+                    # 			// If there is a redundant half, get rid of it
+                    ctfTomo.getPsdFile() if ctfTomo.getPsdFile() else FILE_NOT_FOUND,  # 15, rlnCtfImage
+                    defocusU,  # 16, rlnDefocusU
+                    defocusV,  # 17, rlnDefocusV
+                    abs(defocusU - defocusV),  # 18, rlnCtfAstigmatism
+                    ctfTomo.getDefocusAngle(),  # 19, rlnDefocusAngle
+                    # TODO: from Relion label definition: "not used inside relion_refine", but may be _fitQuality from
+                    #  our model
+                    0,  # 20, rlnCtfFigureOfMerit
+                    # TODO: check if CTFFind's Estimated maximum resolution (in A) of significant CTF Thon rings is the
+                    #  same in other plugins that estimate the CTF
+                    ctfTomo.getResolution(),  # 21, rlnCtfMaxResolution
+                    # TODO: check if this value is used and, in that case, if we have this somewhere or have to store it
+                    #  in the data model
+                    ctfTomo.getFitQuality() if ctfTomo.getFitQuality() is not None else 0,  # 22, rlnCtfIceRingDensity
+                    # TODO: I've only seen this off tilt axis estimated in EMAN...
+                    0,  # 23, rlnTomoXTilt
+                    tiltAngle,  # 24, rlnTomoYTilt
+                    rotAngle,  # 25, rlnTomoZRot
+                    sxAngst,  # 26, rlnTomoXShiftAngst
+                    syAngst,  # 27, rlnTomoYShiftAngst
+                    np.cos(np.deg2rad(tiltAngle))  # 28, rlnCtfScalefactor
+                )
             # Write the STAR file
             tsTable.writeStar(f, tableName=tsId)
 
     @staticmethod
+    @convertStats.timed('convert50_tomo.alignedTsSet2Star')
     def alignedTsSet2Star(tsDict: Dict[str, TiltSeries],
                           outPath: str,
                           handedness: int = -1,
@@ -505,7 +562,10 @@ class Writer(WriterTomo):
         :param outPath: path (only path, no filename) in which the star file will be generated.
         """
         tsId = ts.getTsId()
-        with open(getTsStarFile(tsId, outPath), 'w') as f:
+        tsStarFile = getTsStarFile(tsId, outPath)
+        # It may be a hardlink to a cached file, which must not be modified
+        cleanPath(tsStarFile)
+        with open(tsStarFile, 'w') as f:
             Writer._writeScipionCommentLine(f)  # Initial comment
             sRate = ts.getSamplingRate()
             tiltAxisAngle = ts.getAcquisition().getTiltAxisAngle()
@@ -559,6 +619,7 @@ class Writer(WriterTomo):
             tsTable.writeStar(f, tableName=tsId)
 
     @staticmethod
+    @convertStats.timed('convert50_tomo.tomoSet2Star')
     def tomoSet2Star(tomoDict: Dict[str, Tomogram],
                      tsDict: Dict[str, TiltSeries],
                      outPath: str,
@@ -654,6 +715,7 @@ class Writer(WriterTomo):
             tomoTable.writeStar(f, tableName=GLOBAL_TABLE)
 
     @staticmethod
+    @convertStats.timed('convert50_tomo.coords2Star')
     def coords2Star(coordSet: SetOfCoordinates3D,
                     tomoDict: Dict[str, Tomogram],
                     outPath: str,
@@ -697,17 +759,27 @@ class Writer(WriterTomo):
             particlesTable = Table(columns=coordsStarFields)
             sRate = coordSet.getSamplingRate()
             coordsScale = 1 if isRe5Picking else coordsScale
-            for tsId, tomo in tomoDict.items():
-                for coord in coordSet.iterCoordinates(volume=tomo):
-                    angles, _ = getTransformInfoFromCoordOrSubtomo(coord, sRate)
-                    particlesTable.addRow(
+            # The coordinates are read in a single pass, grouped by tomogram, and written in the order of tomoDict.
+            # The angles are calculated for all of them at once, so their positions in the rows are left empty until
+            # then
+            tomoRows = {tsId: ([], []) for tsId in tomoDict}  # tsId --> (rows, matrices)
+            for tsId, coords in groupby(coordSet.iterItems(orderBy=[Coordinate3D.TOMO_ID_ATTR, 'id']),
+                                        key=lambda coord: coord.getTomoId()):
+                if tsId not in tomoRows:
+                    continue
+                tomo = tomoDict[tsId]
+                rows, matrices = tomoRows[tsId]
+                for coord in coords:
+                    coord.setVolume(tomo)
+                    matrices.append(np.array(getRelionMatrix(coord)))
+                    rows.append([
                         tsId,  # 1, rlnTomoName
                         coord.getX(RELION_3D_COORD_ORIGIN) * coordsScale,  # 2, rlnCoordinateX
                         coord.getY(RELION_3D_COORD_ORIGIN) * coordsScale,  # 3, rlnCoordinateY
                         coord.getZ(RELION_3D_COORD_ORIGIN) * coordsScale,  # 4, rlnCoordinateZ
-                        angles[0],  # 5, rlnTomoSubtomogramRot
-                        angles[1],  # 6, rlnTomoSubtomogramTilt
-                        angles[2],  # 7, rlnTomoSubtomogramPsi
+                        None,  # 5, rlnTomoSubtomogramRot
+                        None,  # 6, rlnTomoSubtomogramTilt
+                        None,  # 7, rlnTomoSubtomogramPsi
                         getattr(coord, R5_ROT_ATTRIB, Float(0)).get(),  # 8, rlnAngleRot
                         getattr(coord, R5_TILT_ATTRIB, Float(0)).get(),  # 9, rlnAngleTilt
                         getattr(coord, R5_PSI_ATTRIB, Float(0)).get(),  # 10, rlnAnglePsi
@@ -718,15 +790,23 @@ class Writer(WriterTomo):
                         coord.getY(SCIPION),  # _sciYCoord
                         coord.getZ(SCIPION),  # _sciZCoord
                         coord.getGroupId()  # _sciGroupId
-                    )
+                    ])
+            rows = [row for tsRows, _ in tomoRows.values() for row in tsRows]
+            matrices = [matrix for _, tsMatrices in tomoRows.values() for matrix in tsMatrices]
+            anglesList, _ = getTransformInfoFromMatrices(matrices, sRate)
+            for row, angles in zip(rows, anglesList.tolist()):
+                row[4:7] = angles
+                particlesTable.addRow(*row)
             # Write the STAR file
             particlesTable.writeStar(f, tableName=PARTICLES_TABLE)
 
-    @staticmethod
-    def pseudoSubtomograms2Star(pSubtomoSet: RelionSetOfPseudoSubtomograms,
+    @convertStats.timed('convert50_tomo.pseudoSubtomograms2Star')
+    def pseudoSubtomograms2Star(self,
+                                pSubtomoSet: RelionSetOfPseudoSubtomograms,
                                 outPath: str,
                                 are2dParticles: bool = True,
-                                isWarp=False):
+                                isWarp=False,
+                                flushChunk: int = PARTICLES_FLUSH_CHUNK):
         """Reads the data_particles table of a generated particles.star file. (output of the command execution
         relion_refine --print_metadata_labels):
 
@@ -771,10 +851,34 @@ class Writer(WriterTomo):
         :param are2dParticles: bool used case to choose the fields that will be present in the generated particles.star
         file, as they are not the same depending on if the particles are 2D or 3D.
         :param isWarp: flag to indicate if the particles used come from a Warp/M processing
+        :param flushChunk: number of rows written between consecutive flushes of the output file. The rows are
+        streamed to the file in chunks of this size, which are also used to convert the transformation matrices of
+        the particles into angles and shifts all at once, so the memory used does not depend on the set size.
         """
+        outStarFile = join(outPath, IN_PARTICLES_STAR)
+        # It may be a link to the particles file of the input set or to a cached file, which must not be modified
+        cleanPath(outStarFile)
+        # The binary sidecars of a previous version of the file would be stale. The rows are streamed to the file,
+        # so the sidecar is not written here, but by the first reader that parses it
+        removeStarTableSidecars(outStarFile)
+        cacheKey = None
+        if self.fileCache:
+            # The same sqlite may contain several sets, identified by their prefix
+            cacheKey = self.fileCache.getKey('pseudoSubtomograms2Star',
+                                             getFileStamp(pSubtomoSet.getFileName()),
+                                             pSubtomoSet.getPrefix(),
+                                             pSubtomoSet.getObjId(),
+                                             getFileStamp(pSubtomoSet.getParticlesStar()),
+                                             pSubtomoSet.getSize(),
+                                             pSubtomoSet.getSamplingRate(),
+                                             pSubtomoSet.getAcquisition().opticsGroupInfo.get(),
+                                             are2dParticles,
+                                             isWarp)
+            if self.fileCache.fetch(cacheKey, [outStarFile]):
+                return
         logger.info("Generating particles file from pseudosubtomogram set.")
         # Write the STAR file
-        with open(join(outPath, IN_PARTICLES_STAR), 'w') as f:
+        with open(outStarFile, 'w') as f:
             sRate = pSubtomoSet.getSamplingRate()
             # Initial comment
             Writer._writeScipionCommentLine(f)
@@ -788,7 +892,7 @@ class Writer(WriterTomo):
             optGroup.toStar(f)
 
             # Particles table
-            particlesStarFields = particles2dStarFields if are2dParticles else particles3dStarFields
+            particlesStarFields = list(particles2dStarFields if are2dParticles else particles3dStarFields)
             firstItem = pSubtomoSet.getFirstItem()
             hasCoords = firstItem.hasCoordinate3D()
             if hasCoords:
@@ -807,9 +911,31 @@ class Writer(WriterTomo):
 
             particlesStarFields.extend(warpCoordsFields)
 
+            # Write header first and then stream the rows. Table.writeStar writes each row with writeRow, so both take
+            # the width of the columns from the first row and the file is the same as the one written by writeStar
             particlesTable = Table(columns=particlesStarFields)
+            partsWriter = Table.Writer(f)
+            partsWriter.writeTableName(PARTICLES_TABLE)
+            partsWriter.writeHeader(particlesTable.getColumns())
+            # The angles and shifts are calculated in batches of flushChunk rows. Until then, their positions in
+            # the rows are left empty
+            chunkRows = []
+            chunkMatrices = []
+
+            def writeChunk():
+                if not chunkRows:
+                    return
+                anglesList, shiftsList = getTransformInfoFromMatrices(chunkMatrices, sRate)
+                for row, angles, shifts in zip(chunkRows, anglesList.tolist(), shiftsList.tolist()):
+                    row[1:4] = angles  # 2-4, rlnTomoSubtomogram{Rot, Tilt, Psi}
+                    row[13:16] = shifts  # 14-16, rlnOrigin{X, Y, Z}Angst
+                    partsWriter.writeRowValues(row)
+                convertStats.count('convert50_tomo.pseudoSubtomograms2Star', len(chunkRows))
+                chunkRows.clear()
+                chunkMatrices.clear()
+                f.flush()
+
             for pSubtomo in pSubtomoSet.iterSubtomos():
-                angles, shifts = getTransformInfoFromCoordOrSubtomo(pSubtomo, sRate)
                 # Fields 12 and 13 is different depending on if the particles are 2D or 3D
                 imageName = pSubtomo.getFileName()
                 if are2dParticles:
@@ -822,9 +948,9 @@ class Writer(WriterTomo):
                 # Add row to the table which will be used to generate the STAR file
                 particlesRow = [
                     pSubtomo.getTsId(),  # 1, rlnTomoName
-                    angles[0],  # 2, rlnTomoSubtomogramRot
-                    angles[1],  # 3, rlnTomoSubtomogramTilt
-                    angles[2],  # 4, rlnTomoSubtomogramPsi
+                    None,  # 2, rlnTomoSubtomogramRot
+                    None,  # 3, rlnTomoSubtomogramTilt
+                    None,  # 4, rlnTomoSubtomogramPsi
                     pSubtomo.getRot(),  # 5, rlnAngleRot
                     pSubtomo.getTilt(),  # 6, rlnAngleTilt
                     pSubtomo.getPsi(),  # 7, rlnAnglePsi
@@ -835,9 +961,9 @@ class Writer(WriterTomo):
                     field12,  # 12, rlnTomoVisibleFrames (for 2D particles) or rlnImageName (for 3D particles)
                     field13,  # 13, rlnImageName (for 2D particles) or rlnCtfImage (for 3D particles)
                     # pix * Å/pix = [shifts in Å]
-                    shifts[0],  # 14, rlnOriginXAngst
-                    shifts[1],  # 15, rlnOriginYAngst
-                    shifts[2],  # 16, rlnOriginZAngst,
+                    None,  # 14, rlnOriginXAngst
+                    None,  # 15, rlnOriginYAngst
+                    None,  # 16, rlnOriginZAngst,
                     pSubtomo.getXInImg(),  # 17, rlnCenteredCoordinateXAngst
                     pSubtomo.getYInImg(),  # 18, rlnCenteredCoordinateYAngst
                     pSubtomo.getZInImg(),  # 19, rlnCenteredCoordinateZAngst
@@ -860,9 +986,15 @@ class Writer(WriterTomo):
                                  str(pSubtomo.getCoordY()),  #32 rlnCoordinateY / warp
                                  str(pSubtomo.getCoordZ())]  #33 rlnCoordinateZ / warp
 
-                particlesTable.addRow(*particlesRow)
-                # Write the STAR file
-            particlesTable.writeStar(f, tableName=PARTICLES_TABLE)
+                chunkRows.append(particlesRow)
+                # Copy it, as the items of the set may be reused while iterating
+                chunkMatrices.append(np.array(getRelionMatrix(pSubtomo)))
+                if len(chunkRows) == flushChunk:
+                    writeChunk()
+            writeChunk()
+            partsWriter.writeNewline()
+        if self.fileCache:
+            self.fileCache.store(cacheKey, [outStarFile])
 
     @staticmethod
     def _writeScipionCommentLine(fileId):
@@ -912,137 +1044,218 @@ class Reader(ReaderTomo):
             outTs.append(ti)
             counter += 1
 
-    @staticmethod
-    def gen3dCoordFromStarRow(row, sRate, precedentIdDict, factor=1):
-        coordinate3d = None
-        tomoId = row.get(TOMO_NAME)
-        vol = precedentIdDict.get(tomoId, None)
-        if vol:
-            coordinate3d = Coordinate3D()
-            x = row.get(RLN_COORDINATEX, 0)  # / sRate
-            y = row.get(RLN_COORDINATEY, 0)  # / sRate
-            z = row.get(RLN_COORDINATEZ, 0)  # / sRate
-            coordinate3d.setVolume(vol)
-            coordinate3d.setX(float(x) * factor, RELION_3D_COORD_ORIGIN)
-            coordinate3d.setY(float(y) * factor, RELION_3D_COORD_ORIGIN)
-            coordinate3d.setZ(float(z) * factor, RELION_3D_COORD_ORIGIN)
-            trMatrix = getCoordsTransformMatrixFromRow(row, sRate=sRate)
-            coordinate3d.setMatrix(trMatrix, convention=TR_RELION)
-            # Extended fields
-            setattr(coordinate3d, R5_ROT_ATTRIB, Float(row.get(RLN_ANGLEROT, 0)))
-            setattr(coordinate3d, R5_TILT_ATTRIB, Float(row.get(RLN_ANGLETILT, 0)))
-            setattr(coordinate3d, R5_PSI_ATTRIB, Float(row.get(RLN_ANGLEPSI, 0)))
-            setattr(coordinate3d, R5_TILT_PRIOR_ATTRIB, Float(row.get(RLN_ANGLETILTPRIOR, 0)))
-            setattr(coordinate3d, R5_PSI_PRIO_ATTRIB, Float(row.get(RLN_ANGLEPSIPRIOR, 0)))
-
-        return coordinate3d, tomoId
-
+    @convertStats.timed('convert50_tomo.starFile2Coords3D')
     def starFile2Coords3D(self,
                           coordsSet: SetOfCoordinates3D,
                           tomogramsSet: SetOfTomograms,
-                          scaleFactor: bool = 1):
+                          scaleFactor: float = 1,
+                          batchSize: int = INSERT_BATCH_SIZE):
         """ Converts the contents of a preloaded star file into Scipion SetOfCoordinates3D.
         :param coordsSet: SetOfCoordinates3D that will be filled with the contest from the loaded star file
         :param tomogramsSet: introduced SetOfTomograms.
-        :param scaleFactor: used to scale the coordinates to the size of the tomograms."""
-        presentTsIds = tomogramsSet.getTSIds()
-        precedentIdDict = {tomo.getTsId(): tomo.clone() for tomo in tomogramsSet if tomo.getTsId() in presentTsIds}
+        :param scaleFactor: used to scale the coordinates to the size of the tomograms.
+        :param batchSize: number of coordinates inserted at once."""
         sRate = tomogramsSet.getSamplingRate()
-        nonMatchingTomoIds = ''
-        for row in self.dataTable:
-            # Consider that there can be coordinates in the star file that does not belong to any of the tomograms
-            # introduced
-            coord, tomoId = self.gen3dCoordFromStarRow(row,
-                                                       sRate,
-                                                       precedentIdDict,
-                                                       factor=scaleFactor)
-            if coord:
-                coordsSet.append(coord)
-            else:
-                if tomoId not in nonMatchingTomoIds:
-                    nonMatchingTomoIds += '%s ' % tomoId
-
+        getColumn = self.getColumnList
+        # Transformation matrices, all of them generated at once. Only the angles are considered
+        angles = np.column_stack([getColumn(label, 0) for label in
+                                  (RLN_TOMOSUBTOMOGRAMROT, RLN_TOMOSUBTOMOGRAMTILT, RLN_TOMOSUBTOMOGRAMPSI)])
+        matrices = genTransformMatrices(np.zeros(angles.shape), angles.astype(np.float64), sRate)
+        # Extended fields
+        extraColumns = {
+            R5_ROT_ATTRIB: (Float, getColumn(RLN_ANGLEROT, 0)),
+            R5_TILT_ATTRIB: (Float, getColumn(RLN_ANGLETILT, 0)),
+            R5_PSI_ATTRIB: (Float, getColumn(RLN_ANGLEPSI, 0)),
+            R5_TILT_PRIOR_ATTRIB: (Float, getColumn(RLN_ANGLETILTPRIOR, 0)),
+            R5_PSI_PRIO_ATTRIB: (Float, getColumn(RLN_ANGLEPSIPRIOR, 0)),
+        }
+        # Consider that there can be coordinates in the star file that does not belong to any of the tomograms
+        # introduced
+        nonMatchingTomoIds = self.appendCoords3D(coordsSet, tomogramsSet, matrices, extraColumns,
+                                                 scaleFactor=scaleFactor, batchSize=batchSize)
         if nonMatchingTomoIds:
             logger.info(yellowStr('The star file contains coordinates that belong to tomograms not present '
-                                  'in the introduced set of tomograms: %s' % nonMatchingTomoIds))
+                                  'in the introduced set of tomograms: %s' % ' '.join(nonMatchingTomoIds)))
 
     def starFile2PseudoSubtomograms(self, outputSet: RelionSetOfPseudoSubtomograms,
                                     calculateWarpCoords=False,
-                                    coordFactor=1):
-        sRate = outputSet.getSamplingRate()
-        coordSet = outputSet.getCoordinates3D()
-        counter = 0
-        for row, coord in zip(self.dataTable, coordSet):
-            t = Transform()
-            particleFile = row.get(RLN_IMAGENAME, None)
-            if calculateWarpCoords:
-                coordX = coord.getX(BOTTOM_LEFT_CORNER) * coordFactor
-                coordY = coord.getY(BOTTOM_LEFT_CORNER) * coordFactor
-                coordZ = coord.getZ(BOTTOM_LEFT_CORNER) * coordFactor
-            else:
-                coordX = row.get(RLN_COORDINATEX, 0)
-                coordY = row.get(RLN_COORDINATEY, 0)
-                coordZ = row.get(RLN_COORDINATEZ, 0)
-
-            psubtomo = RelionPSubtomogram(fileName=particleFile,
-                                          samplingRate=sRate,
-                                          tsId=row.get(RLN_TOMONAME),
-                                          classId=row.get(RLN_CLASSNUMBER, -1),
-                                          # Coords. in Relion they are in angstroms, while in Scipion they're in pixels
-                                          x=row.get(RLN_ORIGINXANGST, 0),
-                                          y=row.get(RLN_ORIGINYANGST, 0),
-                                          z=row.get(RLN_ORIGINZANGST, 0),
-                                          xInImg=row.get(RLN_CENTEREDCOORDINATEXANGST, 0),
-                                          yInImg=row.get(RLN_CENTEREDCOORDINATEYANGST, 0),
-                                          zInImg=row.get(RLN_CENTEREDCOORDINATEZANGST, 0),
-                                          rdnSubset=row.get(RANDOM_SUBSET, counter % 2 + 1),  # 1 and 2 alt. by default
-                                          relionParticleName=row.get(RLN_TOMOPARTICLENAME),
-                                          visibleFrames=str(row.get(RLN_TOMOVISIBLEFRAMES, 0)),
-                                          ctfFile=row.get(RLN_CTFIMAGE, FILE_NOT_FOUND),
-                                          opticsGroupId=row.get(OPTICS_GROUP, 1),
-                                          manifoldIndex=row.get(MANIFOLD_INDEX, 1 if counter % 2 else -1),  # 1 and -1
-                                          logLikeliCont=row.get(LOG_LIKELI_CONTRIB, -1),
-                                          maxValProbDist=row.get(MAX_VALUE_PROB_DISTRIB, -1),
-                                          noSignifSamples=row.get(NO_SIGNIFICANT_SAMPLES, -1),
-                                          rot=row.get(RLN_ANGLEROT, 0),
-                                          tilt=row.get(RLN_ANGLETILT, 0),
-                                          psi=row.get(RLN_ANGLEPSI, 0),
-                                          tiltPrior=row.get(RLN_ANGLETILTPRIOR, 0),
-                                          psiPrior=row.get(RLN_ANGLEPSIPRIOR, 0),
-                                          groupId=row.get(RLN_GROUPNUMBER, -1),
-                                          normCorrection=row.get(RLN_NORMCORRECTION, -1),
-                                          coordX=coordX,
-                                          coordY=coordY,
-                                          coordZ=coordZ,
-                                          )
-            counter += 1
-
-            # TODO: decide what to do with this
-            # Keeping particle id
-            # psubtomo.setObjId(row.get(TOMO_PARTICLE_ID))
-
-            # Set the coordinate3D
-            if row.get(SCIPION_COORD_X) is not None:  # Assume that the coordinates exists
-                sciCoord = Coordinate3D()
-                sciCoord.setX(row.get(SCIPION_COORD_X), SCIPION)
-                sciCoord.setY(row.get(SCIPION_COORD_Y), SCIPION)
-                sciCoord.setZ(row.get(SCIPION_COORD_Z), SCIPION)
-                sciCoord.setGroupId(row.get(SCIPION_COORD_GROUP_ID, 1))
-                sciCoord.setTomoId(row.get(TOMO_NAME))
-                psubtomo.setCoordinate3D(sciCoord)
-
-            # Set the transformation matrix
-            t.setMatrix(getTransformMatrixFromRow(row, sRate=sRate, isRe5Star=True))
-            psubtomo.setTransform(t)
-            # This is not necessary: psubtomo.setIndex(counter)
-            psubtomo.setClassId(row.get(RLN_CLASSNUMBER, 1))
-
-            # Add current pseudosubtomogram to the output set
-            outputSet.append(psubtomo)
+                                    coordFactor=1,
+                                    batchSize=INSERT_BATCH_SIZE):
+        psubtomo, columns, nItems, _ = self.getPseudoSubtomogramsColumns(outputSet,
+                                                                         calculateWarpCoords=calculateWarpCoords,
+                                                                         coordFactor=coordFactor)
+        if nItems > 0:
+            # Add the pseudosubtomograms to the output set
+            outputSet.appendFromColumns(psubtomo, columns, nItems, batchSize=batchSize)
 
         # Keep the number of particles to compare sizes in case of subset
         outputSet.setNReParticles(self.dataTable.size())
 
+    @convertStats.timed('convert50_tomo.getPseudoSubtomogramsColumns')
+    def getPseudoSubtomogramsColumns(self, outputSet: RelionSetOfPseudoSubtomograms,
+                                     calculateWarpCoords=False,
+                                     coordFactor=1) -> Tuple[Optional[RelionPSubtomogram], dict, int, None]:
+        """Reads the pseudosubtomograms of the star file as columns. It returns the first pseudosubtomogram, a
+        dictionary {attribute: values} with the values of the rest of them, as expected by
+        RelionSetOfPseudoSubtomograms.appendFromColumns, the number of pseudosubtomograms and their ids (None, as
+        they are consecutive)."""
+        sRate = outputSet.getSamplingRate()
+        coordSet = outputSet.getCoordinates3D()
+        nParticles = self.dataTable.size()
+        counters = np.arange(nParticles)
+        getColumn = self.getColumnList
+        # Read the columns once instead of accessing the row objects field by field
+        particleFiles = getColumn(RLN_IMAGENAME)
+        tsIds = getColumn(RLN_TOMONAME)
+        classIds = getColumn(RLN_CLASSNUMBER, -1)
+        # Coords. in Relion they are in angstroms, while in Scipion they're in pixels
+        xList = getColumn(RLN_ORIGINXANGST, 0)
+        yList = getColumn(RLN_ORIGINYANGST, 0)
+        zList = getColumn(RLN_ORIGINZANGST, 0)
+        xInImgList = getColumn(RLN_CENTEREDCOORDINATEXANGST, 0)
+        yInImgList = getColumn(RLN_CENTEREDCOORDINATEYANGST, 0)
+        zInImgList = getColumn(RLN_CENTEREDCOORDINATEZANGST, 0)
+        rdnSubsets = getColumn(RANDOM_SUBSET, counters % 2 + 1)  # 1 and 2 alt. by default
+        particleNames = getColumn(RLN_TOMOPARTICLENAME)
+        visibleFramesList = getColumn(RLN_TOMOVISIBLEFRAMES, 0)
+        ctfFiles = getColumn(RLN_CTFIMAGE, FILE_NOT_FOUND)
+        opticsGroupIds = getColumn(OPTICS_GROUP, 1)
+        manifoldIndices = getColumn(MANIFOLD_INDEX, np.where(counters % 2, 1, -1))  # 1 and -1
+        logLikeliConts = getColumn(LOG_LIKELI_CONTRIB, -1)
+        maxValProbDists = getColumn(MAX_VALUE_PROB_DISTRIB, -1)
+        noSignifSamplesList = getColumn(NO_SIGNIFICANT_SAMPLES, -1)
+        rots = getColumn(RLN_ANGLEROT, 0)
+        tilts = getColumn(RLN_ANGLETILT, 0)
+        psis = getColumn(RLN_ANGLEPSI, 0)
+        tiltPriors = getColumn(RLN_ANGLETILTPRIOR, 0)
+        psiPriors = getColumn(RLN_ANGLEPSIPRIOR, 0)
+        groupIds = getColumn(RLN_GROUPNUMBER, -1)
+        normCorrections = getColumn(RLN_NORMCORRECTION, -1)
+        classNumbers = getColumn(RLN_CLASSNUMBER, 1)
+        if not calculateWarpCoords:
+            coordXList = getColumn(RLN_COORDINATEX, 0)
+            coordYList = getColumn(RLN_COORDINATEY, 0)
+            coordZList = getColumn(RLN_COORDINATEZ, 0)
+        # Transformation matrices, all of them generated at once
+        matrices = getTransformMatricesFromTable(self, sRate=sRate, isRe5Star=True)
+        # Scipion coordinates
+        hasSciCoords = self.dataTable.hasColumn(SCIPION_COORD_X)
+        if hasSciCoords:
+            sciXList = getColumn(SCIPION_COORD_X)
+            sciYList = getColumn(SCIPION_COORD_Y)
+            sciZList = getColumn(SCIPION_COORD_Z)
+            sciGroupIds = getColumn(SCIPION_COORD_GROUP_ID, 1)
+            sciTomoIds = getColumn(TOMO_NAME)
+
+        # There can not be more particles than coordinates
+        nItems = min(nParticles, coordSet.getSize())
+        if calculateWarpCoords:
+            coordXList, coordYList, coordZList = [], [], []
+            for coord in islice(coordSet, nItems):
+                coordXList.append(coord.getX(BOTTOM_LEFT_CORNER) * coordFactor)
+                coordYList.append(coord.getY(BOTTOM_LEFT_CORNER) * coordFactor)
+                coordZList.append(coord.getZ(BOTTOM_LEFT_CORNER) * coordFactor)
+        visibleFramesList = [str(visibleFrames) for visibleFrames in visibleFramesList]
+
+        # Only the first particle is created as an object. The rest of them are inserted in the set directly from
+        # the columns read
+        if nItems == 0:
+            return None, {}, 0, None
+        itemType = outputSet.getItemType()
+        psubtomo = itemType(fileName=particleFiles[0],
+                            samplingRate=sRate,
+                            tsId=tsIds[0],
+                            classId=classIds[0],
+                            x=xList[0],
+                            y=yList[0],
+                            z=zList[0],
+                            xInImg=xInImgList[0],
+                            yInImg=yInImgList[0],
+                            zInImg=zInImgList[0],
+                            rdnSubset=rdnSubsets[0],
+                            relionParticleName=particleNames[0],
+                            visibleFrames=visibleFramesList[0],
+                            ctfFile=ctfFiles[0],
+                            opticsGroupId=opticsGroupIds[0],
+                            manifoldIndex=manifoldIndices[0],
+                            logLikeliCont=logLikeliConts[0],
+                            maxValProbDist=maxValProbDists[0],
+                            noSignifSamples=noSignifSamplesList[0],
+                            rot=rots[0],
+                            tilt=tilts[0],
+                            psi=psis[0],
+                            tiltPrior=tiltPriors[0],
+                            psiPrior=psiPriors[0],
+                            groupId=groupIds[0],
+                            normCorrection=normCorrections[0],
+                            coordX=coordXList[0],
+                            coordY=coordYList[0],
+                            coordZ=coordZList[0],
+                            )
+
+        # TODO: decide what to do with this
+        # Keeping particle id
+        # psubtomo.setObjId(row.get(TOMO_PARTICLE_ID))
+
+        # Set the coordinate3D
+        if hasSciCoords:  # Assume that the coordinates exists
+            sciCoord = Coordinate3D()
+            sciCoord.setX(sciXList[0], SCIPION)
+            sciCoord.setY(sciYList[0], SCIPION)
+            sciCoord.setZ(sciZList[0], SCIPION)
+            sciCoord.setGroupId(sciGroupIds[0])
+            sciCoord.setTomoId(sciTomoIds[0])
+            psubtomo.setCoordinate3D(sciCoord)
+
+        # Set the transformation matrix
+        t = Transform()
+        t.setMatrix(matrices[0].copy())
+        psubtomo.setTransform(t)
+        # This is not necessary: psubtomo.setIndex(counter)
+        psubtomo.setClassId(classNumbers[0])
+
+        columns = {
+            '_filename': particleFiles,
+            RelionPSubtomogram.TS_ID_ATTRIBUTE: tsIds,
+            '_classId': classNumbers,
+            '_x': xList,
+            '_y': yList,
+            '_z': zList,
+            '_xInImg': xInImgList,
+            '_yInImg': yInImgList,
+            '_zInImg': zInImgList,
+            '_rdnSubset': rdnSubsets,
+            '_relionParticleName': particleNames,
+            '_visibleFrames': visibleFramesList,
+            '_ctfFile': ctfFiles,
+            '_opticsGroupId': opticsGroupIds,
+            '_manifoldIndex': manifoldIndices,
+            '_logLikeliContribution': logLikeliConts,
+            '_maxValueProbDistribution': maxValProbDists,
+            '_nrOfSignificantSamples': noSignifSamplesList,
+            '_rot': rots,
+            '_tilt': tilts,
+            '_psi': psis,
+            '_tiltPrior': tiltPriors,
+            '_psiPrior': psiPriors,
+            '_groupId': groupIds,
+            '_normCorrection': normCorrections,
+            '_coordX': coordXList,
+            '_coordY': coordYList,
+            '_coordZ': coordZList,
+            '_transform._matrix': matrices,
+        }
+        if hasSciCoords:
+            columns.update({
+                '_coordinate._x': sciXList,
+                '_coordinate._y': sciYList,
+                '_coordinate._z': sciZList,
+                '_coordinate._groupId': sciGroupIds,
+                '_coordinate._tomoId': sciTomoIds,
+            })
+        convertStats.count('convert50_tomo.getPseudoSubtomogramsColumns', nItems)
+        return psubtomo, columns, nItems, None
+
 
 def getProjMatrixList(tsStarFile: str, 
                       tomogram: Tomogram, 
@@ -1067,42 +1280,39 @@ def getProjMatrixList(tsStarFile: str,
     # *
     # * /
     # specimen_shifts(xshift_angst / optics.pixelSize, yshift_angst / optics.pixelSize, 0.);
-    prjMatrixList = []
-    indexList = []
-    dataTable = Table()
-    dataTable.read(tsStarFile)
+    prjMatrices, indexList = getProjMatrices(tsStarFile, ts)
+    return list(prjMatrices), indexList
+
+
+def getProjMatrices(tsStarFile: str, ts: TiltSeries) -> Tuple[np.ndarray, List[int]]:
+    """Same as getProjMatrixList, but the projection matrices of all the tilt-images are generated at once and
+    returned as a (T, 4, 4) array, being T the number of tilt-images contained in the tilt-series star file."""
+    dataTable = readStarTable(tsStarFile)
     tsSRate = ts.getSamplingRate()
     ih = ImageHandler()
-    tomoXDim, tomoYDim, tomoZDim, _ = ih.getDimensions(tomogram.getFileName())
     tsXDim, tsYDim, _, _ = ih.getDimensions(ts.getFirstItem().getFileName())
-    for row in dataTable:
-        xRotAngle = row.get(RLN_TOMO_X_TILT, None)
-        yRotAngle = row.get(RLN_TOMO_Y_TILT, None)
-        zRotAngle = row.get(RLN_TOMO_Z_ROT, None)
-        sxAngst = row.get(RLN_TOMO_X_SHIFT_ANGST, None)
-        syAngst = row.get(RLN_TOMO_Y_SHIFT_ANGST, None)
-        # Rotate specimen around X-axis
-        r0 = gen3dRotXMatrix(xRotAngle)
-        r1 = gen3dRotYMatrix(yRotAngle)
-        r2 = gen3dRotZMatrix(zRotAngle)
-        # Translations
-        s0 = genTranslationMatrix(-tomoXDim / 2, -tomoYDim / 2, -tomoZDim / 2)
-        s1 = genTranslationMatrix(sxAngst / tsSRate, syAngst / tsSRate, 0)
-        s2 = genTranslationMatrix(tsXDim / 2, tsYDim / 2, 0)
-        # Projection matrix
-        # prjMatrix = s2 @ s1 @ r2 @ r1 @ r0 @ s0
-        prjMatrix = s2 @ s1 @ r2 @ r1 @ r0
-        # logger.info(yellowStr(prjMatrix))
-        # logger.info(f's2 =\n{s2}')
-        # logger.info(f's1 =\n{s1}')
-        # logger.info(f'r2 =\n{r2}')
-        # logger.info(f'r1 =\n{r1}')
-        # logger.info(f'r0 =\n{r0}')
-        # logger.info(f's0 =\n{s0}')
-        prjMatrixList.append(prjMatrix)
-        indexList.append(int(row.get(RLN_MICROGRAPH_NAME).split('@')[0]))
-
-    return prjMatrixList, indexList
+    # Rotate specimen around X, Y and Z axes
+    r0 = gen3dRotXMatrices(dataTable.getColumnArray(RLN_TOMO_X_TILT))
+    r1 = gen3dRotYMatrices(dataTable.getColumnArray(RLN_TOMO_Y_TILT))
+    r2 = gen3dRotZMatrices(dataTable.getColumnArray(RLN_TOMO_Z_ROT))
+    # Translations. The one to put the specimen center at the origin (s0) is not applied, as the particles
+    # coordinates are already centered
+    s1 = np.tile(np.eye(4), (dataTable.size(), 1, 1))
+    s1[:, 0, 3] = dataTable.getColumnArray(RLN_TOMO_X_SHIFT_ANGST) / tsSRate
+    s1[:, 1, 3] = dataTable.getColumnArray(RLN_TOMO_Y_SHIFT_ANGST) / tsSRate
+    s2 = genTranslationMatrix(tsXDim / 2, tsYDim / 2, 0)
+    # Projection matrices: s2 @ s1 @ r2 @ r1 @ r0
+    prjMatrices = s2 @ s1 @ r2 @ r1 @ r0
+    indexList = [int(micName.split('@')[0]) for micName in dataTable.getColumnValues(RLN_MICROGRAPH_NAME)]
+    return prjMatrices, indexList
+
+
+def projectCoordinates(prjMatrices: np.ndarray, coords: np.ndarray) -> np.ndarray:
+    """Projects the (N, 3) array of coordinates coords with each of the (T, 4, 4) projection matrices. It returns a
+    (N, T, 2) array with the projected x and y of each coordinate in each tilt-image."""
+    homCoords = np.ones((len(coords), 4))
+    homCoords[:, :3] = coords
+    return np.einsum('tij,nj->nti', prjMatrices[:, :2, :], homCoords)
 
 
 def gen3dRotXMatrix(angleInDeg):
@@ -1129,6 +1339,44 @@ def gen3dRotZMatrix(angleInDeg):
                      [0, 0, 0, 1]])
 
 
+def gen3dRotXMatrices(anglesInDeg):
+    """Vectorized version of gen3dRotXMatrix. It returns an (N, 4, 4) array."""
+    c, s = _getCosSin(anglesInDeg)
+    matrices = np.tile(np.eye(4), (len(c), 1, 1))
+    matrices[:, 1, 1] = c
+    matrices[:, 1, 2] = -s
+    matrices[:, 2, 1] = s
+    matrices[:, 2, 2] = c
+    return matrices
+
+
+def gen3dRotYMatrices(anglesInDeg):
+    """Vectorized version of gen3dRotYMatrix. It returns an (N, 4, 4) array."""
+    c, s = _getCosSin(anglesInDeg)
+    matrices = np.tile(np.eye(4), (len(c), 1, 1))
+    matrices[:, 0, 0] = c
+    matrices[:, 0, 2] = s
+    matrices[:, 2, 0] = -s
+    matrices[:, 2, 2] = c
+    return matrices
+
+
+def gen3dRotZMatrices(anglesInDeg):
+    """Vectorized version of gen3dRotZMatrix. It returns an (N, 4, 4) array."""
+    c, s = _getCosSin(anglesInDeg)
+    matrices = np.tile(np.eye(4), (len(c), 1, 1))
+    matrices[:, 0, 0] = c
+    matrices[:, 0, 1] = -s
+    matrices[:, 1, 0] = s
+    matrices[:, 1, 1] = c
+    return matrices
+
+
+def _getCosSin(anglesInDeg):
+    anglesInRad = np.radians(np.asarray(anglesInDeg, dtype=np.float64))
+    return np.cos(anglesInRad), np.sin(anglesInRad)
+
+
 def genTranslationMatrix(sx, sy, sz):
     trMatrix = np.eye(4)
     trMatrix[0, 3] = sx
@@ -1137,31 +1385,74 @@ def genTranslationMatrix(sx, sy, sz):
     return trMatrix
 
 
-def getCoordsTransformMatrixFromRow(row, sRate=1):
-    shiftx = 0
-    shifty = 0
-    shiftz = 0
-    rot = row.get(RLN_TOMOSUBTOMOGRAMROT, 0)
-    tilt = row.get(RLN_TOMOSUBTOMOGRAMTILT, 0)
-    psi = row.get(RLN_TOMOSUBTOMOGRAMPSI, 0)
-    return genTransformMatrix(shiftx, shifty, shiftz, rot, tilt, psi, sRate)
+class StarTableGroups:
+    """Grouped view of the rows of a StarTable by the values of one of its columns (the tomogram name by default),
+    so the rows of each group can be accessed without scanning the whole table again. The groups are built in a
+    single pass over the table and keep the order of the rows in it. They are iterated in the order in which each
+    group appears in the table for the first time.
 
+    Example:
+        particlesByTs = StarTableGroups(particlesTable)
+        for tsId in particlesByTs:
+            xCoords = particlesByTs.getColumn(tsId, RLN_CENTEREDCOORDINATEXANGST)
+    """
 
-class StarFileIterator:
-    def __init__(self, star_data, field_name, field_value):
-        self.star_data = star_data
-        self.field_name = field_name
-        self.field_value = field_value
-        self.index = 0
+    def __init__(self, table: StarTable, colName: str = RLN_TOMONAME):
+        self.table = table
+        self.colName = colName
+        self._columns = {}  # Column arrays already requested, to avoid converting them for each group
+        self._groups = self._groupRows()
+
+    def _groupRows(self) -> Dict[str, np.ndarray]:
+        if self.table.isCategorical(self.colName):
+            # Stable sort of the categorical codes: the rows of each group are contiguous and keep their order
+            codes = self.table.getCodes(self.colName)
+            sortedIndices = np.argsort(codes, kind='stable')
+            groupCodes, firstIndices, counts = np.unique(codes, return_index=True, return_counts=True)
+            indicesList = np.split(sortedIndices, np.cumsum(counts)[:-1])
+            categories = self.table.getCategories(self.colName)
+            return {categories[groupCodes[i]]: indicesList[i] for i in np.argsort(firstIndices, kind='stable')}
+        groups = {}
+        for index, value in enumerate(self.table.getColumnValues(self.colName)):
+            groups.setdefault(value, []).append(index)
+        return {value: np.array(indices, dtype=np.int64) for value, indices in groups.items()}
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        while self.index < len(self.star_data):
-            if self.star_data[self.index].get(self.field_name) == self.field_value:
-                result = self.star_data[self.index]
-                self.index += 1
-                return result
-            self.index += 1
-        raise StopIteration
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __contains__(self, key):
+        return key in self._groups
+
+    def keys(self):
+        return self._groups.keys()
+
+    def getIndices(self, key) -> np.ndarray:
+        """Indices, in the table, of the rows of the given group. It is empty if there is no such group."""
+        return self._groups.get(key, np.empty(0, dtype=np.int64))
+
+    def size(self, key) -> int:
+        return len(self.getIndices(key))
+
+    def getColumn(self, key, colName: str, default=None) -> Optional[np.ndarray]:
+        """Values of the column colName for the rows of the given group. If the column does not exist, they are
+        filled with the default value, or None is returned if there is no default value."""
+        indices = self.getIndices(key)
+        if not self.table.hasColumn(colName):
+            if default is None:
+                return None
+            return np.full(len(indices), default, dtype=object if isinstance(default, str) else None)
+        if colName not in self._columns:
+            self._columns[colName] = self.table.getColumnArray(colName)
+        return self._columns[colName][indices]
+
+    def getTable(self, key) -> StarTable:
+        """New table containing only the rows of the given group."""
+        return self.table.take(self.getIndices(key))
+
+    def iterRows(self, key):
+        """Iterates the rows of the given group."""
+        for index in self.getIndices(key):
+            yield self.table[int(index)]
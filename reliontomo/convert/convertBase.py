@@ -22,20 +22,29 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
+import csv
 import logging
-from os.path import join
+from itertools import repeat
+from os.path import join, exists
+from typing import Dict, List, Tuple
 import numpy as np
 from pwem.convert import transformations
 from pwem.convert.transformations import translation_from_matrix, euler_from_matrix
 from pwem.emlib.image import ImageHandler
-from pyworkflow.utils import getExt, removeBaseExt, replaceBaseExt, makePath, cyanStr
+from pyworkflow.utils import getExt, removeBaseExt, replaceBaseExt, makePath
 from relion.convert.convert_base import WriterBase
-from reliontomo.constants import MRC, SHIFTX_ANGST, SHIFTY_ANGST, SHIFTZ_ANGST, TILT, PSI, ROT
-from tomo.constants import TR_RELION
-from tomo.objects import Coordinate3D
+from reliontomo.constants import MRC, SHIFTX_ANGST, SHIFTY_ANGST, SHIFTZ_ANGST, TILT, PSI, ROT, TOMO_NAME, COORD_X, \
+    COORD_Y, COORD_Z, RELION_3D_COORD_ORIGIN, RLN_ORIGINXANGST, RLN_ORIGINYANGST, RLN_ORIGINZANGST, \
+    RLN_TOMOSUBTOMOGRAMROT, RLN_TOMOSUBTOMOGRAMTILT, RLN_TOMOSUBTOMOGRAMPSI
+from reliontomo.objects import appendItemsFromColumns, INSERT_BATCH_SIZE
+from reliontomo.utils import convertStats
+from tomo.constants import TR_RELION, SCIPION
+from tomo.objects import Coordinate3D, SetOfCoordinates3D, SetOfTomograms, LandmarkModel
 
 logger = logging.getLogger(__name__)
 
+LANDMARK_FIELDS = ['xCoor', 'yCoor', 'tiltIm', 'chainId', 'xResid', 'yResid']  # Columns of the landmarks files
+
 
 class WriterTomo(WriterBase):
     def __init__(self,  **kwargs):
@@ -48,10 +57,90 @@ class ReaderTomo:
         self.starFile = starFile
         self.dataTable = dataTable
 
+    def getColumnList(self, colName, default=None):
+        """Returns the values of the column colName of the loaded table as a list. If the column is not present, a
+        list filled with the default value is returned. The default can also be a list or an array with one value
+        per row."""
+        if self.dataTable.hasColumn(colName):
+            return self.dataTable.getColumnValues(colName)
+        if isinstance(default, (list, np.ndarray)):
+            return list(default)
+        return [default] * self.dataTable.size()
+
+    @convertStats.timed('convertBase.appendCoords3D')
+    def appendCoords3D(self,
+                       coordsSet: SetOfCoordinates3D,
+                       tomogramsSet: SetOfTomograms,
+                       matrices: np.ndarray,
+                       extraColumns: Dict[str, Tuple[type, list]],
+                       scaleFactor: float = 1,
+                       batchSize: int = INSERT_BATCH_SIZE) -> List[str]:
+        """Bulk conversion of the coordinates of the loaded table into Coordinate3D, which are inserted in coordsSet
+        without creating an object for each of them (see appendItemsFromColumns). The coordinates are scaled and
+        referred to the tomograms all at once. The rows whose tomogram is not in tomogramsSet are skipped.
+        :param coordsSet: SetOfCoordinates3D in which the coordinates will be inserted.
+        :param tomogramsSet: SetOfTomograms to which the coordinates belong.
+        :param matrices: (N, 4, 4) stack with the transformation matrix of each row, in Relion's convention.
+        :param extraColumns: dictionary of type {attribute: (class, values)} with the extended attributes to be
+        added to each coordinate.
+        :param scaleFactor: used to scale the coordinates to the size of the tomograms.
+        :param batchSize: number of coordinates inserted at once.
+        :return: the tomogram names of the skipped rows.
+        """
+        tomoNames, tomoIndices = np.unique(np.asarray(self.getColumnList(TOMO_NAME), dtype=str), return_inverse=True)
+        # Id and offset of the coordinates (the one applied by Coordinate3D.setX, setY and setZ) of each tomogram
+        tomoObjIds = np.zeros(len(tomoNames), dtype=np.int64)
+        tomoOffsets = np.zeros((len(tomoNames), 3))
+        tomoPresent = np.zeros(len(tomoNames), dtype=bool)
+        namePositions = {name: ind for ind, name in enumerate(tomoNames)}
+        auxCoord = Coordinate3D()
+        for tomo in tomogramsSet.iterItems():
+            ind = namePositions.get(tomo.getTsId(), None)
+            if ind is not None:
+                auxCoord.setVolume(tomo)
+                auxCoord.setPosition(0, 0, 0, RELION_3D_COORD_ORIGIN)
+                tomoObjIds[ind] = tomo.getObjId()
+                tomoOffsets[ind] = auxCoord.getPosition(SCIPION)
+                tomoPresent[ind] = True
+
+        rows = np.flatnonzero(tomoPresent[tomoIndices])
+        size = len(rows)
+        if size > 0:
+            rowTomos = tomoIndices[rows]
+            coords = np.column_stack([self.getColumnList(label, 0) for label in (COORD_X, COORD_Y, COORD_Z)])
+            coords = coords.astype(np.float64)[rows] * scaleFactor + tomoOffsets[rowTomos]
+            sciMatrices = relionToScipionMatrices(np.asarray(matrices)[rows])
+            columns = {
+                '_x': coords[:, 0],
+                '_y': coords[:, 1],
+                '_z': coords[:, 2],
+                '_volId': tomoObjIds[rowTomos],
+                Coordinate3D.TOMO_ID_ATTR: tomoNames[rowTomos],
+                '_eulerMatrix._matrix': sciMatrices,
+            }
+            # Only the first coordinate is created as an object
+            firstCoord = Coordinate3D()
+            firstCoord.setVolume(tomogramsSet[int(tomoObjIds[rowTomos[0]])])
+            firstCoord.setPosition(*coords[0], SCIPION)
+            firstCoord.setMatrix(sciMatrices[0])
+            for attrName, (attrClass, values) in extraColumns.items():
+                values = np.asarray(values)[rows]
+                setattr(firstCoord, attrName, attrClass(values[0].item()))
+                columns[attrName] = values
+            appendItemsFromColumns(coordsSet, firstCoord, columns, size, batchSize=batchSize)
+            convertStats.count('convertBase.appendCoords3D', size)
+
+        return [str(name) for name in tomoNames[~tomoPresent]]
+
+
+def getRelionMatrix(obj):
+    """Returns the transformation matrix of a coordinate or a subtomogram in Relion's convention."""
+    return obj.getMatrix(convention=TR_RELION) if isinstance(obj, Coordinate3D) else obj.getTransform(convention=TR_RELION).getMatrix()
+
 
 def getTransformInfoFromCoordOrSubtomo(obj, samplingRate):
 
-    M = obj.getMatrix(convention=TR_RELION) if isinstance(obj, Coordinate3D) else obj.getTransform(convention=TR_RELION).getMatrix()
+    M = getRelionMatrix(obj)
     shifts = translation_from_matrix(M)
 
     # These 2 lines below were done when inverting, which is now what we always do.
@@ -75,47 +164,19 @@ def checkSubtomogramFormat(subtomo, extraPath):
         ih.convert(subtomo.getFileName(), mrcFile)
 
 
-# def getTransformMatrixFromRow(row, sRate=1, isRe5Star=False):
-#     if isRe5Star:
-#         from reliontomo.convert.convert50_tomo import RLN_ORIGINZANGST, RLN_ORIGINYANGST, RLN_ORIGINXANGST, \
-#             RLN_TOMOSUBTOMOGRAMROT, RLN_TOMOSUBTOMOGRAMTILT, RLN_TOMOSUBTOMOGRAMPSI
-#         shiftx = float(row.get(RLN_ORIGINXANGST, 0))
-#         shifty = float(row.get(RLN_ORIGINYANGST, 0))
-#         shiftz = float(row.get(RLN_ORIGINZANGST, 0))
-#         rot = row.get(RLN_TOMOSUBTOMOGRAMROT, 0)
-#         tilt = row.get(RLN_TOMOSUBTOMOGRAMTILT, 0)
-#         psi = row.get(RLN_TOMOSUBTOMOGRAMPSI, 0)
-#     else:
-#         shiftx = float(row.get(SHIFTX_ANGST, 0))
-#         shifty = float(row.get(SHIFTY_ANGST, 0))
-#         shiftz = float(row.get(SHIFTZ_ANGST, 0))
-#         rot = row.get(ROT, 0)
-#         tilt = row.get(TILT, 0)
-#         psi = row.get(PSI, 0)
-#
-#     return genTransformMatrix(shiftx, shifty, shiftz, rot, tilt, psi, sRate)
+# Labels of the shifts and the angles read by getTransformMatrixFromRow and getTransformMatricesFromTable
+_RE5_SHIFT_LABELS = (RLN_ORIGINXANGST, RLN_ORIGINYANGST, RLN_ORIGINZANGST)
+_RE5_ANGLE_LABELS = (RLN_TOMOSUBTOMOGRAMROT, RLN_TOMOSUBTOMOGRAMTILT, RLN_TOMOSUBTOMOGRAMPSI)
+_SHIFT_LABELS = (SHIFTX_ANGST, SHIFTY_ANGST, SHIFTZ_ANGST)
+_ANGLE_LABELS = (ROT, TILT, PSI)
 
 
 def getTransformMatrixFromRow(row, sRate=1, isRe5Star=False):
-    if isRe5Star:
-        logger.info(cyanStr('Is Relion 5'))
-        from reliontomo.convert.convert50_tomo import RLN_ORIGINZANGST, RLN_ORIGINYANGST, RLN_ORIGINXANGST, \
-            RLN_TOMOSUBTOMOGRAMROT, RLN_TOMOSUBTOMOGRAMTILT, RLN_TOMOSUBTOMOGRAMPSI
-        shiftx = float(row.get(RLN_ORIGINXANGST, 0))
-        shifty = float(row.get(RLN_ORIGINYANGST, 0))
-        shiftz = float(row.get(RLN_ORIGINZANGST, 0))
-        rot = row.get(RLN_TOMOSUBTOMOGRAMROT, 0)
-        tilt = row.get(RLN_TOMOSUBTOMOGRAMTILT, 0)
-        psi = row.get(RLN_TOMOSUBTOMOGRAMPSI, 0)
-    else:
-        logger.info(cyanStr('It is NOT Relion 5'))
-        shiftx = float(row.get(SHIFTX_ANGST, 0))
-        shifty = float(row.get(SHIFTY_ANGST, 0))
-        shiftz = float(row.get(SHIFTZ_ANGST, 0))
-        rot = row.get(ROT, 0)
-        tilt = row.get(TILT, 0)
-        psi = row.get(PSI, 0)
-
+    shiftLabels, angleLabels = (_RE5_SHIFT_LABELS, _RE5_ANGLE_LABELS) if isRe5Star else (_SHIFT_LABELS, _ANGLE_LABELS)
+    shiftx, shifty, shiftz = [float(row.get(label, 0)) for label in shiftLabels]
+    rot, tilt, psi = [row.get(label, 0) for label in angleLabels]
+    convertStats.trace('getTransformMatrixFromRow', 'isRe5Star = %s, shifts = %s, angles = %s',
+                       isRe5Star, (shiftx, shifty, shiftz), (rot, tilt, psi))
     return genTransformMatrix(shiftx, shifty, shiftz, rot, tilt, psi, sRate)
 
 
@@ -137,3 +198,107 @@ def genTransformMatrix(shiftx, shifty, shiftz, rot, tilt, psi, sRate):
     #     M[2, 3] = shifts[2]
 
     return M
+
+
+# Batched versions of the conversions above. They work on whole particle sets at once: angles and shifts are
+# (N, 3) arrays and the transformation matrices are (N, 4, 4) stacks. The Euler angles follow the 'szyz' convention
+# of pwem.convert.transformations, which is the one used by Relion.
+def eulerMatricesZYZ(radAngles):
+    """Vectorized version of transformations.euler_matrix(rot, tilt, psi, 'szyz') for an (N, 3) array of angles
+    expressed in radians. It returns an (N, 4, 4) stack of homogeneous rotation matrices."""
+    radAngles = np.asarray(radAngles, dtype=np.float64).reshape(-1, 3)
+    # Axes 'szyz' means first axis z (i = 2, j = 1, k = 0) with odd parity, so the angles are negated
+    ai, aj, ak = -radAngles[:, 0], -radAngles[:, 1], -radAngles[:, 2]
+    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M = np.zeros((len(radAngles), 4, 4))
+    M[:, 2, 2] = cj
+    M[:, 2, 1] = sj * si
+    M[:, 2, 0] = sj * ci
+    M[:, 1, 2] = sj * sk
+    M[:, 1, 1] = -cj * ss + cc
+    M[:, 1, 0] = -cj * cs - sc
+    M[:, 0, 2] = -sj * ck
+    M[:, 0, 1] = cj * sc + cs
+    M[:, 0, 0] = cj * cc - ss
+    M[:, 3, 3] = 1
+    return M
+
+
+def eulerAnglesFromMatricesZYZ(matrices):
+    """Vectorized version of transformations.euler_from_matrix(M, 'szyz') for an (N, 4, 4) or (N, 3, 3) stack of
+    matrices. It returns an (N, 3) array with the angles expressed in radians."""
+    M = np.asarray(matrices, dtype=np.float64)[:, :3, :3]
+    sy = np.sqrt(M[:, 2, 1] ** 2 + M[:, 2, 0] ** 2)
+    regular = sy > transformations._EPS
+    ax = np.where(regular, np.arctan2(M[:, 2, 1], M[:, 2, 0]), np.arctan2(-M[:, 1, 0], M[:, 1, 1]))
+    ay = np.arctan2(sy, M[:, 2, 2])
+    az = np.where(regular, np.arctan2(M[:, 1, 2], -M[:, 0, 2]), 0.0)
+    return -np.stack((ax, ay, az), axis=1)
+
+
+def genTransformMatrices(shifts, angles, sRate):
+    """Batched version of genTransformMatrix. The shifts (in Angstroms) and the angles (rot, tilt, psi, in degrees)
+    are (N, 3) arrays. It returns an (N, 4, 4) stack of matrices."""
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 3) / sRate
+    M = eulerMatricesZYZ(-np.deg2rad(np.asarray(angles, dtype=np.float64)))
+    M[:, :3, 3] = -shifts
+    return np.linalg.inv(M)
+
+
+def getTransformInfoFromMatrices(matrices, samplingRate):
+    """Batched version of getTransformInfoFromCoordOrSubtomo. It receives an (N, 4, 4) stack of matrices in Relion's
+    convention and returns two (N, 3) arrays: the angles (rot, tilt, psi, in degrees) and the shifts (in Angstroms)."""
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    shifts = -matrices[:, :3, 3] * samplingRate
+    angles = -np.rad2deg(eulerAnglesFromMatricesZYZ(np.linalg.inv(matrices)))
+    return angles, shifts
+
+
+def getTransformMatricesFromTable(reader, sRate=1, isRe5Star=False):
+    """Batched version of getTransformMatrixFromRow. It reads the shifts and the angles from the table loaded in the
+    given ReaderTomo and returns an (N, 4, 4) stack with the transformation matrix of each row."""
+    shiftLabels, angleLabels = (_RE5_SHIFT_LABELS, _RE5_ANGLE_LABELS) if isRe5Star else (_SHIFT_LABELS, _ANGLE_LABELS)
+    shifts = np.column_stack([reader.getColumnList(label, 0) for label in shiftLabels]).astype(np.float64)
+    angles = np.column_stack([reader.getColumnList(label, 0) for label in angleLabels]).astype(np.float64)
+    return genTransformMatrices(shifts, angles, sRate)
+
+
+def invertMatrices(matrices: List[np.ndarray]) -> List[np.ndarray]:
+    """Inverts all the given matrices at once. If they do not have the same shape, they are inverted one by one."""
+    if len({matrix.shape for matrix in matrices}) == 1:
+        return list(np.linalg.inv(np.array(matrices)))
+    return [np.linalg.inv(matrix) for matrix in matrices]
+
+
+def relionToScipionMatrices(matrices):
+    """Batched version of the conversion done by Coordinate3D.setMatrix(M, convention=TR_RELION). It converts an
+    (N, 4, 4) stack of matrices from Relion's convention to Scipion's one: M = R @ R @ inv(N), being R the rotation
+    part of each matrix N."""
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    R = np.zeros_like(matrices)
+    R[:, :3, :3] = matrices[:, :3, :3]
+    R[:, 3, 3] = 1
+    return R @ R @ np.linalg.inv(matrices)
+
+
+def addLandmarks(landmarkModel: LandmarkModel,
+                 xCoords: List[float],
+                 yCoords: List[float],
+                 tiltIds: List[int],
+                 chainIds: List[int]):
+    """Adds a batch of landmarks to the given landmark model. The file is the same as the one written calling
+    LandmarkModel.addLandmark for each of them (with no residuals), but it is opened only once. The chains of each
+    batch are expected to be new ones (e.g. one chain per particle), so the count of the model is increased by the
+    number of different chains in the batch."""
+    fileName = landmarkModel.getFileName()
+    mode = "a" if exists(fileName) else "w"
+    with open(fileName, mode) as f:
+        writer = csv.writer(f, delimiter='\t')
+        if mode == "w":
+            writer.writerow(LANDMARK_FIELDS)
+        writer.writerows(zip(xCoords, yCoords, tiltIds, chainIds, repeat(0), repeat(0)))
+    landmarkModel.setCount(landmarkModel.getCount() + len(set(chainIds)))
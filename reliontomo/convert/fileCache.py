@@ -0,0 +1,165 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from os.path import join, basename, exists, lexists, isdir, realpath
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FILE_CACHE_VERSION = 1  # Part of all the keys, so the entries generated by a different version are never used
+_TMP_ENTRY_PREFIX = '.tmp'
+HASH_CHUNK_SIZE = 16 * 1024 * 1024  # Size of the chunks read to calculate the hash of a file
+
+
+def getFileStamp(fileName: Optional[str]) -> Optional[Tuple[str, int, int]]:
+    """Returns the tuple (realpath, size, mtime in ns) of the given file, which changes each time the file is
+    modified, or None if it does not exist."""
+    if not fileName or not exists(fileName):
+        return None
+    stat = os.stat(fileName)
+    return realpath(fileName), stat.st_size, stat.st_mtime_ns
+
+
+def getFileHash(fileName: Optional[str]) -> Optional[str]:
+    """Returns the hash of the content of the given file, or None if it does not exist. Unlike getFileStamp, it
+    identifies the same content in different files or after the file is touched, at the cost of reading it."""
+    if not fileName or not exists(fileName):
+        return None
+    fileHash = hashlib.blake2b(digest_size=20)
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def linkOrCopyFile(srcFile: str, dstFile: str):
+    """Hardlinks srcFile to dstFile, replacing it if it exists. If the hardlink cannot be made (e.g. they are in
+    different filesystems), the file is copied."""
+    if lexists(dstFile):
+        os.remove(dstFile)
+    try:
+        os.link(srcFile, dstFile)
+    except OSError:
+        shutil.copyfile(srcFile, dstFile)
+
+
+class ProjectFileCache:
+    """Content-addressed cache of the files generated from the input sets of a protocol, such as the STAR files
+    required by Relion, so the protocols of the same project that convert the same inputs with the same parameters
+    share them instead of generating them again.
+
+    Each entry is a directory of cacheDir named with a key which must be calculated (see getKey) from the stamps
+    of the input files (see getFileStamp) and all the parameters that affect the generated content. Thus, an entry
+    is never updated, and modifying an input set produces a different key. The files are hardlinked (or copied)
+    from and to the entries, so the files generated must be removed before being written again, not truncated, as
+    that would modify the cached ones. When the entries exceed maxBytes, the least recently used are removed."""
+
+    def __init__(self, cacheDir: str, maxBytes: int):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    @staticmethod
+    def getKey(*parts) -> Optional[str]:
+        """Returns the key corresponding to the given parts, which must be JSON serializable, or None if any of
+        them is None, which means that some input file does not exist or its content cannot be identified."""
+        if any(part is None for part in parts):
+            return None
+        content = json.dumps([FILE_CACHE_VERSION, *parts], sort_keys=True, default=str)
+        return hashlib.blake2b(content.encode(), digest_size=20).hexdigest()
+
+    def _getEntryDir(self, key: str) -> str:
+        return join(self.cacheDir, key)
+
+    @staticmethod
+    def _touch(entryDir: str):
+        """Marks the entry as recently used. The current time is set explicitly, as the timestamps set by the
+        filesystem may be too coarse to sort entries stored or used one after another."""
+        now = time.time_ns()
+        os.utime(entryDir, ns=(now, now))
+
+    def fetch(self, key: Optional[str], outFiles: List[str]) -> bool:
+        """Generates the given files from the cache entry corresponding to the key. Returns False if there is
+        not such an entry or some of the files are not in it."""
+        if not key:
+            return False
+        entryDir = self._getEntryDir(key)
+        cachedFiles = [join(entryDir, basename(outFile)) for outFile in outFiles]
+        if not all(exists(cachedFile) for cachedFile in cachedFiles):
+            return False
+        try:
+            for cachedFile, outFile in zip(cachedFiles, outFiles):
+                linkOrCopyFile(cachedFile, outFile)
+            self._touch(entryDir)
+        except OSError as e:
+            # E.g. the entry has been evicted by another protocol meanwhile
+            logger.debug('Unable to get the files %s from the cache: %s' % (outFiles, e))
+            for outFile in outFiles:
+                if lexists(outFile):
+                    os.remove(outFile)
+            return False
+        logger.info('Files %s got from the cache entry %s' % ([basename(f) for f in outFiles], key))
+        return True
+
+    def store(self, key: Optional[str], files: List[str]):
+        """Adds the given files to the cache, in the entry corresponding to the key."""
+        if not key or exists(self._getEntryDir(key)):
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        # The entry is generated in a temporary directory and then renamed, so it is never seen incomplete
+        tmpDir = tempfile.mkdtemp(prefix=_TMP_ENTRY_PREFIX, dir=self.cacheDir)
+        try:
+            for fileName in files:
+                linkOrCopyFile(fileName, join(tmpDir, basename(fileName)))
+            os.rename(tmpDir, self._getEntryDir(key))
+            self._touch(self._getEntryDir(key))
+        except OSError as e:
+            # E.g. the same entry has been stored by another protocol meanwhile
+            logger.debug('Unable to store the files %s in the cache: %s' % (files, e))
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the size of the cache is lower than maxBytes."""
+        entries = []
+        totalBytes = 0
+        for entry in os.scandir(self.cacheDir) if isdir(self.cacheDir) else []:
+            if not entry.is_dir() or entry.name.startswith(_TMP_ENTRY_PREFIX):
+                continue
+            entryBytes = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            entries.append((entry.stat().st_mtime_ns, entryBytes, entry.path))
+            totalBytes += entryBytes
+        for _, entryBytes, entryDir in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalBytes -= entryBytes
+            logger.debug('Cache entry %s evicted' % basename(entryDir))
@@ -0,0 +1,640 @@
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion-users@lists.sourceforge.net'
+# *
+# **************************************************************************
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import shlex
+import sys
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Union, List, Iterator, Optional, Dict, Set, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DATA_PREFIX = 'data_'
+LOOP_LABEL = 'loop_'
+_QUOTES_REGEX = re.compile(r'\'|\"+')
+MAX_INDEXED_FILES = 256  # Max number of files whose block offsets are kept in memory
+_blockOffsetsCache = OrderedDict()  # Realpath --> ((size, mtime), {blockName: offset})
+_blockOffsetsLock = threading.Lock()  # The files may be indexed from several threads
+STAR_CACHE_MAX_BYTES = 1024 ** 3  # Max size of the parsed tables kept in memory by readStarTable
+SIDECAR_VERSION = 3  # Version of the binary sidecar format. Sidecars with a different version are ignored
+SIDECAR_EXT = '.npz'
+_CHECKSUM_CHUNK = 8 * 1024 ** 2
+STAR_VALUES_TOLERANCE = 1e-6  # Max difference between two numeric values of STAR files to consider them equal
+NAME_LABEL_SUFFIX = 'Name'  # Columns like rlnTomoName are kept as strings even if their values are numbers
+
+
+class StarTable:
+    """Columnar version of emtable.Table used by the readers. Each data_ block is parsed into typed NumPy arrays:
+    integer columns are stored as int64, decimal ones as float64 and the rest of them as categorical codes (int64)
+    pointing to a list of categories, so a column with the tomogram name of 2M particles only stores the different
+    tomogram names once.
+
+    The type of each column is inferred from all its values, not only from the first row as emtable does, except
+    for the name columns (labels ending in 'Name', like rlnTomoName), which are always kept as strings, so a
+    tomogram named 101 is not read as a number. The
+    emtable row API (iteration over rows with row.get(label, default), getColumnNames, hasColumn, getColumnValues,
+    size, sort, [index]) is kept, so it can be used wherever an emtable.Table was being read, while the readers
+    can consume whole columns via getColumnArray."""
+
+    def __init__(self, fileName: str = None, tableName: str = None):
+        self.clear()
+        if fileName:
+            self.read(fileName, tableName=tableName)
+
+    @classmethod
+    def fromColumns(cls, columns: 'OrderedDict[str, np.ndarray]', categories: Dict[str, np.ndarray] = None):
+        """Creates a table from its columns, being the values of the categorical ones the codes of the
+        categories."""
+        table = cls()
+        table._columns = OrderedDict(columns)
+        table._categories = dict(categories or {})
+        table._size = len(next(iter(table._columns.values()))) if table._columns else 0
+        table._createRowClass()
+        return table
+
+    def clear(self):
+        self.Row = None
+        self._columns = OrderedDict()  # Label --> NumPy array (values or categorical codes)
+        self._categories = {}  # Label --> NumPy object array with the categories of the string columns
+        self._size = 0
+
+    # --------------------------- READ ------------------------------------------
+    def read(self, fileName: str, tableName: Optional[str] = None):
+        """Reads the table tableName from the star file fileName. If tableName is None, the first data_ block found
+        is read. Otherwise, the block offsets index of the file is used to go straight to the requested block."""
+        with open(fileName) as f:
+            if tableName is not None:
+                offset = getStarBlockOffsets(fileName).get(tableName, None)
+                if offset is None:
+                    raise Exception("'%s' block was not found" % (DATA_PREFIX + tableName))
+                f.seek(offset)
+            self.readStar(f, tableName=tableName)
+
+    def readStar(self, inputFile, tableName: Optional[str] = None):
+        """Parses the table tableName from an already opened file. The file pointer is moved until the end of the
+        requested block."""
+        self.clear()
+        _findDataLine(inputFile, tableName)
+        labels, values = _readBlock(inputFile)
+        self._setColumns(labels, values)
+
+    def _setColumns(self, labels: List[str], values: List[str]):
+        nCols = len(labels)
+        if nCols and len(values) % nCols:
+            raise Exception('The number of values read (%i) is not a multiple of the number of columns (%i)' %
+                            (len(values), nCols))
+        self._size = len(values) // nCols if nCols else 0
+        for i, label in enumerate(labels):
+            colValues = values[i::nCols]
+            array, categories = _parseColumn(colValues, asString=label.endswith(NAME_LABEL_SUFFIX))
+            self._columns[label] = array
+            if categories is not None:
+                self._categories[label] = categories
+        self._createRowClass()
+
+    def _createRowClass(self):
+        class Row(namedtuple('_Row', self._columns.keys())):
+            __slots__ = ()
+
+            def hasColumn(self, colName):
+                """ Return True if the row has this column. """
+                return hasattr(self, colName)
+
+            def get(self, key, default=None):
+                return getattr(self, key, default)
+
+        self.Row = Row
+
+    # --------------------------- COLUMNS ---------------------------------------
+    def getColumnNames(self) -> List[str]:
+        return list(self._columns.keys())
+
+    def hasColumn(self, colName: str) -> bool:
+        return colName in self._columns
+
+    def hasAnyColumn(self, colNames: List[str]) -> bool:
+        return any(self.hasColumn(c) for c in colNames)
+
+    def hasAllColumns(self, colNames: List[str]) -> bool:
+        return all(self.hasColumn(c) for c in colNames)
+
+    def isCategorical(self, colName: str) -> bool:
+        """True if the column colName contains strings, stored as categorical codes."""
+        return colName in self._categories
+
+    def getCodes(self, colName: str) -> np.ndarray:
+        """Categorical codes of a string column. Each code is the index of the value in getCategories(colName)."""
+        return self._columns[colName]
+
+    def getCategories(self, colName: str) -> np.ndarray:
+        """Different values contained in a string column, sorted in ascending order."""
+        return self._categories[colName]
+
+    def getColumnArray(self, colName: str, default=None) -> Optional[np.ndarray]:
+        """Returns the values of the column colName as a NumPy array. String columns are returned as object arrays.
+        If the column does not exist, an array filled with the default value is returned, or None if there is no
+        default value."""
+        if colName in self._columns:
+            values = self._columns[colName]
+            categories = self._categories.get(colName, None)
+            return values if categories is None else categories[values]
+        if default is None:
+            return None
+        if isinstance(default, np.ndarray):
+            return default
+        return np.full(self._size, default, dtype=object if isinstance(default, str) else None)
+
+    def getColumnValues(self, colName: str) -> list:
+        """Same as emtable.Table.getColumnValues: the values of the given column as a list."""
+        if colName not in self._columns:
+            raise Exception("Non-existing column: %s" % colName)
+        return self.getColumnArray(colName).tolist()
+
+    # --------------------------- ROWS ------------------------------------------
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self) -> Iterator:
+        colLists = [self.getColumnArray(label).tolist() for label in self._columns]
+        return map(self.Row._make, zip(*colLists))
+
+    def __getitem__(self, item: int):
+        if item < 0:
+            item += self._size
+        if not 0 <= item < self._size:
+            raise IndexError('Table index out of range')
+        return self.Row._make(self._getValue(label, item) for label in self._columns)
+
+    def _getValue(self, colName: str, index: int):
+        value = self._columns[colName][index]
+        categories = self._categories.get(colName, None)
+        return value.item() if categories is None else categories[value]
+
+    def sort(self, key: str, reverse: bool = False):
+        """Sorts the table rows in place (stable sort) by the values of the column key."""
+        values = self._columns[key]  # The categories are sorted, so the codes keep the order of the strings
+        if reverse:
+            # Descending order keeping the original order of the equal values, as list.sort(reverse=True) does
+            order = self._size - 1 - np.argsort(values[::-1], kind='stable')[::-1]
+        else:
+            order = np.argsort(values, kind='stable')
+        self.take(order, inPlace=True)
+
+    def copy(self) -> 'StarTable':
+        """Shallow copy: the column arrays are shared, but sorting or taking rows from the copy does not affect the
+        original table, as those operations generate new arrays."""
+        table = StarTable()
+        table._columns = OrderedDict(self._columns)
+        table._categories = dict(self._categories)
+        table._size = self._size
+        table.Row = self.Row
+        return table
+
+    def getNBytes(self) -> int:
+        """Approximated memory used by the table, considering the arrays and the strings of the categories."""
+        nBytes = sum(values.nbytes for values in self._columns.values())
+        for categories in self._categories.values():
+            nBytes += categories.nbytes + sum(sys.getsizeof(category) for category in categories)
+        return nBytes
+
+    def setReadOnly(self):
+        """Makes the column arrays read-only, so they can be safely shared."""
+        for values in self._columns.values():
+            values.flags.writeable = False
+        for categories in self._categories.values():
+            categories.flags.writeable = False
+
+    def take(self, indices: Union[np.ndarray, List[int]], inPlace: bool = False) -> 'StarTable':
+        """Returns a new table (or modifies the current one if inPlace) with the rows of the given indices."""
+        indices = np.asarray(indices, dtype=np.int64)
+        table = self if inPlace else StarTable()
+        table._columns = OrderedDict((label, values[indices]) for label, values in self._columns.items())
+        table._categories = dict(self._categories)
+        table._size = len(indices)
+        table.Row = self.Row
+        return table
+
+
+# --------------------------- PARSED TABLES CACHE -------------------------------
+class _StarTableCache:
+    """Process-wide LRU cache of parsed tables, keyed by (realpath, size, mtime, tableName). The entries are
+    evicted, starting with the least recently used one, when the total memory used by the cached tables exceeds
+    STAR_CACHE_MAX_BYTES. It can be used from several threads."""
+
+    def __init__(self):
+        self._tables = OrderedDict()  # Key --> (StarTable, nBytes)
+        self._nBytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[StarTable]:
+        with self._lock:
+            entry = self._tables.get(key, None)
+            if entry is None:
+                return None
+            self._tables.move_to_end(key)
+            return entry[0]
+
+    def add(self, key, table: StarTable):
+        nBytes = table.getNBytes()
+        if nBytes > STAR_CACHE_MAX_BYTES:
+            return
+        with self._lock:
+            # Remove the tables cached for previous versions of the file
+            for oldKey in [k for k in self._tables if k[0] == key[0] and k[3] == key[3]]:
+                self._remove(oldKey)
+            self._tables[key] = (table, nBytes)
+            self._nBytes += nBytes
+            while self._nBytes > STAR_CACHE_MAX_BYTES:
+                self._remove(next(iter(self._tables)))
+
+    def _remove(self, key):
+        _, nBytes = self._tables.pop(key)
+        self._nBytes -= nBytes
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._nBytes = 0
+
+
+_starTableCache = _StarTableCache()
+
+
+def readStarTable(fileName: str, tableName: Optional[str] = None, useSidecar: bool = False,
+                  sidecarDirs: Sequence[str] = ()) -> StarTable:
+    """Returns the table tableName of the given STAR file, parsing it only if it has not been read before by the
+    current process or if the file has changed (different size or modification time). This is the entry point
+    the readers should use, so reading the same file several times in the same run (e.g. in the validation and
+    in the steps of a protocol) only parses it once. The returned table is a shallow copy of the cached one, with
+    read-only columns, so it can be sorted or subset without affecting the cache.
+
+    If useSidecar, the table is loaded from its binary sidecar (see writeStarTableSidecar) when it is up-to-date.
+    If it is not, the sidecar is written after parsing the file only if the file is inside one of sidecarDirs
+    (e.g. the directory of the protocol that generated it), so nothing is written in the directories of other
+    protocols or of the user. It is intended for big tables, like the particles one, that are read again by each
+    downstream protocol."""
+    realPath = os.path.realpath(fileName)
+    stat = os.stat(realPath)
+    if tableName is not None:
+        tableName = str(tableName)  # E.g. a tomogram name read from a column, that may be a number
+    else:
+        # Use the name of the first block, so it shares the cache entry with the reads that request it by name
+        blockNames = list(getStarBlockOffsets(realPath))
+        if not blockNames:
+            raise Exception("No data_ blocks were found in %s" % fileName)
+        tableName = blockNames[0]
+    key = (realPath, stat.st_size, stat.st_mtime_ns, tableName)
+    table = _starTableCache.get(key)
+    if table is None:
+        table = loadStarTableSidecar(realPath, tableName) if useSidecar else None
+        if table is None:
+            table = StarTable(fileName=realPath, tableName=tableName)
+            if useSidecar and isFileInDirs(realPath, sidecarDirs):
+                writeStarTableSidecar(table, realPath, tableName)
+        table.setReadOnly()
+        _starTableCache.add(key, table)
+    return table.copy()
+
+
+def isFileInDirs(fileName: str, dirs: Sequence[str]) -> bool:
+    """Returns True if the given file is inside any of the given directories or their subdirectories."""
+    realPath = os.path.realpath(fileName)
+    for dirName in dirs:
+        realDir = os.path.realpath(dirName)
+        if os.path.commonpath([realPath, realDir]) == realDir:
+            return True
+    return False
+
+
+def clearStarTableCache():
+    _starTableCache.clear()
+
+
+# --------------------------- BINARY SIDECARS -----------------------------------
+def getStarTableSidecarName(starFile: str, tableName: str) -> str:
+    """Name of the binary sidecar of the table tableName of starFile, located next to it (particles.star -->
+    particles.star.particles.npz)."""
+    return '%s.%s%s' % (starFile, tableName, SIDECAR_EXT)
+
+
+def getFileChecksum(fileName: str) -> str:
+    fileHash = hashlib.blake2b(digest_size=16)
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHECKSUM_CHUNK), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def writeStarTableSidecar(table: StarTable, starFile: str, tableName: str) -> Optional[str]:
+    """Writes the columns of a table read from starFile into a binary sidecar, a NumPy .npz file with one array
+    per column plus a schema that contains the sidecar version, the column names and types and the size, the
+    modification time and the checksum of the STAR file. The STAR file is still the reference for Relion, so failing to write the sidecar (e.g. in a read
+    only directory) is not an error. Returns the sidecar file name or None if it could not be written."""
+    realPath = os.path.realpath(starFile)
+    sidecar = getStarTableSidecarName(realPath, tableName)
+    labels = table.getColumnNames()
+    stat = os.stat(realPath)
+    schema = {'version': SIDECAR_VERSION,
+              'tableName': tableName,
+              'size': table.size(),
+              'starSize': stat.st_size,
+              'starMtimeNs': stat.st_mtime_ns,
+              'checksum': getFileChecksum(realPath),
+              'columns': labels,
+              'categorical': [label for label in labels if table.isCategorical(label)]}
+    arrays = {'schema': np.frombuffer(json.dumps(schema).encode(), dtype=np.uint8)}
+    for i, label in enumerate(labels):
+        arrays['col%i' % i] = table._columns[label]
+        if table.isCategorical(label):
+            # STAR values cannot contain line breaks, so the categories are stored as a single utf-8 buffer
+            categories = table.getCategories(label)
+            arrays['cat%i' % i] = np.frombuffer('\n'.join(categories).encode(), dtype=np.uint8)
+            arrays['nCat%i' % i] = np.array(len(categories))
+    tmpFile = None
+    try:
+        # Write it to a temporary file and rename it, so no other process can read an incomplete sidecar
+        fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(realPath), suffix=SIDECAR_EXT)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpFile, sidecar)
+        return sidecar
+    except OSError as e:
+        logger.debug('Unable to write the sidecar %s: %s' % (sidecar, e))
+        if tmpFile and os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        return None
+
+
+def loadStarTableSidecar(starFile: str, tableName: str) -> Optional[StarTable]:
+    """Loads the table tableName of starFile from its binary sidecar. None is returned if the sidecar does not
+    exist, was written with another version of the format or the STAR file has changed since it was written.
+    The size and the modification time of the STAR file are compared first, as fileCache.getFileStamp does, so
+    the file is only read to compare its checksum if its modification time has changed (e.g. it was copied or
+    touched), which may happen without changing its content."""
+    realPath = os.path.realpath(starFile)
+    sidecar = getStarTableSidecarName(realPath, tableName)
+    if not os.path.exists(sidecar):
+        return None
+    try:
+        with np.load(sidecar, allow_pickle=False) as data:
+            schema = json.loads(data['schema'].tobytes().decode())
+            stat = os.stat(realPath)
+            if (schema.get('version') != SIDECAR_VERSION or schema.get('tableName') != tableName or
+                    schema.get('starSize') != stat.st_size):
+                return None
+            if (schema.get('starMtimeNs') != stat.st_mtime_ns and
+                    schema.get('checksum') != getFileChecksum(realPath)):
+                return None
+            categorical = set(schema['categorical'])
+            columns = OrderedDict()
+            categories = {}
+            for i, label in enumerate(schema['columns']):
+                columns[label] = data['col%i' % i]
+                if label in categorical:
+                    nCategories = int(data['nCat%i' % i])
+                    catStr = data['cat%i' % i].tobytes().decode()
+                    categories[label] = np.array(catStr.split('\n') if nCategories else [], dtype=object)
+            return StarTable.fromColumns(columns, categories)
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug('Unable to load the sidecar %s: %s' % (sidecar, e))
+        return None
+
+
+def removeStarTableSidecars(starFile: str):
+    """Removes the sidecars of all the tables of starFile. Used when the STAR file is going to be rewritten."""
+    realPath = os.path.realpath(starFile)
+    dirName = os.path.dirname(realPath)
+    prefix = os.path.basename(realPath) + '.'
+    if os.path.isdir(dirName):
+        for fileName in os.listdir(dirName):
+            if fileName.startswith(prefix) and fileName.endswith(SIDECAR_EXT):
+                os.remove(os.path.join(dirName, fileName))
+
+
+# --------------------------- BLOCKS INDEX --------------------------------------
+def getStarBlockOffsets(fileName: str) -> Dict[str, int]:
+    """Returns a dictionary {blockName: byteOffset} with the position of each data_ line of the given STAR file,
+    so a block can be read by seeking to it instead of parsing the file from the top. The index is built once per
+    file and kept in memory, being rebuilt if the size or the modification time of the file change."""
+    realPath = os.path.realpath(fileName)
+    stat = os.stat(realPath)
+    fileKey = (stat.st_size, stat.st_mtime_ns)
+    with _blockOffsetsLock:
+        cached = _blockOffsetsCache.get(realPath, None)
+        if cached and cached[0] == fileKey:
+            _blockOffsetsCache.move_to_end(realPath)
+            return cached[1]
+    # The file is scanned without holding the lock, so other files can be indexed at the same time
+    offsets = _indexStarBlocks(realPath)
+    with _blockOffsetsLock:
+        _blockOffsetsCache[realPath] = (fileKey, offsets)
+        _blockOffsetsCache.move_to_end(realPath)
+        if len(_blockOffsetsCache) > MAX_INDEXED_FILES:
+            _blockOffsetsCache.popitem(last=False)
+    return offsets
+
+
+def _indexStarBlocks(fileName: str) -> Dict[str, int]:
+    """Scans the file looking for the lines starting with data_. If a block name is repeated, the first one is
+    kept, as it is the one that would be found reading the file from the top."""
+    offsets = {}
+    dataPrefix = DATA_PREFIX.encode()
+    newBlockPrefix = b'\n' + dataPrefix
+    with open(fileName, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return offsets
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0 if mm[:len(dataPrefix)] == dataPrefix else _nextBlockStart(mm, 0, newBlockPrefix)
+            while start != -1:
+                lineEnd = mm.find(b'\n', start)
+                blockName = mm[start:lineEnd if lineEnd != -1 else len(mm)].split()[0][len(dataPrefix):]
+                offsets.setdefault(blockName.decode(), start)
+                start = _nextBlockStart(mm, start, newBlockPrefix)
+    return offsets
+
+
+def _nextBlockStart(mm: mmap.mmap, pos: int, newBlockPrefix: bytes) -> int:
+    pos = mm.find(newBlockPrefix, pos)
+    return pos + 1 if pos != -1 else -1
+
+
+# --------------------------- COMPARISON AND FILTERING --------------------------
+def getStarTableChanges(starFile1: str, starFile2: str, tableName: Optional[str] = None,
+                        tolerance: float = STAR_VALUES_TOLERANCE, sidecarDirs: Sequence[str] = ()) -> List[str]:
+    """Returns the labels of the columns of the table tableName that are not the same in both STAR files: the ones
+    present in only one of them and the ones with different values. The numeric values are considered equal if their
+    difference is not greater than tolerance. If the tables have a different number of rows, all the labels are
+    returned. An empty list means that both tables contain the same data, although the files may be formatted
+    differently. The sidecars of the tables are used as explained in readStarTable."""
+    if os.path.realpath(starFile1) == os.path.realpath(starFile2) or \
+            (os.path.getsize(starFile1) == os.path.getsize(starFile2) and
+             getFileChecksum(starFile1) == getFileChecksum(starFile2)):
+        return []
+    table1 = readStarTable(starFile1, tableName=tableName, useSidecar=True, sidecarDirs=sidecarDirs)
+    table2 = readStarTable(starFile2, tableName=tableName, useSidecar=True, sidecarDirs=sidecarDirs)
+    labels1 = table1.getColumnNames()
+    labels2 = table2.getColumnNames()
+    if table1.size() != table2.size():
+        return labels1 + [label for label in labels2 if label not in labels1]
+    changes = [label for label in labels1 + labels2 if not (table1.hasColumn(label) and table2.hasColumn(label))]
+    for label in labels1:
+        if not table2.hasColumn(label):
+            continue
+        isCategorical = table1.isCategorical(label)
+        if isCategorical != table2.isCategorical(label):
+            changes.append(label)
+        elif isCategorical:
+            if not np.array_equal(table1.getColumnArray(label), table2.getColumnArray(label)):
+                changes.append(label)
+        elif not np.allclose(table1.getColumnArray(label), table2.getColumnArray(label),
+                             rtol=0, atol=tolerance, equal_nan=True):
+            changes.append(label)
+    return changes
+
+
+def filterStarTable(inStarFile: str, outStarFile: str, tableName: str, label: str, values: Set[str]) -> int:
+    """Writes a copy of inStarFile in which the table tableName only keeps the rows whose value of the column label
+    is contained in values. The rest of the file is copied as it is. The file is streamed line by line, so the
+    table is never loaded. Returns the number of rows kept."""
+    removeStarTableSidecars(outStarFile)
+    nRows = 0
+    with open(inStarFile) as fIn, open(outStarFile, 'w') as fOut:
+        inTable = False
+        labels = []
+        colIndex = None
+        for line in fIn:
+            stripped = line.strip()
+            if stripped.startswith(DATA_PREFIX):
+                inTable = stripped[len(DATA_PREFIX):] == tableName
+                labels = []
+                colIndex = None
+            elif inTable and stripped.startswith('_'):
+                labels.append(_split(stripped)[0][1:])
+            elif inTable and stripped and not stripped.startswith(('#', LOOP_LABEL)):
+                if colIndex is None:
+                    if label not in labels:
+                        raise Exception('Column %s not found in the table %s of %s' % (label, tableName, inStarFile))
+                    colIndex = labels.index(label)
+                if _split(stripped)[colIndex] not in values:
+                    continue
+                nRows += 1
+            fOut.write(line)
+    return nRows
+
+
+# --------------------------- PARSING HELPERS -----------------------------------
+def _findDataLine(inputFile, tableName: Optional[str]):
+    """Moves the file pointer after the line data_tableName. If tableName is None, the first data_ block is used.
+    Unlike emtable, the block name must match exactly (data_TS_1 does not match data_TS_10)."""
+    dataStr = DATA_PREFIX + (tableName or '')
+    line = inputFile.readline()
+    while line:
+        if line.startswith(DATA_PREFIX):
+            blockName = line.split()[0]
+            if tableName is None or blockName == dataStr:
+                return line
+        line = inputFile.readline()
+    raise Exception("'%s' block was not found" % dataStr)
+
+
+def _readBlock(inputFile):
+    """Reads the labels and values of the current block, that ends with an empty line, the end of the file or
+    a new data_ line. It returns the list of labels and the flat list of values. Both loop_ and single row
+    (label value) blocks are supported."""
+    isLoop = False
+    line = inputFile.readline()
+    while line:
+        line = line.strip()
+        if line.startswith('_'):
+            break
+        elif line.startswith(LOOP_LABEL):
+            isLoop = True
+        elif line.startswith(DATA_PREFIX):
+            return [], []
+        line = inputFile.readline()
+
+    labels = []
+    values = []
+    while line.startswith('_'):
+        parts = _split(line)
+        labels.append(parts[0][1:])
+        if not isLoop:
+            values.append(parts[1])
+        line = inputFile.readline().strip()
+
+    if isLoop:
+        dataLines = []
+        while line and not line.startswith(DATA_PREFIX):
+            if not line.startswith('#'):
+                dataLines.append(line)
+            line = inputFile.readline().strip()
+        dataStr = '\n'.join(dataLines)
+        if '"' in dataStr or "'" in dataStr:
+            for dataLine in dataLines:
+                values.extend(_split(dataLine))
+        else:
+            values = dataStr.split()
+    return labels, values
+
+
+def _split(line: str) -> List[str]:
+    return shlex.split(line) if _QUOTES_REGEX.search(line) else line.split()
+
+
+def _parseColumn(values: List[str], asString: bool = False):
+    """Converts the list of strings values into a NumPy array. It tries with int64, then float64 and, if none of
+    them is possible or asString is True, the column is considered as a string one and is encoded as categorical.
+    Returns the array and the categories (None for the numeric columns)."""
+    # Avoid the int64 attempt if the first value is not an integer
+    if asString:
+        dtypes = ()
+    elif values and values[0].lstrip('+-').isdigit():
+        dtypes = (np.int64, np.float64)
+    else:
+        dtypes = (np.float64,)
+    for dtype in dtypes:
+        try:
+            return np.array(values, dtype=dtype), None
+        except (ValueError, OverflowError):
+            pass
+    catDict = {}
+    codes = np.fromiter((catDict.setdefault(v, len(catDict)) for v in values), dtype=np.int64, count=len(values))
+    categories = np.array(list(catDict), dtype=object)
+    # Store the categories sorted, so the order of the codes is the same as the order of the strings
+    order = np.argsort(categories, kind='stable')
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return ranks[codes], categories[order]
@@ -22,15 +22,25 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
+import functools
+import json
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
 from enum import Enum
+from itertools import islice, repeat
 from os.path import exists, join, isfile, basename, dirname
 from typing import Union
 
+import numpy as np
 from emtable import Table
 
-from pyworkflow.object import String, Integer, Float, Boolean, Pointer
+from pwem.objects import Matrix
+from pyworkflow.object import String, Integer, Float, Boolean, Pointer, Scalar, Object, Set
 from relion.convert import OpticsGroups
 from reliontomo import Plugin
+from reliontomo.utils import convertStats
 from reliontomo.constants import (OPT_TOMOS_STAR, OPT_PARTICLES_STAR,
                                   OPT_TRAJECTORIES_STAR, OPT_MANIFOLDS_STAR,
                                   OPT_FSC_STAR, OUT_TOMOS_STAR, OUT_PARTICLES_STAR,
@@ -40,6 +50,9 @@ from reliontomo.constants import (OPT_TOMOS_STAR, OPT_PARTICLES_STAR,
 from tomo.constants import SCIPION, TR_SCIPION
 from tomo.objects import SetOfSubTomograms, SubTomogram, SetOfCoordinates3D, TomoAcquisition
 
+MAX_OPTICS_FILES = 256  # Max number of particles files whose optics groups are kept in memory
+INSERT_BATCH_SIZE = 5000  # Number of items inserted at once into the sqlite by appendItemsFromColumns
+
 
 class EnumRe4GenFilesProps(Enum):
     _tomograms = OUT_TOMOS_STAR
@@ -247,6 +260,146 @@ class RelionPSubtomogram(SubTomogram):
     #                         '_re4ParticleName', '_opticsGroupId', '_boxSize')
 
 
+class PackedFields(Scalar):
+    """Fixed number of numeric fields stored as a single column of comma separated values. The string is decoded
+    only when one of the fields is accessed for the first time. The empty fields (None) are stored as nan."""
+
+    def __init__(self, nFields=0, value=None, **kwargs):
+        self._nFields = nFields
+        self._values = None  # Decoded values, as a numpy array
+        self._modified = False  # The decoded values have changed and have to be encoded again
+        super().__init__(value, **kwargs)
+
+    def _convertValue(self, value):
+        return str(value)
+
+    def set(self, value):
+        self._values = None
+        self._modified = False
+        super().set(value)
+
+    def get(self, default=None):
+        self.getObjValue()
+        return super().get(default)
+
+    def hasValue(self):
+        return self._modified or self._objValue is not None
+
+    def getObjValue(self):
+        if self._modified:
+            self._objValue = self.encode(self._values)
+            self._modified = False
+        return self._objValue
+
+    def getValues(self) -> np.ndarray:
+        if self._values is None:
+            if self._objValue:
+                self._values = np.array(self._objValue.split(','), dtype=np.float64)
+            else:
+                self._values = np.full(self._nFields, np.nan)
+        return self._values
+
+    def getField(self, index: int):
+        value = self.getValues()[index]
+        return None if np.isnan(value) else float(value)
+
+    def setField(self, index: int, value):
+        self.getValues()[index] = np.nan if value is None else value
+        self._modified = True
+
+    @staticmethod
+    def encode(values) -> str:
+        return ','.join(map(repr, np.asarray(values, dtype=np.float64).tolist()))
+
+
+class _PackedField:
+    """Replaces the Integer and Float attributes of a RelionPSubtomogramCompact, so the getters and setters of
+    RelionPSubtomogram work on the packed fields."""
+    __slots__ = ('_packedFields', '_index', '_type')
+
+    def __init__(self, packedFields: PackedFields, index: int, fieldType):
+        self._packedFields = packedFields
+        self._index = index
+        self._type = fieldType
+
+    def get(self, default=None):
+        value = self._packedFields.getField(self._index)
+        return default if value is None else self._type(value)
+
+    def set(self, value):
+        self._packedFields.setField(self._index, None if value is None else self._type(value))
+
+    def hasValue(self):
+        return self._packedFields.getField(self._index) is not None
+
+
+def _packedFieldProperty(index, fieldType):
+    def getter(self):
+        return _PackedField(self._relionFields, index, fieldType)
+
+    def setter(self, value):
+        self._relionFields.setField(index, value.get() if isinstance(value, Scalar) else value)
+
+    return property(getter, setter)
+
+
+class RelionPSubtomogramCompact(RelionPSubtomogram):
+    """RelionPSubtomogram whose Relion numeric fields (angles, coordinates, subsets...) are packed in a single
+    attribute instead of one Integer or Float each. Hence, the sqlite of its set has one column for all of them
+    and they are only decoded if any of them is accessed. The getters and setters are the same as in
+    RelionPSubtomogram, but the packed fields can not be used to query the sqlite (e.g. in where clauses)."""
+    PACKED_ATTRIBUTE = '_relionFields'
+    PACKED_FIELDS = [('_rdnSubset', int),
+                     ('_opticsGroupId', int),
+                     ('_manifoldIndex', int),
+                     ('_logLikeliContribution', float),
+                     ('_maxValueProbDistribution', float),
+                     ('_nrOfSignificantSamples', int),
+                     ('_groupId', int),
+                     ('_normCorrection', float),
+                     ('_x', float),
+                     ('_y', float),
+                     ('_z', float),
+                     ('_xInImg', float),
+                     ('_yInImg', float),
+                     ('_zInImg', float),
+                     ('_rot', float),
+                     ('_tilt', float),
+                     ('_psi', float),
+                     ('_tiltPrior', float),
+                     ('_psiPrior', float),
+                     ('_coordX', float),
+                     ('_coordY', float),
+                     ('_coordZ', float)]
+
+    def __init__(self, **kwargs):
+        # It has to exist before the attributes are assigned in RelionPSubtomogram
+        self._relionFields = PackedFields(nFields=len(self.PACKED_FIELDS))
+        super().__init__(**kwargs)
+
+    def packColumns(self, columns: dict, size: int) -> dict:
+        """Replaces the values of the packed fields contained in columns ({attribute: values}, as in
+        RelionSetOfPseudoSubtomograms.appendFromColumns) by the values of the packed attribute. The fields not
+        contained in columns take the value they have in this particle."""
+        columns = dict(columns)
+        currentValues = self._relionFields.getValues()
+        packedColumns = []
+        for index, (name, _) in enumerate(self.PACKED_FIELDS):
+            values = columns.pop(name, None)
+            if values is None:
+                packedColumns.append(np.full(size, currentValues[index]))
+            else:
+                packedColumns.append(np.array([np.nan if value is None else value for value in values[:size]],
+                                              dtype=np.float64))
+        columns[self.PACKED_ATTRIBUTE] = [PackedFields.encode(row) for row in np.column_stack(packedColumns)]
+        return columns
+
+
+for _index, (_name, _fieldType) in enumerate(RelionPSubtomogramCompact.PACKED_FIELDS):
+    setattr(RelionPSubtomogramCompact, _name, _packedFieldProperty(_index, _fieldType))
+del _index, _name, _fieldType
+
+
 class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
     """ Set to persist relion's metadata files and particles.
     Approach: heep always the generated optimization_set.star file. Additionally,
@@ -262,7 +415,10 @@ class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
     ARE_2D_PARTICLES = '_areRe5Particles'
 
     def __init__(self, optimSetStar=None, relionBinning=None, tsSamplingRate=None, boxSize=24,
-                 nReParticles=0, are2dStacks=None, areRe5Particles=None, **kwargs):
+                 nReParticles=0, are2dStacks=None, areRe5Particles=None, compact=False, lazy=False, **kwargs):
+        # Flag to read the particles from the particles star file instead of from the sqlite (see setLazy). It has
+        # to exist before the set is loaded by Set.__init__
+        self._lazy = Boolean(lazy)
         super().__init__(**kwargs)
         self._filesMaster = String()  # Optimisation set file path
         self._boxSize = Integer(boxSize)
@@ -276,6 +432,7 @@ class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
         self._nReParticles = Integer(nReParticles)  # Number of relion particles in the particles star file
         self._are2dStacks = Boolean(are2dStacks)  # Fag to identify if the particles are 2D or 3D
         self._areRe5Particles = Boolean(areRe5Particles)
+        self._compact = Boolean(compact)  # Flag to store the particles as RelionPSubtomogramCompact
 
         if optimSetStar:
             self.filesMaster = optimSetStar
@@ -322,9 +479,8 @@ class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
         self._referenceFsc.set(fscPath)
 
         # Read the optimisation set and fill the corresponding attribute
-        opticsGroups = OpticsGroups(Table(fileName=self._particles.get(), tableName=OPTICS_TABLE))
         acquisition = self.getAcquisition()
-        acquisition.opticsGroupInfo = String(opticsGroups.toString())
+        acquisition.opticsGroupInfo = String(readOpticsGroupsStr(self._particles.get()))
         self.setAcquisition(acquisition)
 
     def updateGenFiles(self, extraPath):
@@ -372,6 +528,134 @@ class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
     def areRe5Particles(self):
         return self._areRe5Particles.get()
 
+    def isCompact(self):
+        return self._compact.get()
+
+    def getItemType(self):
+        """Class of the particles to be added to the set, depending on if it is compact or not."""
+        return RelionPSubtomogramCompact if self.isCompact() else RelionPSubtomogram
+
+    def setCompact(self, val):
+        self._compact.set(val)
+
+    def isLazy(self):
+        return self._lazy.get()
+
+    def setLazy(self, val):
+        """In a lazy set, the particles are not written to the sqlite. They are read from the particles star file,
+        or from its binary sidecar, each time the set is iterated. The sqlite is only filled (see materialize) when
+        the set is accessed in a way that requires it, like getting a particle by its id or iterating it with a
+        where clause or a different order."""
+        self._lazy.set(val)
+
+    def load(self):
+        size = self._size.get()
+        super().load()
+        if self.isLazy():
+            if self._size.get() > 0:
+                # Materialized by a previous access
+                self.setLazy(False)
+            else:
+                self._size.set(size)
+
+    def materialize(self):
+        """Writes the particles of a lazy set into its sqlite, so it can be accessed as any other set. The sqlite is
+        generated in a temporary file and then renamed, so the processes reading the set never find it half
+        written."""
+        if not self.isLazy():
+            return
+        fileName = self.getFileName()
+        fd, tmpFile = tempfile.mkstemp(dir=dirname(os.path.abspath(fileName)), suffix='.sqlite')
+        os.close(fd)
+        try:
+            tmpSet = RelionSetOfPseudoSubtomograms(filename=tmpFile)
+            tmpSet.copyInfo(self)
+            firstItem, columns, size, objIds = self._readColumns()
+            tmpSet.appendFromColumns(firstItem, columns, size, objIds=objIds)
+            tmpSet.write()
+            tmpSet.close()
+            self.close()
+            os.replace(tmpFile, fileName)
+        finally:
+            if exists(tmpFile):
+                os.remove(tmpFile)
+        self.setLazy(False)
+        self.load()
+
+    def cloneItems(self, other: 'RelionSetOfPseudoSubtomograms'):
+        """Replaces the particles of this set by the ones of other, copying its sqlite file instead of reading and
+        inserting them one by one. Only the items are copied, not the attributes of the set."""
+        other.materialize()
+        self.close()
+        with closing(sqlite3.connect(other.getFileName())) as src, closing(sqlite3.connect(self.getFileName())) as dst:
+            src.backup(dst)
+        self.setLazy(False)
+        self.load()
+
+    def _readColumns(self):
+        # Imported here to avoid a circular import, as the converters import this module
+        from reliontomo.convert import createReaderTomo
+        reader, _ = createReaderTomo(self.getParticlesStar(), isRelion5=self.areRe5Particles(), useSidecar=True)
+        return reader.getPseudoSubtomogramsColumns(self)
+
+    def _iterStarItems(self, limit=None):
+        """Generates the particles of a lazy set from the particles star file. As the sqlite mapper does, the same
+        object is updated and returned for each particle, so it has to be cloned to be kept."""
+        item, columns, size, objIds = self._readColumns()
+        if size == 0:
+            return
+        attributes = []
+        for key, values in columns.items():
+            attr = item
+            for attrName in key.split('.'):
+                attr = getattr(attr, attrName)
+            attributes.append((attr.setMatrix if isinstance(attr, Matrix) else attr.set, values))
+        if objIds is None:
+            objIds = range(1, size + 1)
+        if not item.hasAcquisition():
+            item.setAcquisition(self.getAcquisition())
+        for index in range(size if limit is None else min(limit, size)):
+            for setValue, values in attributes:
+                setValue(values[index])
+            item.setObjId(int(objIds[index]))
+            yield item
+
+    def iterItems(self, orderBy='id', direction='ASC', where='1', limit=None, iterate=True, rowFilter=None):
+        if self.isLazy():
+            if (orderBy == 'id' and direction == 'ASC' and where in (None, '1') and rowFilter is None and
+                    (limit is None or isinstance(limit, int))):
+                items = self._iterStarItems(limit=limit)
+                # As the mapper does, a list of different objects is returned if not iterating
+                return items if iterate else [item.clone() for item in items]
+            self.materialize()
+        return super().iterItems(orderBy=orderBy, direction=direction, where=where, limit=limit, iterate=iterate,
+                                 rowFilter=rowFilter)
+
+    def getFirstItem(self):
+        if self.isLazy():
+            return next(self._iterStarItems(limit=1), None)
+        return super().getFirstItem()
+
+    def __getitem__(self, itemId):
+        self.materialize()
+        return super().__getitem__(itemId)
+
+    def __contains__(self, itemId):
+        self.materialize()
+        return super().__contains__(itemId)
+
+    def aggregate(self, operations, operationLabel, groupByLabels=None):
+        self.materialize()
+        return super().aggregate(operations, operationLabel, groupByLabels=groupByLabels)
+
+    def getUniqueValues(self, attributes, where=None):
+        self.materialize()
+        return super().getUniqueValues(attributes, where=where)
+
+    def enableAppend(self):
+        self.materialize()
+        super().enableAppend()
+
     def setAre2dStacks(self, val):
         return self._are2dStacks.set(val)
 
@@ -402,7 +686,7 @@ class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
     def copyInfo(self, other):
         self.copyAttributes(other, '_filesMaster', '_tomograms', '_particles', '_trajectories', '_manifolds',
                             '_referenceFsc', '_relionBinning', '_tsSamplingRate', '_samplingRate', '_boxSize',
-                            '_nReParticles', '_coordsPointer', '_are2dStacks', '_areRe5Particles')
+                            '_nReParticles', '_coordsPointer', '_are2dStacks', '_areRe5Particles', '_compact')
         self._acquisition.copyInfo(other.getAcquisition())
         # self._relionMd = relionMd if relionMd else relionTomoMetadata
 
@@ -413,6 +697,103 @@ class RelionSetOfPseudoSubtomograms(SetOfSubTomograms):
         """ Returns al the Tilt series ids involved in the set."""
         return self.getUniqueValues(RelionPSubtomogram.TS_ID_ATTRIBUTE)
 
+    def appendFromColumns(self, firstItem: RelionPSubtomogram, columns: dict, size: int, objIds=None,
+                          batchSize: int = INSERT_BATCH_SIZE):
+        """Bulk version of append, to add size particles to the set without creating an object for each of them
+        (see appendItemsFromColumns).
+
+        :param firstItem: RelionPSubtomogram corresponding to the first particle.
+        :param columns: dictionary of type {attribute: values}, where attribute is the name of the column in the
+        sqlite (e.g. '_volName' or '_coordinate._x') and values contains its value for each particle, including the
+        first one. The attributes not contained in it take the value they have in firstItem.
+        :param size: number of particles.
+        :param objIds: the ids of the particles. If not provided, consecutive ids are assigned, as done in append.
+        :param batchSize: number of rows inserted at once.
+
+        In lazy sets, nothing is inserted, as the particles are read again from the particles star file when
+        the set is iterated.
+        """
+        if self.isLazy():
+            self._size.set(size)
+            return
+        if size > 1 and isinstance(firstItem, RelionPSubtomogramCompact):
+            columns = firstItem.packColumns(columns, size)
+        appendItemsFromColumns(self, firstItem, columns, size, objIds=objIds, batchSize=batchSize)
+
+
+@convertStats.timed('objects.appendItemsFromColumns')
+def appendItemsFromColumns(outSet: Set, firstItem: Object, columns: dict, size: int, objIds=None,
+                           batchSize: int = INSERT_BATCH_SIZE):
+    """Bulk version of Set.append, to add size items to a set without creating an object for each of them. The
+    first one, firstItem, is appended as usual, so it creates the tables of the set if needed. The rest of them are
+    inserted directly into the sqlite, in batches of batchSize rows inside the same transaction, which is committed
+    when the set is written.
+
+    :param outSet: set in which the items will be inserted.
+    :param firstItem: object corresponding to the first item. It must have all the attributes present in columns,
+    including the extended ones.
+    :param columns: dictionary of type {attribute: values}, where attribute is the name of the column in the
+    sqlite (e.g. '_x' or '_eulerMatrix._matrix') and values contains its value for each item, including the
+    first one. The attributes not contained in it take the value they have in firstItem.
+    :param size: number of items.
+    :param objIds: the ids of the items. If not provided, consecutive ids are assigned, as done in append.
+    :param batchSize: number of rows inserted at once.
+    """
+    if size < 1:
+        return
+    outSet.append(firstItem)
+    if size == 1:
+        return
+    classNames = {key: value[0] for key, value in firstItem.getObjDict(includeClass=True).items()}
+    notFound = [key for key in columns if key not in classNames]
+    if notFound:
+        raise Exception('Attributes %s not found in %s' % (notFound, firstItem.getClassName()))
+    # The rows are inserted with the command used by the mapper to insert the items, whose values are in the order
+    # of the columns of the sqlite. Hence, it has to be the order of the attributes of firstItem
+    db = outSet._getMapper().db
+    layout = sorted((row['column_name'], row['label_property'], row['class_name']) for row in db.getClassRows())
+    expectedLayout = sorted(('c%02d' % ind, key, className)
+                            for ind, (key, className) in enumerate(classNames.items()))
+    if layout != expectedLayout:
+        raise Exception('The attributes of %s do not match the columns of %s' %
+                        (firstItem.getClassName(), outSet.getFileName()))
+
+    # Values of the attributes of each row, in the order of the columns in the sqlite
+    rowValues = []
+    for key, value in firstItem.getObjDict().items():
+        if key in columns:
+            rowValues.append(_convertColumn(classNames[key], columns[key][1:size]))
+        else:
+            rowValues.append(repeat(value))
+    if objIds is None:
+        objIds = range(outSet._idCount + 1, outSet._idCount + size)
+    else:
+        objIds = [int(objId) for objId in objIds[1:size]]
+    rows = zip(objIds, repeat(firstItem.isEnabled()), repeat(firstItem.getObjLabel()),
+               repeat(firstItem.getObjComment()), *rowValues)
+
+    batch = list(islice(rows, batchSize))
+    while batch:
+        db.cursor.executemany(db.INSERT_OBJECT, batch)
+        batch = list(islice(rows, batchSize))
+    convertStats.count('objects.appendItemsFromColumns', size)
+    outSet._idCount = max(outSet._idCount, max(objIds))
+    outSet._size.set(outSet._size.get() + size - 1)
+
+
+def _convertColumn(className: str, values):
+    """Converts the values of a column into what the corresponding Scipion object would store in the sqlite."""
+    if className == 'Matrix':
+        matrices = np.asarray(values)
+        if matrices.ndim == 3 and matrices.dtype.kind == 'f' and np.isfinite(matrices).all():
+            # Same text as json.dumps, but formatting each matrix at once, which is much faster
+            nRows, nCols = matrices.shape[1:]
+            template = '[[%s]]' % '], ['.join([', '.join(['%r'] * nCols)] * nRows)
+            return [template % tuple(matrix) for matrix in matrices.reshape(len(matrices), -1).tolist()]
+        return [json.dumps(np.asarray(value).tolist()) for value in values]
+    convert = {'Integer': int, 'Float': float, 'String': str, 'Boolean': bool, 'PackedFields': str}[className]
+    return [None if value is None else convert(value) for value in values]
+
 
 def createSetOfRelionPSubtomograms(protocolPath: str,
                                    optimSetStar: str,
@@ -423,7 +804,8 @@ def createSetOfRelionPSubtomograms(protocolPath: str,
                                    boxSize: int = 24,
                                    nReParticles: int = 0,
                                    are2dStacks: bool = False,
-                                   acquisition: Union[TomoAcquisition, None] = None) -> RelionSetOfPseudoSubtomograms:
+                                   acquisition: Union[TomoAcquisition, None] = None,
+                                   compact: bool = False) -> RelionSetOfPseudoSubtomograms:
     """ Creates the RelionSetOfSubtomograms from the input arguments
 
     :param protocolPath: Path of the protocol where to create the sqlite
@@ -438,6 +820,8 @@ def createSetOfRelionPSubtomograms(protocolPath: str,
     :param acquisition: TomoAcquisition. The recommended is the one from the tilt-series, as it may contain more data
     if they were imported compared to imported tomograms. If not provided, the coordinates pointer will be used to
     access to the precedent tomograms and clone their acquisition.
+    :param compact: Boolean used to indicate if the Relion numeric fields of the particles are packed in a single
+    attribute (see RelionPSubtomogramCompact).
 
     """
     psubtomoSet = RelionSetOfPseudoSubtomograms.create(protocolPath, template=template)
@@ -449,6 +833,7 @@ def createSetOfRelionPSubtomograms(protocolPath: str,
     psubtomoSet.setCoordinates3D(coordsPointer)
     psubtomoSet.setAre2dStacks(are2dStacks)
     psubtomoSet.setAreRe5Particles(True if Plugin.isRe50() else False)
+    psubtomoSet.setCompact(compact)
 
     # Manage the acquisition
     if not acquisition:
@@ -572,5 +957,25 @@ class StarFileComparer:
         return labelsList
 
 
+def readOpticsGroupsStr(particlesStar: str) -> str:
+    """Reads the optics table of a particles star file and returns it as a string in STAR format. The file is
+    read from the top and the parsing stops once the data_optics block is consumed, so the particles table is never
+    parsed. The result is memoised per file, being read again only if the size or the modification time of the
+    file change, as the same particles file is read each time a set of pseudosubtomograms is created from it."""
+    realPath = os.path.realpath(particlesStar)
+    stat = os.stat(realPath)
+    return _readOpticsGroupsStr(realPath, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=MAX_OPTICS_FILES)
+def _readOpticsGroupsStr(realPath: str, size: int, mtimeNs: int) -> str:
+    """Cached by the stamp of the file (realpath, size, mtime in ns), so the entries of the previous versions of a
+    modified file are not used again and are evicted as the least recently used ones."""
+    opticsTable = Table()
+    with open(realPath) as f:
+        opticsTable.readStar(f, tableName=OPTICS_TABLE)
+    return OpticsGroups(opticsTable).toString()
+
+
 def list2str(inList):
     return ' '.join([str(label) for label in inList])
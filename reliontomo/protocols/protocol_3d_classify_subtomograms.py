@@ -32,6 +32,7 @@ from pyworkflow.protocol import Form
 from pyworkflow.object import Float
 from pyworkflow.utils import moveFile, createLink
 from reliontomo.constants import OUT_PARTICLES_STAR, TOMO_PARTICLE_ID, OPTICS_TABLE, PARTICLES_TABLE
+from reliontomo.convert.starTable import readStarTable
 from reliontomo.objects import RelionSetOfPseudoSubtomograms
 from reliontomo.protocols import ProtRelionRefineSubtomograms
 from reliontomo.protocols.protocol_base_refine import ProtRelionRefineBase
@@ -270,12 +271,13 @@ class ProtRelion3DClassifySubtomograms(ProtRelionRefineSubtomograms):
         with open(modelStar) as fid:
             self.modelTable.readStar(fid, tableName='model_general')
             self.classesTable.readStar(fid, tableName='model_classes')
+        # The data star file is usually the particles file read to generate the output set, so it is already cached
         dataStar = self._getIterGenFileName('data', iteration)
-        with open(dataStar) as fid:
-            self.opticsTable.readStar(fid, tableName=OPTICS_TABLE)
-            self.particlesTable.readStar(fid, tableName=PARTICLES_TABLE)
-            if not IS_RELION_50:
-                self.particlesTable.sort(TOMO_PARTICLE_ID)
+        self.opticsTable = readStarTable(dataStar, tableName=OPTICS_TABLE)
+        self.particlesTable = readStarTable(dataStar, tableName=PARTICLES_TABLE, useSidecar=True,
+                                            sidecarDirs=self.getSidecarDirs())
+        if not IS_RELION_50:
+            self.particlesTable.sort(TOMO_PARTICLE_ID)
 
         # Model table has only one row, while classes table has the same number of rows as classes found
         self.nClasses = int(self.modelTable._rows[0].rlnNrClasses)  # self.numberOfClasses.get()
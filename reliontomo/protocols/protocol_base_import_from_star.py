@@ -25,7 +25,6 @@
 import logging
 from enum import Enum
 from os.path import exists
-from emtable import Table
 from pwem.protocols import EMProtocol
 from pyworkflow.object import Boolean
 from pyworkflow.protocol import FileParam, FloatParam, IntParam, PointerParam
@@ -33,7 +32,9 @@ from pyworkflow.utils import Message, getParentFolder, createLink, makePath
 from reliontomo import Plugin
 from reliontomo.constants import TOMO_NAME, IN_PARTICLES_STAR, PIXEL_SIZE, TOMO_PARTICLE_ID
 from reliontomo.convert import createReaderTomo
-from reliontomo.protocols.protocol_base_relion import IS_RELION_50
+from reliontomo.convert.convert50_tomo import StarTableGroups
+from reliontomo.convert.starTable import readStarTable
+from reliontomo.protocols.protocol_base_relion import IS_RELION_50, ProtRelionConvertStats
 from tomo.protocols.protocol_base import ProtTomoBase
 from tomo.objects import SetOfCoordinates3D
 
@@ -45,7 +46,7 @@ class importCoordsOutputs(Enum):
     coordinates = SetOfCoordinates3D
 
 
-class ProtBaseImportFromStar(EMProtocol, ProtTomoBase):
+class ProtBaseImportFromStar(ProtRelionConvertStats, EMProtocol, ProtTomoBase):
     """Base protocol for importing data from a star file"""
 
     def __init__(self, **kwargs):
@@ -158,8 +159,7 @@ class ProtBaseImportFromStar(EMProtocol, ProtTomoBase):
 
     # --------------------------- UTILS functions ------------------------------
     def checkIfRe5PickedCoords(self) -> bool:
-        dataTable = Table()
-        dataTable.read(self.starFile.get())
+        dataTable = readStarTable(self.starFile.get())
         presentColumns = dataTable.getColumnNames()
         # The column psSegImage is present in PySeg star files (picked coordinates that follow Relion 3 format)
         # The column rlnTomoParticleId is present in Relion 4 data model, but not in Relion 5
@@ -194,7 +194,7 @@ class ProtBaseImportFromStar(EMProtocol, ProtTomoBase):
     def _checkIfTsIdErrorsInStar(self, reader, errorMsg: list):
         tsIds = [tomo.getTsId() for tomo in self.inTomos.get()]
         if tsIds:
-            coordTomoIds = list(set([row.get(TOMO_NAME) for row in reader.dataTable]))
+            coordTomoIds = list(StarTableGroups(reader.dataTable, TOMO_NAME))
             matchingCoorTomoIds = [coordTomoId for coordTomoId in coordTomoIds if coordTomoId in tsIds]
             if len(set(coordTomoIds) & set(matchingCoorTomoIds)) == 0:
                 errorMsg.append(f'No matching TsIds were found between the\n'
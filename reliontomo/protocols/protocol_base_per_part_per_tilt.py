@@ -146,7 +146,8 @@ class ProtRelionPerParticlePerTiltBase(ProtRelionTomoBase):
                 tomoTable.writeStar(f, tableName=GLOBAL_TABLE)
 
         # Register outputs and define relations
-        pSubtomos = self.genRelionParticles()  # Output RelionParticles
+        # The particles are only read again if Relion has modified them
+        pSubtomos = self.genRelionParticles(reuseInputItems=True)  # Output RelionParticles
         self._defineOutputs(**{outputObjects.relionParticles.name: pSubtomos})
         self._defineSourceRelation(self.getInputParticles(), pSubtomos)
 
@@ -23,7 +23,7 @@
 # *
 # **************************************************************************
 from os.path import exists, join
-from typing import Union
+from typing import Union, Optional, List
 
 from emtable import Table
 
@@ -32,18 +32,34 @@ from pwem.protocols import EMProtocol
 from pyworkflow import BETA, PROD
 from pyworkflow.object import Pointer
 from pyworkflow.protocol import PointerParam, StringParam, IntParam
-from pyworkflow.utils import Message, createLink
+from pyworkflow.utils import Message, createLink, cleanPath
 from reliontomo import Plugin
 from reliontomo.constants import IN_PARTICLES_STAR, POSTPROCESS_DIR, OPTIMISATION_SET_STAR, PSUBTOMOS_SQLITE, \
-    OUT_PARTICLES_STAR, OUT_TOMOS_STAR, TRAJECTORIES_STAR
-from reliontomo.convert import writeSetOfPseudoSubtomograms, readSetOfPseudoSubtomograms, convert50_tomo
+    OUT_PARTICLES_STAR, OUT_TOMOS_STAR, TRAJECTORIES_STAR, PARTICLES_TABLE, STAR_CACHE_DIR, GAIN_CACHE_DIR
+from reliontomo.convert import writeSetOfPseudoSubtomograms, readSetOfPseudoSubtomograms, convert50_tomo, \
+    reuseParticlesStar
+from reliontomo.convert.fileCache import ProjectFileCache
+from reliontomo.convert.starTable import getStarTableChanges
 from reliontomo.objects import RelionSetOfPseudoSubtomograms
+from reliontomo.utils import convertStats
 from tomo.objects import SetOfCoordinates3D
 
 IS_RELION_50 = Plugin.isRe50()
 
 
-class ProtRelionTomoBase(EMProtocol):
+class ProtRelionConvertStats:
+    """Mixin for the protocols that convert data from or to Relion. At the end of each step, it reports the stats
+    of the conversions done since the previous report (see reliontomo.utils.ConvertStats). The stats are kept per
+    process, not per step, so if the steps run in parallel the report of a step also includes the conversions of
+    the steps running at the same time. It must precede EMProtocol in the bases of the protocol."""
+
+    def _stepFinished(self, step):
+        for line in convertStats.popReport():
+            self.info('Conversion stats: %s' % line)
+        return super()._stepFinished(step)
+
+
+class ProtRelionTomoBase(ProtRelionConvertStats, EMProtocol):
     _devStatus = BETA if IS_RELION_50 else PROD
 
     def __init__(self, **kwargs):
@@ -99,29 +115,50 @@ class ProtRelionTomoBase(EMProtocol):
     def getOutStarFileName(self):
         return self._getExtraPath(IN_PARTICLES_STAR)
 
+    def getStarFileCache(self) -> Optional[ProjectFileCache]:
+        """Returns the cache of the STAR files generated from the input sets, shared by the protocols of the project,
+        or None if it is disabled."""
+        return self._getProjectFileCache(STAR_CACHE_DIR, Plugin.getStarCacheMaxBytes())
+
+    def getGainFileCache(self) -> Optional[ProjectFileCache]:
+        """Returns the cache of the gain references converted to MRC, shared by the protocols of the project, or
+        None if it is disabled."""
+        return self._getProjectFileCache(GAIN_CACHE_DIR, Plugin.getGainCacheMaxBytes())
+
+    def getSidecarDirs(self) -> List[str]:
+        """Directories in which the binary sidecars of the STAR tables read by the protocol can be written: its
+        own directory and the STAR files cache of the project."""
+        sidecarDirs = [self._getPath()]
+        project = self.getProject()
+        if project is not None:
+            sidecarDirs.append(project.getTmpPath(STAR_CACHE_DIR))
+        return sidecarDirs
+
+    def _getProjectFileCache(self, cacheDir: str, maxBytes: int) -> Optional[ProjectFileCache]:
+        project = self.getProject()
+        if maxBytes <= 0 or project is None:
+            return None
+        return ProjectFileCache(project.getTmpPath(cacheDir), maxBytes)
+
     def genInStarFile(self, withPriors=False, are2dParticles=False):
         """It will check if the set size and the stored particles star file are of the same size or not. In
         the first case, a link will be made to the previous particles star file to avoid generating it and in the
-        second case, a new file will be generated containing only the ones present in the input set.
+        second case, a new file will be generated containing only the ones present in the input set, filtering the
+        previous particles star file if possible.
         :param withPriors: Applies only if using Relion 4. Consider the prior angles.
         :param are2dParticles: Applies only if using Relion 5. Used to choose the fields that will be present in
         the generated particles.star file, as they are not the same depending on if the particles are 2D or 3D.
         """
         inReParticlesSet = self.getInputParticles()
         outStarFileName = self.getOutStarFileName()
-        # if IS_RELION_50:
-        #     withPriors = False
-        # if inReParticlesSet.getSize() == inReParticlesSet.getNReParticles() and not withPriors:
-        #     if inReParticlesSet.getSize() == inReParticlesSet.getNReParticles():
-        #         self.info("Using existing star (%s) file instead of generating a new one." %
-        #                   inReParticlesSet.getParticlesStar())
-        #         createLink(inReParticlesSet.getParticlesStar(), outStarFileName)
-        # else:
-        #     self.info("Less particles detected in the input set respecting to it associated star file. Assuming "
-        #               "that a subset was made. Writing the new particles file.")
+        # Remove the file or the link generated by a previous execution
+        cleanPath(outStarFileName)
+        if not withPriors and reuseParticlesStar(inReParticlesSet, outStarFileName, are2dParticles=are2dParticles,
+                                                 sidecarDirs=self.getSidecarDirs()):
+            return
         if IS_RELION_50:
             outPath = self._getExtraPath()
-            writer = convert50_tomo.Writer()
+            writer = convert50_tomo.Writer(fileCache=self.getStarFileCache())
             writer.pseudoSubtomograms2Star(inReParticlesSet, outPath, are2dParticles=are2dParticles)
         else:
             writeSetOfPseudoSubtomograms(inReParticlesSet, outStarFileName, withPriors=withPriors)
@@ -146,11 +183,24 @@ class ProtRelionTomoBase(EMProtocol):
                            tomograms=OUT_TOMOS_STAR,
                            trajectories=TRAJECTORIES_STAR,
                            binningFactor=None,
-                           boxSize=24):
+                           boxSize=24,
+                           lazy=None,
+                           compact=None,
+                           reuseInputItems=False):
         """Generate a RelionSetOfPseudoSubtomograms object containing the files involved for the next protocol,
         considering that some protocols don't generate the optimisation_set.star file. In that case, the input Object
         which represents it will be copied and, after that, this method will be used to update the corresponding
-        attribute."""
+        attribute.
+
+        If lazy (by default, the value of the plugin variable RELIONTOMO_LAZY_PARTICLES), the particles are not
+        copied into the sqlite of the set, but read from the generated particles star file when needed.
+
+        If compact (by default, the value of the plugin variable RELIONTOMO_COMPACT_PARTICLES), the particles are
+        stored as RelionPSubtomogramCompact items, with their Relion fields packed into a single column.
+
+        If reuseInputItems and the particles table of the generated particles star file contains the same data as
+        the one of the input particles, the sqlite of the input set is copied instead of reading the particles
+        again. It is intended for the protocols that do not modify the particles, like the CTF refinement."""
 
         # Create the set
         inParticlesSet = self.getInputParticles()
@@ -182,10 +232,36 @@ class ProtRelionTomoBase(EMProtocol):
 
         # Fill the items (pseudo subtomos/particles) from de particles star file
         psubtomoSet.setSamplingRate(psubtomoSet.getCurrentSamplingRate())
-        readSetOfPseudoSubtomograms(psubtomoSet, isRelion5=IS_RELION_50)
+        if reuseInputItems and self._areInputItemsReusable(psubtomoSet):
+            self.info('The particles were not modified. Copying them from the input set.')
+            psubtomoSet.cloneItems(inParticlesSet)
+            psubtomoSet.write()
+        else:
+            psubtomoSet.setLazy(Plugin.useLazyParticles() if lazy is None else lazy)
+            psubtomoSet.setCompact(Plugin.useCompactParticles() if compact is None else compact)
+            readSetOfPseudoSubtomograms(psubtomoSet, isRelion5=IS_RELION_50, sidecarDirs=self.getSidecarDirs())
 
         return psubtomoSet
 
+    def _areInputItemsReusable(self, psubtomoSet: RelionSetOfPseudoSubtomograms) -> bool:
+        """The particles of the input set can be copied to the output set if they are stored in its sqlite, the input
+        set contains all the particles of its particles star file, the sampling rate is the same and the particles
+        table generated by the protocol contains the same data as the input one."""
+        inParticlesSet = self.getInputParticles()
+        inParticlesStar = inParticlesSet.getParticlesStar()
+        outParticlesStar = psubtomoSet.getParticlesStar()
+        if (inParticlesSet.isLazy() or inParticlesSet.getPrefix() or
+                inParticlesSet.getSize() != inParticlesSet.getNReParticles() or
+                abs(inParticlesSet.getSamplingRate() - psubtomoSet.getSamplingRate()) > 1e-6 or
+                not inParticlesStar or not outParticlesStar or not exists(outParticlesStar)):
+            return False
+        changes = getStarTableChanges(inParticlesStar, outParticlesStar, tableName=PARTICLES_TABLE,
+                                      sidecarDirs=self.getSidecarDirs())
+        if changes:
+            self.info('Changes detected in the particles (%s). Reading them from %s.' %
+                      (', '.join(changes), outParticlesStar))
+        return not changes
+
     def genFSCs(self, starFile, tableName, fscColumns):
         fscSet = self._createSetOfFSCs()
         table = Table(fileName=starFile, tableName=tableName)
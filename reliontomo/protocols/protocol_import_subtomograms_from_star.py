@@ -26,6 +26,7 @@ from enum import Enum
 from os import mkdir
 from os.path import exists
 from pyworkflow.utils import getParentFolder
+from reliontomo import Plugin
 from reliontomo.constants import SUBTOMO_NAME, FILE_NOT_FOUND, PSUBTOMOS_SQLITE
 from reliontomo.convert import createReaderTomo
 from reliontomo.objects import RelionSetOfPseudoSubtomograms
@@ -77,6 +78,7 @@ class ProtImportSubtomogramsFromStar(ProtBaseImportFromStar):
             subtomoSet = RelionSetOfPseudoSubtomograms.create(self.getPath(), template=PSUBTOMOS_SQLITE)
             subtomoSet.setSamplingRate(sRate)
             subtomoSet.setAcquisition(acq)
+            subtomoSet.setCompact(Plugin.useCompactParticles())
             self.reader.starFile2PseudoSubtomograms(subtomoSet)
         self._defineOutputs(**{outputObjects.subtomograms.name: subtomoSet})
         self._defineSourceRelation(self.inTomos, subtomoSet)
@@ -23,13 +23,10 @@
 # *
 # **************************************************************************
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from os import rename
-from os.path import exists
-
-import mrcfile
-import numpy as np
-from emtable import Table
+from os.path import exists, basename
 
 from pwem.emlib.image import ImageHandler
 from pyworkflow.protocol import PointerParam, IntParam, GE, BooleanParam, LEVEL_ADVANCED, FloatParam, EnumParam, \
@@ -40,8 +37,10 @@ from reliontomo.constants import (IN_TS_STAR, FRAMES_DIR, MOTIONCORR_DIR,
                                   RLN_TOMO_NOMINAL_STAGE_TILT_ANGLE, RLN_MICROGRAPH_NAME, RLN_MICROGRAPH_NAME_EVEN,
                                   RLN_MICROGRAPH_NAME_ODD)
 from reliontomo.convert import convert50_tomo, readTsStarFile
+from reliontomo.convert.fileCache import getFileHash
+from reliontomo.convert.starTable import readStarTable
 from reliontomo.protocols.protocol_base_relion import ProtRelionTomoBase, IS_RELION_50
-from reliontomo.utils import getProgram
+from reliontomo.utils import getProgram, mountMrcStack
 from tomo.objects import SetOfTiltSeries, TiltSeries
 
 logger = logging.getLogger(__name__)
@@ -211,8 +210,7 @@ class ProtRelionTomoMotionCorr(ProtRelionTomoBase):
             if gainFile.endswith(MRC):
                 createLink(gainFile, gainMrcFName)
             else:
-                ih = ImageHandler()
-                ih.convert(gainFile, gainMrcFName)
+                self._convertGain(gainFile, gainMrcFName)
 
     def correctMotionStep(self):
         nMpi = self.numberOfMpi.get()
@@ -226,11 +224,12 @@ class ProtRelionTomoMotionCorr(ProtRelionTomoBase):
         # Create the output set
         inTsMSet = self.inputTiltSeriesM.get()
         outSRate = inTsMSet.getSamplingRate() * self.binningFactor.get()
-        outTsSet = self._genOutTsSet(inTsMSet, outSRate)
+        tsTables = self._mountStacks(inTsMSet, outSRate)
+        outTsSet = self._genOutTsSet(inTsMSet, outSRate, tsTables)
         outputsDict = {outputObjects.tiltSeries.name: outTsSet}
         if self.saveEvenOdd.get():
-            outTsSetEven = self._genOutTsSet(inTsMSet, outSRate, suffix=EVEN)
-            outTsSetOdd = self._genOutTsSet(inTsMSet, outSRate, suffix=ODD)
+            outTsSetEven = self._genOutTsSet(inTsMSet, outSRate, tsTables, suffix=EVEN)
+            outTsSetOdd = self._genOutTsSet(inTsMSet, outSRate, tsTables, suffix=ODD)
             outputsDict[outputObjects.tiltSeriesEven.name] = outTsSetEven
             outputsDict[outputObjects.tiltSeriesOdd.name] = outTsSetOdd
         # Define the outputs and the relations
@@ -240,7 +239,25 @@ class ProtRelionTomoMotionCorr(ProtRelionTomoBase):
             self._defineSourceRelation(self.inputTiltSeriesM, outTsSetEven)
             self._defineSourceRelation(self.inputTiltSeriesM, outTsSetOdd)
 
-    def _genOutTsSet(self, inTsMSet, outSRate, suffix=''):
+    def _mountStacks(self, inTsMSet, outSRate):
+        """Prepares the files of the output tilt-series. Each one is independent and mostly I/O, so they are processed
+        concurrently, using the number of Relion threads. The output sets are filled afterwards by the calling thread,
+        the only one that writes to them. It returns a dictionary of type {tsId: table of its star file sorted by tilt
+        angle}, so the star files are not read again to fill each output set."""
+        tsIds = [tsM.getTsId() for tsM in inTsMSet]
+        with ThreadPoolExecutor(max_workers=max(1, self.binThreads.get())) as executor:
+            # Consuming the results also raises the exceptions of the workers
+            return dict(zip(tsIds, executor.map(lambda tsId: self._mountTsStacks(tsId, outSRate), tsIds)))
+
+    def _mountTsStacks(self, tsId, outSRate):
+        # Rename each TS output star files as they preserve the same base name as the input files, which are
+        # preceded by an in_ suffix to avoid confusion
+        outTsStarName = self.getOutTsStarFileName(tsId)
+        if not exists(outTsStarName):
+            rename(self.getOutTsStarFileName(tsId, preffix='in'), outTsStarName)
+        return self.mountStack(tsId, outSRate)  # It mounts also the even/odd if requested
+
+    def _genOutTsSet(self, inTsMSet, outSRate, tsTables, suffix=''):
         outTsSet = SetOfTiltSeries.create(self._getPath(), template='tiltseries', suffix=suffix)
         outTsSet.copyInfo(inTsMSet)
         outTsSet.setSamplingRate(outSRate)
@@ -248,19 +265,12 @@ class ProtRelionTomoMotionCorr(ProtRelionTomoBase):
         # Fill it with the generated tilt-series
         for tsM in inTsMSet:
             tsId = tsM.getTsId()
-            outTsStarName = self.getOutTsStarFileName(tsId)
-            # Rename each TS output star files as they preserve the same base name as the input files, which are
-            # preceded by an in_ suffix to avoid confusion. Only for the complete TS
-            if not suffix and not exists(outTsStarName):
-                rename(self.getOutTsStarFileName(tsId, preffix='in'), outTsStarName)
             newTs = TiltSeries(tsId=tsId)
             outTsSet.append(newTs)
             newTs.copyInfo(tsM)
             newTs.setSamplingRate(outSRate)
-            if not suffix:
-                self.mountStack(newTs)  # It mounts also the even/odd if requested
-            readTsStarFile(tsM, newTs, outTsStarName, self.getOutStackName(tsId, suffix=suffix),
-                           self._getExtraPath(), isEvenOdd=isEvenOdd)
+            readTsStarFile(tsM, newTs, self.getOutTsStarFileName(tsId), self.getOutStackName(tsId, suffix=suffix),
+                           self._getExtraPath(), isEvenOdd=isEvenOdd, dataTable=tsTables[tsId])
             outTsSet.update(newTs)
         return outTsSet
 
@@ -315,44 +325,35 @@ class ProtRelionTomoMotionCorr(ProtRelionTomoBase):
         bName = f'{tsId}_{suffix}' if suffix else tsId
         return self._getExtraPath(MOTIONCORR_DIR, bName + MRC)
 
-    def mountStack(self, ts):
-        tsId = ts.getTsId()
-        sRate = ts.getSamplingRate()
-        dataTable = Table()
-        dataTable.read(self.getOutTsStarFileName(tsId), tableName=tsId)
+    def mountStack(self, tsId, sRate):
+        """Mounts the stack of the given tilt-series and also the even/odd ones if requested, walking its star file
+        table, sorted by tilt angle, only once. The sorted table is returned."""
+        dataTable = readStarTable(self.getOutTsStarFileName(tsId), tableName=tsId)
         dataTable.sort(RLN_TOMO_NOMINAL_STAGE_TILT_ANGLE)  # Sort by tilt angle
-        self._mountCurrentStack(tsId, sRate, dataTable)
-        # Mount the even/odd stacks if requested
+        stacks = {'': RLN_MICROGRAPH_NAME}
         if self.saveEvenOdd.get():
-            self._mountCurrentStack(tsId, sRate, dataTable, imgField=RLN_MICROGRAPH_NAME_EVEN, suffix=EVEN)
-            self._mountCurrentStack(tsId, sRate, dataTable, imgField=RLN_MICROGRAPH_NAME_ODD, suffix=ODD)
-
-    def _mountCurrentStack(self, tsId, sRate, dataTable, imgField=RLN_MICROGRAPH_NAME, suffix=''):
-        outStackFile = self.getOutStackName(tsId, suffix=suffix)
-        logger.info(f'Mounting the stack file {outStackFile}')
-        alignedImgs = [self._getExtraPath(row.get(imgField)) for row in dataTable]
-
-        # Read the first image to get the dimensions
-        with mrcfile.mmap(alignedImgs[0], mode='r+') as mrc:
-            img = mrc.data
-            nx, ny = img.shape
-
-        # Create an empty array in which the stack of images will be stored
-        shape = (len(alignedImgs), nx, ny)
-        stackArray = np.empty(shape, dtype=img.dtype)
-
-        # Fill it with the images sorted by angle
-        for i, img in enumerate(alignedImgs):
-            with mrcfile.mmap(img) as mrc:
-                logger.info(f'Inserting image - index [{i}], {img}')
-                stackArray[i] = mrc.data
-
-        # Save the stack in a new mrc file
-        with mrcfile.new_mmap(outStackFile, shape, overwrite=True) as mrc:
-            mrc.set_data(stackArray)
-            mrc.update_header_from_data()
-            mrc.update_header_stats()
-            mrc.voxel_size = sRate
+            stacks.update({EVEN: RLN_MICROGRAPH_NAME_EVEN, ODD: RLN_MICROGRAPH_NAME_ODD})
+        alignedImgs = {suffix: [] for suffix in stacks}
+        for row in dataTable:
+            for suffix, imgField in stacks.items():
+                alignedImgs[suffix].append(self._getExtraPath(row.get(imgField)))
+        for suffix, imgs in alignedImgs.items():
+            outStackFile = self.getOutStackName(tsId, suffix=suffix)
+            logger.info(f'Mounting the stack file {outStackFile}')
+            mountMrcStack(imgs, outStackFile, sRate)
+        return dataTable
+
+    def _convertGain(self, gainFile, gainMrcFName):
+        """Converts the gain file to MRC. The conversion is taken from the gain cache of the project if a gain file
+        with the same content has been converted before by any protocol of the project."""
+        fileCache = self.getGainFileCache()
+        cacheKey = fileCache.getKey('gain2Mrc', getFileHash(gainFile), basename(gainMrcFName)) if fileCache else None
+        if fileCache and fileCache.fetch(cacheKey, [gainMrcFName]):
+            return
+        ih = ImageHandler()
+        ih.convert(gainFile, gainMrcFName)
+        if fileCache:
+            fileCache.store(cacheKey, [gainMrcFName])
 
     def _getGainMrcFName(self, inGainFileName):
         return self._getExtraPath(removeBaseExt(inGainFileName) + MRC)
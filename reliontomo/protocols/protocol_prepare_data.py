@@ -36,7 +36,8 @@ from reliontomo.objects import createSetOfRelionPSubtomograms, RelionSetOfPseudo
 from reliontomo.constants import (IN_TOMOS_STAR, OUT_TOMOS_STAR, IN_COORDS_STAR,
                                   OPTIMISATION_SET_STAR, OUT_PARTICLES_STAR, PSUBTOMOS_SQLITE)
 from reliontomo.convert import writeSetOfTomograms, writeSetOfCoordinates, readSetOfPseudoSubtomograms
-from reliontomo.protocols.protocol_base_relion import IS_RELION_50
+from reliontomo.convert.convertBase import addLandmarks
+from reliontomo.protocols.protocol_base_relion import IS_RELION_50, ProtRelionConvertStats
 from reliontomo.utils import generateProjections
 import tomo.objects as tomoObj
 from tomo.protocols.protocol_base import ProtTomoBase
@@ -55,7 +56,7 @@ class outputObjects(Enum):
     projected2DCoordinates = tomoObj.SetOfLandmarkModels
 
 
-class ProtRelionPrepareData(EMProtocol, ProtTomoBase):
+class ProtRelionPrepareData(ProtRelionConvertStats, EMProtocol, ProtTomoBase):
     """Prepare data for Relion 4
     """
     _label = 'Prepare data for Relion 4'
@@ -239,10 +240,11 @@ class ProtRelionPrepareData(EMProtocol, ProtTomoBase):
                                                      template=PSUBTOMOS_SQLITE,
                                                      tsSamplingRate=tsSamplingRate,
                                                      relionBinning=1,  # Coords are re-sampled to fit the TS size
-                                                     boxSize=coordSize)
+                                                     boxSize=coordSize,
+                                                     compact=Plugin.useCompactParticles())
         psubtomoSet.setCoordinates3D(self.inputCoords)
         # Fill the set with the generated particles
-        readSetOfPseudoSubtomograms(psubtomoSet, isRelion5=False)
+        readSetOfPseudoSubtomograms(psubtomoSet, isRelion5=False, sidecarDirs=[self._getPath()])
 
         self._defineOutputs(**{outputObjects.relionParticles.name: psubtomoSet})
         self._defineSourceRelation(self.inputCoords.get(), psubtomoSet)
@@ -276,14 +278,12 @@ class ProtRelionPrepareData(EMProtocol, ProtTomoBase):
             # Get the projections for the tilt series
             tsProjections = projections[tsId]
 
-            for projection in tsProjections:
-                tiltIm = projection[1] + 1
-                chainId = projection[2] + 1
-                xCoor = int(round(projection[3]))
-                yCoor = int(round(projection[4]))
-                landmarkModelGaps.addLandmark(xCoor, yCoor, tiltIm,
-                                              chainId, 0, 0)
-                pos += 1
+            addLandmarks(landmarkModelGaps,
+                         [int(round(projection[3])) for projection in tsProjections],  # xCoor
+                         [int(round(projection[4])) for projection in tsProjections],  # yCoor
+                         [projection[1] + 1 for projection in tsProjections],  # tiltIm
+                         [projection[2] + 1 for projection in tsProjections])  # chainId
+            pos += len(tsProjections)
             fiducialModelGaps.append(landmarkModelGaps)
 
         self._defineOutputs(**{outputObjects.projected2DCoordinates.name: fiducialModelGaps})
@@ -24,6 +24,7 @@
 # **************************************************************************
 import enum
 import logging
+from itertools import groupby
 from typing import Union
 import numpy as np
 from pwem.convert import transformations
@@ -128,9 +129,14 @@ class ProtTomoExportRe5Coords(EMProtocol):
         outCoords.setPrecedents(self.getInputTomograms(returnPointer=True))
         outCoords.setBoxSize(boxSize)
 
-        for tsId, tomo in self.tomosDict.items():
+        # Single pass over the particles, grouped by tomogram
+        for tsId, pSubtomos in groupby(inParticles.iterItems(orderBy=[RelionPSubtomogram.TS_ID_ATTRIBUTE, 'id']),
+                                       key=lambda pSubtomo: pSubtomo.getTsId()):
+            tomo = self.tomosDict.get(tsId, None)
+            if tomo is None:
+                continue
             logger.info(cyanStr(f'tsId = {tsId} - tomogram {tomo}. Exporting the coordinates...'))
-            for pSubtomo in inParticles.iterSubtomos(volume=tomo):
+            for pSubtomo in pSubtomos:
                 try:
                     coord = Coordinate3D()
                     coord.setVolume(tomo)
@@ -30,12 +30,14 @@ from pyworkflow.object import Boolean, Float
 from pyworkflow.protocol import PointerParam, BooleanParam, LEVEL_ADVANCED, IntParam
 from pyworkflow.utils import Message
 from reliontomo import Plugin
-from reliontomo.convert.convert50_tomo import getProjMatrixList, StarFileIterator, PARTICLES_TABLE, RLN_TOMONAME, \
-    RLN_CENTEREDCOORDINATEXANGST, RLN_CENTEREDCOORDINATEYANGST, RLN_CENTEREDCOORDINATEZANGST
+from reliontomo.convert.convert50_tomo import getProjMatrices, projectCoordinates, StarTableGroups, PARTICLES_TABLE, \
+    RLN_TOMONAME, RLN_CENTEREDCOORDINATEXANGST, RLN_CENTEREDCOORDINATEYANGST, RLN_CENTEREDCOORDINATEZANGST
 from reliontomo.objects import createSetOfRelionPSubtomograms, RelionSetOfPseudoSubtomograms
 from reliontomo.constants import (OPTIMISATION_SET_STAR, PSUBTOMOS_SQLITE,
                                   OUT_PARTICLES_STAR, IN_TOMOS_STAR, GLOBAL_TABLE, RLN_TOMOTILT_SERIES_STAR_FILE)
 from reliontomo.convert import readSetOfPseudoSubtomograms, convert50_tomo
+from reliontomo.convert.convertBase import addLandmarks
+from reliontomo.convert.starTable import readStarTable
 from reliontomo.protocols.protocol_re5_base_extract_subtomos_and_rec_particle import (
     ProtRelion5ExtractSubtomoAndRecParticleBase)
 from reliontomo.protocols.protocol_base_import_from_star import IS_RE5_PICKING_ATTR
@@ -167,7 +169,7 @@ class ProtRelion5ExtractSubtomos(ProtRelion5ExtractSubtomoAndRecParticleBase):
         if self.isInputSetOf3dCoords():
             coords = self.getInputParticles()
             outPath = self._getExtraPath()
-            writer = convert50_tomo.Writer()
+            writer = convert50_tomo.Writer(fileCache=self.getStarFileCache())
             # Particles.star
             writer.coords2Star(coords, self.tomoDict, outPath,
                                coordsScale=self.coordsScaleFactor.get(),
@@ -204,8 +206,10 @@ class ProtRelion5ExtractSubtomos(ProtRelion5ExtractSubtomoAndRecParticleBase):
                                                            suffix='Gaps')
             fiducialModelGaps.copyInfo(tsSet)
             fiducialModelGaps.setSetOfTiltSeries(tsPointer)  # Use the pointer better when scheduling
-            starData = Table()
-            starData.read(self._getExtraPath(OUT_PARTICLES_STAR), tableName=PARTICLES_TABLE)
+            # Particles grouped by tomogram, so the whole table is not scanned again for each tilt-series
+            particlesByTs = StarTableGroups(readStarTable(self._getExtraPath(OUT_PARTICLES_STAR),
+                                                          tableName=PARTICLES_TABLE))
+            coordsScaleFactor = self.coordsScaleFactor.get()
             particleCounter = 1
 
             for tsId, ts in self.tsDict.items():
@@ -220,17 +224,23 @@ class ProtRelion5ExtractSubtomos(ProtRelion5ExtractSubtomoAndRecParticleBase):
                                                   applyTSTransformation=False)
                 landmarkModelGaps.setTiltSeries(ts)
                 tsStarFile = self._getExtraPath(tsId + '.star')
-                tsProjectionsList, indexList = getProjMatrixList(tsStarFile, tomo, ts)
-                for particleRow in StarFileIterator(starData, RLN_TOMONAME, tsId):
-                    particleCoords = np.array(
-                        [self.coordsScaleFactor.get() * particleRow.get(RLN_CENTEREDCOORDINATEXANGST) / tomoSRate,
-                         self.coordsScaleFactor.get() * particleRow.get(RLN_CENTEREDCOORDINATEYANGST) / tomoSRate,
-                         self.coordsScaleFactor.get() * particleRow.get(RLN_CENTEREDCOORDINATEZANGST) / tomoSRate,
-                         1])
-                    for index, tomoProjection in zip(indexList, tsProjectionsList):
-                        proj = tomoProjection.dot(particleCoords)
-                        landmarkModelGaps.addLandmark(proj[0], proj[1], index, particleCounter, 0, 0)
-                    particleCounter += 1
+                nParticles = particlesByTs.size(tsId)
+                if nParticles > 0:
+                    # Project all the particles of the tomogram on all the tilt-images at once
+                    prjMatrices, indexList = getProjMatrices(tsStarFile, ts)
+                    particleCoords = np.column_stack(
+                        [particlesByTs.getColumn(tsId, RLN_CENTEREDCOORDINATEXANGST),
+                         particlesByTs.getColumn(tsId, RLN_CENTEREDCOORDINATEYANGST),
+                         particlesByTs.getColumn(tsId, RLN_CENTEREDCOORDINATEZANGST)]) * coordsScaleFactor / tomoSRate
+                    projs = projectCoordinates(prjMatrices, particleCoords)  # Particle x tilt-image x 2
+                    nTilts = len(indexList)
+                    chainIds = np.repeat(np.arange(particleCounter, particleCounter + nParticles), nTilts)
+                    addLandmarks(landmarkModelGaps,
+                                 projs[:, :, 0].ravel().tolist(),
+                                 projs[:, :, 1].ravel().tolist(),
+                                 indexList * nParticles,
+                                 chainIds.tolist())
+                    particleCounter += nParticles
 
                 fiducialModelGaps.append(landmarkModelGaps)
 
@@ -249,10 +259,12 @@ class ProtRelion5ExtractSubtomos(ProtRelion5ExtractSubtomoAndRecParticleBase):
                                                      relionBinning=self.binningFactor.get(),
                                                      boxSize=boxSize,
                                                      are2dStacks=self.write2dStacks.get(),
-                                                     acquisition=acq)
+                                                     acquisition=acq,
+                                                     compact=Plugin.useCompactParticles())
         # Fill the set with the generated particles
         readSetOfPseudoSubtomograms(psubtomoSet, calculateWarpCoords=isInSetOf3dCoords,
-                                    coordFactor=psubtomoSet.getCurrentSamplingRate())
+                                    coordFactor=psubtomoSet.getCurrentSamplingRate(),
+                                    sidecarDirs=self.getSidecarDirs())
 
         # Define the outputs and the relations
         outDict = {outputObjects.relionParticles.name: psubtomoSet}
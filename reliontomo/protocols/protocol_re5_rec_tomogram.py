@@ -159,7 +159,7 @@ class ProtRelion5TomoReconstruct(ProtRelionTomoBase):
 
     def convertInputStep(self):
         outPath = self._getExtraPath()
-        writer = convert50_tomo.Writer()
+        writer = convert50_tomo.Writer(fileCache=self.getStarFileCache())
         # Aligned tilt-series star files: the one corresponding to the set and each TS star file
         writer.alignedTsSet2Star(self.tsDict, outPath)
         writer.tsSet2Star(self.tsDict, self.ctfDict, outPath)
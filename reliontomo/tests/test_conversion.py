@@ -22,12 +22,49 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
-from reliontomo.convert.convertBase import getTransformInfoFromCoordOrSubtomo, genTransformMatrix
-from pyworkflow.tests import BaseTest
+import io
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, dirname, join
+from unittest import mock
+from collections import OrderedDict
+from emtable import Table
+from reliontomo.convert.convertBase import getTransformInfoFromCoordOrSubtomo, genTransformMatrix, \
+    genTransformMatrices, getTransformInfoFromMatrices, getRelionMatrix, getTransformMatrixFromRow, addLandmarks
+from reliontomo.convert.fileCache import ProjectFileCache, getFileStamp, getFileHash
+from reliontomo.convert.starTable import StarTable, getStarBlockOffsets, readStarTable, writeStarTableSidecar, \
+    loadStarTableSidecar, getStarTableChanges, filterStarTable, clearStarTableCache, getStarTableSidecarName, \
+    isFileInDirs
+from reliontomo.convert.convert50_tomo import StarTableGroups, projectCoordinates, genTranslationMatrix, \
+    gen3dRotXMatrix, gen3dRotYMatrix, gen3dRotZMatrix, gen3dRotXMatrices, gen3dRotYMatrices, gen3dRotZMatrices
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pyworkflow.utils import cleanPath
+from pyworkflow.mapper import SqliteMapper
+from pyworkflow.project import Project
+from pyworkflow.protocol import STATUS_FINISHED
+from pyworkflow.protocol.executor import StepExecutor
+import pyworkflow.protocol as pwprot
+import pwem
+from pwem.protocols import EMProtocol
+from reliontomo import Plugin
 from pwem.objects import Transform
 from pwem.convert.transformations import euler_matrix
+import mrcfile
 import numpy as np
-from reliontomo.objects import RelionPSubtomogram
+from reliontomo.objects import RelionPSubtomogram, RelionSetOfPseudoSubtomograms, RelionPSubtomogramCompact
+from tomo.constants import SCIPION, TR_RELION
+from reliontomo.constants import IN_PARTICLES_STAR, RELION_3D_COORD_ORIGIN, R5_ROT_ATTRIB, R5_TILT_ATTRIB, \
+    R5_PSI_ATTRIB, R5_TILT_PRIOR_ATTRIB, R5_PSI_PRIO_ATTRIB, PARTICLES_TABLE
+from reliontomo.convert import convert50_tomo, reuseParticlesStar
+from tomo.objects import LandmarkModel, Coordinate3D, SetOfCoordinates3D, SetOfTomograms, Tomogram, SetOfTiltSeries, \
+    TiltSeries, TiltImage, SetOfCTFTomoSeries, CTFTomoSeries, CTFTomo
+from reliontomo.utils import generateProjections, convertStats, CONVERT_TRACE_SAMPLING, mountMrcStack
+import pyworkflow.object as pwobj
+import pwem.objects as pwemobj
+import tomo.objects as tomoobj
+import reliontomo.objects as reliontomoobj
 
 
 class TestTransformationConversion(BaseTest):
@@ -37,6 +74,35 @@ class TestTransformationConversion(BaseTest):
         """Test conversion o alignment information from and to relion"""
         self._test_set_transformations()
 
+    def test_batchTransformations(self):
+        """Test that the batched conversions give the same results as the particle by particle ones"""
+        nParticles = 200
+        sRate = 1.35
+        rng = np.random.default_rng(0)
+        angles = rng.uniform(-180, 180, (nParticles, 3))
+        angles[:5, 1] = 0  # Degenerated cases: the rot and the psi angles can not be told apart
+        angles[5:10, 1] = 180
+        shifts = rng.uniform(-50, 50, (nParticles, 3))
+
+        matrices = genTransformMatrices(shifts, angles, sRate)
+        self.assertEqual(matrices.shape, (nParticles, 4, 4))
+        for matrix, (shiftX, shiftY, shiftZ), (rot, tilt, psi) in zip(matrices, shifts, angles):
+            self.assertTrue(np.allclose(matrix, genTransformMatrix(shiftX, shiftY, shiftZ, rot, tilt, psi, sRate)))
+
+        subtomos = []
+        for matrix in matrices:
+            subtomo = RelionPSubtomogram()
+            subtomo.setTransform(Transform(matrix=matrix.copy()))
+            subtomos.append(subtomo)
+        rlnAngles, rlnShifts = getTransformInfoFromMatrices([getRelionMatrix(subtomo) for subtomo in subtomos], sRate)
+        for subtomo, rlnAngle, rlnShift in zip(subtomos, rlnAngles, rlnShifts):
+            expectedAngles, expectedShifts = getTransformInfoFromCoordOrSubtomo(subtomo, samplingRate=sRate)
+            self.assertTrue(np.allclose(rlnAngle, expectedAngles))
+            self.assertTrue(np.allclose(rlnShift, expectedShifts))
+
+        # Going back to the matrices from the Relion values has to give the same matrices
+        self.assertTrue(np.allclose(genTransformMatrices(rlnShifts, rlnAngles, sRate), matrices))
+
     def getInitialValues(self):
         """ Returns initial values, Use commented code to test a specific case"""
         fromRealCase ="3.290925     -1.08901    40.351380    65.410000   175.090000    18.310000"
@@ -107,5 +173,825 @@ class TestTransformationConversion(BaseTest):
         print("Scipion transformation matrix:\n%s\n\n" % np.array_str(alignmentMatrix, precision=2, suppress_small=True))
 
 
+class TestConvertStats(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def setUp(self):
+        convertStats.popReport()
+
+    def test_trace(self):
+        rows = [{'rlnOriginXAngst': 2.7, 'rlnAngleRot': 10, 'rlnAngleTilt': 20}, {'rlnAnglePsi': -30}]
+        with self.assertLogs('reliontomo.utils', level='DEBUG') as logs:
+            convertStats.traceSampling = 2
+            for row in rows * 2:
+                matrix = getTransformMatrixFromRow(row, sRate=1.35)
+            convertStats.traceSampling = CONVERT_TRACE_SAMPLING
+        self.assertTrue(np.allclose(matrix, genTransformMatrix(0, 0, 0, 0, 0, -30, 1.35)))
+        self.assertEqual(len(logs.output), 2)  # Calls 1 and 3 are traced
+        # The conversions of single rows are counted by their callers
+        self.assertEqual(convertStats.popReport(), [])
+
+    def test_popReport(self):
+        with convertStats.measure('measured'):
+            convertStats.count('measured', 5)
+        with convertStats.measure('measuredOnly'):
+            pass
+        convertStats.count('counted', 4)
+        report = convertStats.popReport()
+        self.assertEqual([line.rsplit(',', 1)[0] if line.endswith(' s') else line for line in report],
+                         ['measured: 1 calls, 5 items', 'measuredOnly: 1 calls', 'counted: 4 items'])
+        self.assertTrue(all(line.endswith(' s') for line in report[:2]))
+        self.assertEqual(convertStats.popReport(), [])
+
+    def test_protocolSteps(self):
+        """The stats are reported at the end of each step, which must not stop the execution of the next ones."""
+        # The variables of the plugin are needed to import the protocols, as done when the plugin is registered
+        Plugin._defineVariables()
+        from reliontomo.protocols.protocol_base_relion import ProtRelionConvertStats
+
+        class ProtConvertStatsSteps(ProtRelionConvertStats, EMProtocol):
+            def _insertAllSteps(self):
+                for i in range(3):
+                    self._insertFunctionStep(self.convertStep, i + 1)
+
+            def convertStep(self, nItems):
+                convertStats.count('convertStep', nItems)
+
+        workingDir = self.getOutputPath('protConvertStats')
+        cleanPath(workingDir)
+        mapper = SqliteMapper(join(self.getOutputPath(), 'protConvertStats.sqlite'),
+                              {**vars(pwprot), ProtConvertStatsSteps.__name__: ProtConvertStatsSteps})
+        prot = ProtConvertStatsSteps(workingDir=workingDir, mapper=mapper,
+                                     project=Project(pwem.Domain, self.getOutputPath()))
+        prot.makePathsAndClean()
+        prot.setStepsExecutor(StepExecutor(None))
+        prot._insertAllSteps()
+        prot._storeSteps()
+        with self.assertLogs(level='INFO') as logs:
+            prot._runSteps(0)
+        self.assertEqual([step.getStatus() for step in prot._steps], [STATUS_FINISHED] * 3)
+        self.assertEqual([line.split('Conversion stats: ')[1] for line in logs.output if 'Conversion stats' in line],
+                         ['convertStep: %i items' % nItems for nItems in range(1, 4)])
+
+
+class TestStarTable(BaseTest):
+
+    starContent = """
+# Generated by Scipion
+data_general
+
+_rlnTomoSubTomosAre2DStacks                       1
+
+
+data_TS_1
+
+loop_
+_rlnTomoName #1
+_rlnTomoParticleName #2
+_rlnOriginXAngst #3
+_rlnGroupNumber #4
+TS_1 TS_1/1 2.500000 1
+TS_1 TS_1/2 -1 2
+TS_1 TS_1/3 0.125000 1
+
+data_TS_10
+
+loop_
+_rlnTomoName #1
+_rlnTomoParticleName #2
+_rlnOriginXAngst #3
+_rlnGroupNumber #4
+TS_10 TS_10/1 1.000000 3
+"""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.starFile = cls.getOutputPath('starTable.star')
+        with open(cls.starFile, 'w') as f:
+            f.write(cls.starContent)
+
+    def test_sameRowsAsEmtable(self):
+        for tableName in [None, 'general', 'TS_1', 'TS_10']:
+            starTable = StarTable(fileName=self.starFile, tableName=tableName)
+            emTable = Table(fileName=self.starFile, tableName=tableName)
+            self.assertEqual(starTable.getColumnNames(), emTable.getColumnNames())
+            self.assertEqual(starTable.size(), emTable.size())
+            self.assertEqual(list(starTable), list(emTable))
+
+    def test_columns(self):
+        starTable = StarTable(fileName=self.starFile, tableName='TS_1')
+        self.assertEqual(starTable.getColumnArray('rlnGroupNumber').dtype, np.int64)
+        self.assertEqual(starTable.getColumnArray('rlnOriginXAngst').dtype, np.float64)
+        self.assertTrue(starTable.isCategorical('rlnTomoName'))
+        self.assertEqual(starTable.getCategories('rlnTomoName').tolist(), ['TS_1'])
+        self.assertEqual(starTable.getCodes('rlnTomoName').tolist(), [0, 0, 0])
+        self.assertEqual(starTable.getColumnArray('rlnRandomSubset', 1).tolist(), [1, 1, 1])
+        self.assertIsNone(starTable.getColumnArray('rlnRandomSubset'))
+
+    def test_sort(self):
+        starTable = StarTable(fileName=self.starFile, tableName='TS_1')
+        starTable.sort('rlnOriginXAngst')
+        self.assertEqual(starTable.getColumnValues('rlnTomoParticleName'), ['TS_1/2', 'TS_1/3', 'TS_1/1'])
+        starTable.sort('rlnGroupNumber', reverse=True)
+        self.assertEqual(starTable.getColumnValues('rlnTomoParticleName'), ['TS_1/2', 'TS_1/3', 'TS_1/1'])
+        self.assertEqual(starTable[0].get('rlnGroupNumber'), 2)
+
+    def test_groups(self):
+        starTable = StarTable.fromColumns(
+            OrderedDict([('rlnTomoName', np.array([1, 0, 1, 0, 1])),
+                         ('rlnGroupNumber', np.array([3, 3, 1, 2, 1]))]),
+            categories={'rlnTomoName': np.array(['TS_1', 'TS_2'], dtype=object)})
+        particlesByTs = StarTableGroups(starTable)
+        # Groups in order of appearance, keeping the order of the rows
+        self.assertEqual(list(particlesByTs), ['TS_2', 'TS_1'])
+        self.assertEqual(particlesByTs.getIndices('TS_2').tolist(), [0, 2, 4])
+        self.assertEqual(particlesByTs.getColumn('TS_1', 'rlnGroupNumber').tolist(), [3, 2])
+        self.assertEqual(particlesByTs.getColumn('TS_1', 'rlnRandomSubset', 1).tolist(), [1, 1])
+        self.assertEqual([row.get('rlnGroupNumber') for row in particlesByTs.iterRows('TS_2')], [3, 1, 1])
+        self.assertEqual(particlesByTs.getTable('TS_1').getColumnValues('rlnTomoName'), ['TS_1', 'TS_1'])
+        self.assertEqual(particlesByTs.size('TS_3'), 0)
+        # Grouping by a non categorical column
+        byGroupNumber = StarTableGroups(starTable, 'rlnGroupNumber')
+        self.assertEqual(list(byGroupNumber), [3, 1, 2])
+        self.assertEqual(byGroupNumber.getIndices(1).tolist(), [2, 4])
+
+    def test_starTableChanges(self):
+        reformattedStar = self.getOutputPath('starTableReformatted.star')
+        modifiedStar = self.getOutputPath('starTableModified.star')
+        with open(reformattedStar, 'w') as f:
+            f.write(self.starContent.replace('2.500000', '2.5000001').replace('TS_1 TS_1/2 -1', 'TS_1  TS_1/2  -1.0'))
+        with open(modifiedStar, 'w') as f:
+            f.write(self.starContent.replace('TS_1/3 0.125000 1', 'TS_1/4 0.125000 2'))
+        self.assertEqual(getStarTableChanges(self.starFile, self.starFile, tableName='TS_1'), [])
+        self.assertEqual(getStarTableChanges(self.starFile, reformattedStar, tableName='TS_1'), [])
+        self.assertEqual(getStarTableChanges(self.starFile, modifiedStar, tableName='TS_1'),
+                         ['rlnTomoParticleName', 'rlnGroupNumber'])
+        self.assertEqual(getStarTableChanges(self.starFile, modifiedStar, tableName='TS_10'), [])
+
+    def test_filterStarTable(self):
+        filteredStar = self.getOutputPath('starTableFiltered.star')
+        nRows = filterStarTable(self.starFile, filteredStar, 'TS_1', 'rlnTomoParticleName', {'TS_1/1', 'TS_1/3'})
+        self.assertEqual(nRows, 2)
+        self.assertEqual(StarTable(fileName=filteredStar, tableName='TS_1').getColumnValues('rlnTomoParticleName'),
+                         ['TS_1/1', 'TS_1/3'])
+        for tableName in ['general', 'TS_10']:
+            self.assertEqual(list(StarTable(fileName=filteredStar, tableName=tableName)),
+                             list(StarTable(fileName=self.starFile, tableName=tableName)))
+        with self.assertRaises(Exception):
+            filterStarTable(self.starFile, filteredStar, 'TS_1', 'rlnTomoParticleId', {'1'})
+
+    def test_blockOffsets(self):
+        offsets = getStarBlockOffsets(self.starFile)
+        self.assertEqual(list(offsets.keys()), ['general', 'TS_1', 'TS_10'])
+        with open(self.starFile) as f:
+            for blockName, offset in offsets.items():
+                f.seek(offset)
+                self.assertEqual(f.readline().strip(), 'data_' + blockName)
+        # From several threads, as in the protocols that read the star files of the tilt-series in parallel
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(getStarBlockOffsets, [self.starFile] * 200))
+        self.assertTrue(all(result == offsets for result in results))
+
+    def test_readStarTableCache(self):
+        table1 = readStarTable(self.starFile, tableName='TS_1')
+        table1.sort('rlnOriginXAngst')
+        table2 = readStarTable(self.starFile, tableName='TS_1')
+        # Sorting the first copy does not affect the cached table
+        self.assertEqual(table2.getColumnValues('rlnTomoParticleName'), ['TS_1/1', 'TS_1/2', 'TS_1/3'])
+        # The file is parsed only once
+        table3 = readStarTable(self.starFile, tableName='TS_1')
+        self.assertIs(table2.getColumnArray('rlnGroupNumber'), table3.getColumnArray('rlnGroupNumber'))
+        self.assertFalse(table2.getColumnArray('rlnGroupNumber').flags.writeable)
+        # No table name means the first block
+        self.assertEqual(readStarTable(self.starFile).getColumnNames(), ['rlnTomoSubTomosAre2DStacks'])
+
+    def test_sidecar(self):
+        starFile = self.getOutputPath('sidecar.star')
+        with open(starFile, 'w') as f:
+            f.write(self.starContent)
+        starTable = StarTable(fileName=starFile, tableName='TS_1')
+        self.assertIsNotNone(writeStarTableSidecar(starTable, starFile, 'TS_1'))
+        sidecarTable = loadStarTableSidecar(starFile, 'TS_1')
+        self.assertEqual(sidecarTable.getColumnNames(), starTable.getColumnNames())
+        self.assertEqual(list(sidecarTable), list(starTable))
+        self.assertTrue(sidecarTable.isCategorical('rlnTomoParticleName'))
+        # The star file is not read again while its size and modification time do not change
+        with mock.patch('reliontomo.convert.starTable.getFileChecksum', side_effect=AssertionError):
+            self.assertIsNotNone(loadStarTableSidecar(starFile, 'TS_1'))
+        # If only the modification time changes, the checksum is compared
+        stat = os.stat(starFile)
+        os.utime(starFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNotNone(loadStarTableSidecar(starFile, 'TS_1'))
+        # The sidecar is ignored if the star file changes
+        with open(starFile, 'a') as f:
+            f.write('\n')
+        self.assertIsNone(loadStarTableSidecar(starFile, 'TS_1'))
+
+    def test_sidecarDirs(self):
+        sidecarDir = self.getOutputPath('sidecarDir')
+        os.makedirs(sidecarDir, exist_ok=True)
+        outsideStar = self.getOutputPath('outside.star')
+        insideStar = join(sidecarDir, 'inside.star')
+        for starFile in (outsideStar, insideStar):
+            with open(starFile, 'w') as f:
+                f.write(self.starContent)
+            clearStarTableCache()
+            table = readStarTable(starFile, tableName='TS_1', useSidecar=True, sidecarDirs=[sidecarDir])
+            self.assertEqual(table.size(), 3)
+        # The sidecar is only written for the files inside the given directories
+        self.assertFalse(os.path.exists(getStarTableSidecarName(outsideStar, 'TS_1')))
+        self.assertTrue(os.path.exists(getStarTableSidecarName(insideStar, 'TS_1')))
+        self.assertFalse(isFileInDirs(outsideStar, [sidecarDir]))
+
+    def test_readOpticsGroupsStr(self):
+        starFile = self.getOutputPath('optics.star')
+        opticsBlock = 'data_optics\n\nloop_\n_rlnOpticsGroup #1\n_rlnOpticsGroupName #2\n1 %s\n\n'
+        with open(starFile, 'w') as f:
+            f.write(opticsBlock % 'opticsGroup1' + self.starContent)
+        opticsStr = reliontomoobj.readOpticsGroupsStr(starFile)
+        self.assertIn('opticsGroup1', opticsStr)
+        hits = reliontomoobj._readOpticsGroupsStr.cache_info().hits
+        self.assertEqual(reliontomoobj.readOpticsGroupsStr(starFile), opticsStr)
+        self.assertEqual(reliontomoobj._readOpticsGroupsStr.cache_info().hits, hits + 1)
+        # The file is read again if it changes
+        with open(starFile, 'w') as f:
+            f.write(opticsBlock % 'opticsGroupB' + self.starContent)
+        self.assertIn('opticsGroupB', reliontomoobj.readOpticsGroupsStr(starFile))
+        self.assertLessEqual(reliontomoobj._readOpticsGroupsStr.cache_info().currsize,
+                             reliontomoobj.MAX_OPTICS_FILES)
+
+    def test_projectFileCache(self):
+        fileCache = ProjectFileCache(self.getOutputPath('fileCache'), maxBytes=2 * os.path.getsize(self.starFile))
+        self.assertIsNone(fileCache.getKey('ts2Star', getFileStamp(self.getOutputPath('missing.star'))))
+        # The files are cached by their base name
+        fetchedStar = self.getOutputPath('fetched', basename(self.starFile))
+        os.makedirs(dirname(fetchedStar), exist_ok=True)
+        keys = [fileCache.getKey('ts2Star', getFileStamp(self.starFile), i) for i in range(3)]
+        self.assertFalse(fileCache.fetch(keys[0], [fetchedStar]))
+        for key in keys:
+            fileCache.store(key, [self.starFile])
+        # Only the two most recent entries fit in the cache
+        self.assertFalse(fileCache.fetch(keys[0], [fetchedStar]))
+        self.assertTrue(fileCache.fetch(keys[1], [fetchedStar]))
+        with open(fetchedStar) as f:
+            self.assertEqual(f.read(), self.starContent)
+        # The fetched entry is now the most recent one
+        fileCache.store(keys[0], [self.starFile])
+        self.assertTrue(fileCache.fetch(keys[1], [fetchedStar]))
+        self.assertFalse(fileCache.fetch(keys[2], [fetchedStar]))
+        # The same content in a different file gives the same hash
+        self.assertIsNone(getFileHash(self.getOutputPath('missing.star')))
+        self.assertEqual(getFileHash(fetchedStar), getFileHash(self.starFile))
+        otherStar = self.getOutputPath('other.star')
+        with open(otherStar, 'w') as f:
+            f.write(self.starContent + '\n')
+        self.assertNotEqual(getFileHash(otherStar), getFileHash(self.starFile))
+
+
+class TestProjections(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_projectCoordinates(self):
+        rng = np.random.default_rng(0)
+        angles = rng.uniform(-60, 60, (4, 3))
+        prjMatrices = genTranslationMatrix(100, 120, 0) @ gen3dRotZMatrices(angles[:, 2]) @ \
+            gen3dRotYMatrices(angles[:, 1]) @ gen3dRotXMatrices(angles[:, 0])
+        coords = rng.uniform(-50, 50, (6, 3))
+        projs = projectCoordinates(prjMatrices, coords)
+        self.assertEqual(projs.shape, (6, 4, 2))
+        for (xRot, yRot, zRot), prjMatrix, tiltProjs in zip(angles, prjMatrices, projs.transpose(1, 0, 2)):
+            expectedMatrix = genTranslationMatrix(100, 120, 0) @ gen3dRotZMatrix(zRot) @ gen3dRotYMatrix(yRot) @ \
+                gen3dRotXMatrix(xRot)
+            self.assertTrue(np.allclose(prjMatrix, expectedMatrix))
+            for coord, proj in zip(coords, tiltProjs):
+                self.assertTrue(np.allclose(proj, expectedMatrix.dot(np.append(coord, 1))[:2]))
+
+    def test_addLandmarks(self):
+        xCoords = [1.5, 2.25, -3.0, 4.0]
+        yCoords = [0.5, 1.0, 7.125, -2.0]
+        tiltIds = [1, 2, 1, 2]
+        chainIds = [1, 1, 2, 2]
+        expected = LandmarkModel(fileName=self.getOutputPath('expected.sfid'))
+        for values in zip(xCoords, yCoords, tiltIds, chainIds):
+            expected.addLandmark(*values, 0, 0)
+        landmarkModel = LandmarkModel(fileName=self.getOutputPath('landmarks.sfid'))
+        addLandmarks(landmarkModel, xCoords[:2], yCoords[:2], tiltIds[:2], chainIds[:2])
+        addLandmarks(landmarkModel, xCoords[2:], yCoords[2:], tiltIds[2:], chainIds[2:])
+        with open(expected.getFileName()) as f1, open(landmarkModel.getFileName()) as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(landmarkModel.getCount(), expected.getCount())
+
+    def test_generateProjections(self):
+        # Numeric tomogram names must be kept as strings, to find their tables in the tomograms file
+        for ts1, ts2 in [('TS_1', 'TS_2'), ('101', '102')]:
+            tomogramsStar = self.getOutputPath('tomograms_%s.star' % ts1)
+            particlesStar = self.getOutputPath('particles_%s.star' % ts1)
+            projVectors = {ts1: [['[1,0,0,10]', '[0,1,0,20]', '[0,0,1,0]', '[0,0,0,1]'],
+                                 ['[0.5,0,0.5,10]', '[0,1,0,20]', '[0,0,1,0]', '[0,0,0,1]']],
+                           ts2: [['[0,1,0,0]', '[1,0,0,0]', '[0,0,1,0]', '[0,0,0,1]']]}
+            with open(tomogramsStar, 'w') as f:
+                for tomoName, tilts in projVectors.items():
+                    f.write('data_%s\n\nloop_\n_rlnTomoProjX #1\n_rlnTomoProjY #2\n_rlnTomoProjZ #3\n'
+                            '_rlnTomoProjW #4\n' % tomoName)
+                    f.writelines(' '.join(tilt) + '\n' for tilt in tilts)
+                    f.write('\n')
+            with open(particlesStar, 'w') as f:
+                f.write('data_particles\n\nloop_\n_rlnTomoName #1\n_rlnCoordinateX #2\n_rlnCoordinateY #3\n'
+                        '_rlnCoordinateZ #4\n%s 1.0 2.0 3.0\n%s 4.0 5.0 6.0\n%s 7.0 8.0 9.0\n\n' % (ts2, ts1, ts2))
+
+            projections = generateProjections(particlesStar, tomogramsStar)
+            self.assertEqual(list(projections), [ts2, ts1])
+            self.assertEqual(projections[ts2], [[ts2, 0, 0, 2.0, 1.0], [ts2, 0, 2, 8.0, 7.0]])
+            self.assertEqual(projections[ts1], [[ts1, 0, 1, 14.0, 25.0], [ts1, 1, 1, 15.0, 25.0]])
+        # The name of the table may also be given as a number
+        self.assertEqual(readStarTable(tomogramsStar, tableName=102).size(), 1)
+        particlesTable = readStarTable(particlesStar)
+        self.assertTrue(particlesTable.isCategorical('rlnTomoName'))
+        self.assertEqual(list(StarTableGroups(particlesTable)), ['102', '101'])
+
+    def test_tsSet2Star(self):
+        sRate = 2
+        tsSet = SetOfTiltSeries(filename=self.getOutputPath('tiltSeries.sqlite'))
+        tsSet.setSamplingRate(sRate)
+        tsSet.getAcquisition().setTiltAxisAngle(85)
+        ts = TiltSeries(tsId='TS_1')
+        ts.copyInfo(tsSet)
+        tsSet.append(ts)
+        tiltAngles = [0, 3, -3, 6]
+        for i, tiltAngle in enumerate(tiltAngles):
+            ti = TiltImage(location=(i + 1, self.getOutputPath('TS_1.mrcs')), tsId='TS_1', acquisitionOrder=i + 1)
+            ti.setTiltAngle(tiltAngle)
+            ti.setEnabled(i != 1)
+            transform = Transform(np.eye(3))
+            if i == 3:
+                angle = np.deg2rad(30)
+                transform.setMatrix(np.array([[np.cos(angle), np.sin(angle), 10],
+                                              [-np.sin(angle), np.cos(angle), -4],
+                                              [0, 0, 1]]))
+            ti.setTransform(transform)
+            ts.append(ti)
+        tsSet.update(ts)
+        tsSet.write()
+        ctfSet = SetOfCTFTomoSeries(filename=self.getOutputPath('ctfs.sqlite'))
+        ctfSeries = CTFTomoSeries(tsId='TS_1')
+        ctfSet.append(ctfSeries)
+        for i in range(len(tiltAngles)):
+            ctfTomo = CTFTomo(index=i + 1, acqOrder=i + 1)
+            ctfTomo.setStandardDefocus(10000 + i, 9000 + i, 45)
+            ctfTomo.setResolution(8)
+            ctfTomo.setEnabled(i != 2)
+            ctfSeries.append(ctfTomo)
+        ctfSet.update(ctfSeries)
+        ctfSet.write()
+
+        outPath = self.getOutputPath('tsSet2Star')
+        os.makedirs(outPath, exist_ok=True)
+        convert50_tomo.Writer().tsSet2Star({'TS_1': tsSet.getFirstItem()}, {'TS_1': ctfSet.getFirstItem()}, outPath)
+        tsTable = StarTable(fileName=join(outPath, 'TS_1.star'), tableName='TS_1')
+        # Only the tilt-images enabled in both the tilt-series and the CTF series
+        self.assertEqual(tsTable.getColumnValues('rlnTomoYTilt'), [0, 6])
+        self.assertEqual(tsTable.getColumnValues('rlnDefocusU'), [10000, 10003])
+        self.assertTrue(np.allclose(tsTable.getColumnValues('rlnTomoZRot'), [0, 30]))
+        angle = np.deg2rad(30)
+        expectedShifts = -np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]) @ [10, -4] * sRate
+        self.assertTrue(np.allclose(tsTable.getColumnValues('rlnTomoXShiftAngst'), [0, expectedShifts[0]]))
+        self.assertTrue(np.allclose(tsTable.getColumnValues('rlnTomoYShiftAngst'), [0, expectedShifts[1]]))
+
+    def test_mountMrcStack(self):
+        rng = np.random.default_rng(0)
+        imgs = rng.normal(5, 2, (3, 6, 4)).astype(np.float32)
+        imgFiles = []
+        for i, img in enumerate(imgs):
+            imgFiles.append(self.getOutputPath('tilt%i.mrc' % i))
+            with mrcfile.new(imgFiles[-1], overwrite=True) as mrc:
+                mrc.set_data(img)
+        with mrcfile.open(imgFiles[1], mode='r+') as mrc:
+            mrc.reset_header_stats()  # Its stats have to be calculated from the data
+        with mrcfile.open(imgFiles[2], mode='r+') as mrc:
+            # Header written without stats, as some programs do. They have to be calculated from the data too
+            for field in ['dmin', 'dmax', 'dmean', 'rms']:
+                mrc.header[field] = 0
+        rawStackFile = self.getOutputPath('rawStack.mrc')
+        mountMrcStack(imgFiles[::-1], rawStackFile, 1.5)
+        # Different data types, so they are decoded
+        with mrcfile.new(self.getOutputPath('tilt3.mrc'), overwrite=True) as mrc:
+            mrc.set_data(imgs[0].astype(np.float16))
+        decodedStackFile = self.getOutputPath('decodedStack.mrc')
+        mountMrcStack(imgFiles[::-1] + [self.getOutputPath('tilt3.mrc')], decodedStackFile, 1.5)
+        for stackFile, expectedImgs in [(rawStackFile, imgs[::-1]),
+                                        (decodedStackFile, np.concatenate([imgs[::-1], imgs[:1].astype(np.float16)]))]:
+            with mrcfile.open(stackFile) as mrc:
+                self.assertTrue(np.array_equal(mrc.data, expectedImgs))
+                self.assertEqual(mrc.voxel_size.x, 1.5)
+                for field, expected in [('dmin', expectedImgs.min()), ('dmax', expectedImgs.max()),
+                                        ('dmean', expectedImgs.mean()), ('rms', expectedImgs.std())]:
+                    self.assertAlmostEqual(float(mrc.header[field]), float(expected), places=5)
+
+
+class TestAppendFromColumns(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    @staticmethod
+    def _genPSubtomo(i, itemType=RelionPSubtomogram, withCoord=True, **kwargs):
+        psubtomo = itemType(fileName='particle%i.mrc' % i, samplingRate=2.5, tsId='TS_%i' % (i % 3),
+                            x=1.5 * i, y=-2.0 * i, z=i, rdnSubset=i % 2 + 1,
+                            relionParticleName='TS_%i/%i' % (i % 3, i), visibleFrames='[1,1,0]',
+                            manifoldIndex=i, rot=10.0 * i, coordX=i, coordY=2 * i, coordZ=3 * i, **kwargs)
+        if withCoord:
+            coord = Coordinate3D()
+            coord.setX(i, SCIPION)
+            coord.setY(2 * i, SCIPION)
+            coord.setZ(3 * i, SCIPION)
+            coord.setGroupId(i % 4)
+            coord.setTomoId('TS_%i' % (i % 3))
+            psubtomo.setCoordinate3D(coord)
+        psubtomo.setTransform(Transform(matrix=genTransformMatrix(i, 2 * i, 0, 5 * i, 30, -i, 2.5)))
+        psubtomo.setClassId(i % 5)
+        return psubtomo
+
+    @staticmethod
+    def _getRows(sqliteFile):
+        with sqlite3.connect(sqliteFile) as conn:
+            conn.row_factory = sqlite3.Row
+            return [{key: row[key] for key in row.keys() if key != 'creation'}
+                    for row in conn.execute('SELECT * FROM Objects ORDER BY id')]
+
+    def _assertSameItems(self, setClass, fileName, expectedFileName):
+        """Reopens both sets from their sqlite and compares all the attributes of their items."""
+        # The plugin may not be registered in the test environment, so the classes are provided to the mapper
+        classesDict = {**vars(pwobj), **vars(pwemobj), **vars(tomoobj), **vars(reliontomoobj)}
+        readSet = setClass(filename=fileName, classesDict=classesDict)
+        expectedSet = setClass(filename=expectedFileName, classesDict=classesDict)
+        self.assertEqual(readSet.getSize(), expectedSet.getSize())
+        expectedItems = [item.clone() for item in expectedSet.iterItems(orderBy='id')]
+        for item, expectedItem in zip(readSet.iterItems(orderBy='id'), expectedItems):
+            self.assertIs(type(item), type(expectedItem))
+            self.assertEqual((item.getObjId(), item.isEnabled(), item.getObjLabel(), item.getObjComment()),
+                             (expectedItem.getObjId(), expectedItem.isEnabled(), expectedItem.getObjLabel(),
+                              expectedItem.getObjComment()))
+            itemDict, expectedDict = item.getObjDict(), expectedItem.getObjDict()
+            self.assertEqual(list(itemDict.keys()), list(expectedDict.keys()))
+            for key, value in expectedDict.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(itemDict[key], value)
+                elif isinstance(value, str) and value.startswith('[['):
+                    self.assertTrue(np.allclose(json.loads(itemDict[key]), json.loads(value)))
+                else:
+                    self.assertEqual(itemDict[key], value, key)
+        readSet.close()
+        expectedSet.close()
+
+    def test_appendFromColumns(self):
+        nParticles = 7
+        psubtomos = [self._genPSubtomo(i) for i in range(nParticles)]
+        expectedSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath('expected.sqlite'))
+        expectedSet.setSamplingRate(2.5)
+        for psubtomo in psubtomos:
+            expectedSet.append(psubtomo.clone())
+        expectedSet.write()
+
+        columns = {key: [psubtomo.getObjDict()[key] for psubtomo in psubtomos]
+                   for key in ['_filename', '_volName', '_classId', '_x', '_y', '_z', '_rdnSubset',
+                               '_relionParticleName', '_manifoldIndex', '_rot', '_coordX', '_coordY', '_coordZ',
+                               '_coordinate._x', '_coordinate._y', '_coordinate._z', '_coordinate._groupId',
+                               '_coordinate._tomoId']}
+        columns['_transform._matrix'] = np.array([psubtomo.getTransform().getMatrix() for psubtomo in psubtomos])
+        bulkSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath('bulk.sqlite'))
+        bulkSet.setSamplingRate(2.5)
+        bulkSet.appendFromColumns(psubtomos[0].clone(), columns, nParticles, batchSize=3)
+        bulkSet.write()
+
+        self.assertEqual(bulkSet.getSize(), nParticles)
+        self.assertEqual(self._getRows(bulkSet.getFileName()), self._getRows(expectedSet.getFileName()))
+        bulkSet.close()
+        self._assertSameItems(RelionSetOfPseudoSubtomograms, bulkSet.getFileName(), expectedSet.getFileName())
+
+    def test_compactPSubtomos(self):
+        nParticles = 5
+        psubtomos = [self._genPSubtomo(i, itemType=RelionPSubtomogramCompact) for i in range(nParticles)]
+        psubtomo = psubtomos[3]
+        self.assertEqual(psubtomo.getRdnSubset(), 2)
+        self.assertIsInstance(psubtomo.getRdnSubset(), int)
+        self.assertEqual(psubtomo.getManifoldIndex(), 3)
+        self.assertAlmostEqual(psubtomo.getX(), 4.5)
+        self.assertAlmostEqual(psubtomo.getRot(), 30)
+        self.assertIsNone(psubtomo.getPsi())
+        self.assertEqual(psubtomo.getCoords(), (4.5, -6.0, 3.0))
+        self.assertEqual((psubtomo.getCoordX(), psubtomo.getCoordY(), psubtomo.getCoordZ()), (3, 6, 9))
+
+        # Setters and copies
+        psubtomo.setRot(12.5)
+        clonedPSubtomo = psubtomo.clone()
+        self.assertAlmostEqual(clonedPSubtomo.getRot(), 12.5)
+        self.assertEqual(clonedPSubtomo.getRelionParticleName(), 'TS_0/3')
+        clonedPSubtomo.setRot(-1)
+        self.assertAlmostEqual(psubtomo.getRot(), 12.5)
+
+        # Set populated particle by particle vs populated from columns
+        expectedSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath('expectedCompact.sqlite'),
+                                                    compact=True)
+        expectedSet.setSamplingRate(2.5)
+        self.assertIs(expectedSet.getItemType(), RelionPSubtomogramCompact)
+        for psubtomo in psubtomos:
+            expectedSet.append(psubtomo.clone())
+        expectedSet.write()
+
+        columns = {'_filename': [psubtomo.getFileName() for psubtomo in psubtomos],
+                   '_volName': [psubtomo.getTsId() for psubtomo in psubtomos],
+                   '_classId': [psubtomo.getClassId() for psubtomo in psubtomos],
+                   '_relionParticleName': [psubtomo.getRelionParticleName() for psubtomo in psubtomos],
+                   '_transform._matrix': np.array([psubtomo.getTransform().getMatrix() for psubtomo in psubtomos])}
+        for key in ['_x', '_y', '_z', '_rdnSubset', '_manifoldIndex', '_rot', '_coordX', '_coordY', '_coordZ']:
+            columns[key] = [getattr(psubtomo, key).get() for psubtomo in psubtomos]
+        for key in ['_x', '_y', '_z', '_groupId', '_tomoId']:
+            columns['_coordinate.' + key] = [getattr(psubtomo.getCoordinate3D(), key).get() for psubtomo in psubtomos]
+        bulkSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath('bulkCompact.sqlite'), compact=True)
+        bulkSet.setSamplingRate(2.5)
+        bulkSet.appendFromColumns(psubtomos[0].clone(), columns, nParticles, batchSize=2)
+        bulkSet.write()
+
+        rows = self._getRows(bulkSet.getFileName())
+        self.assertEqual(rows, self._getRows(expectedSet.getFileName()))
+        self.assertEqual(len(rows), nParticles)
+        with sqlite3.connect(bulkSet.getFileName()) as conn:
+            labels = [row[0] for row in conn.execute('SELECT label_property FROM Classes')]
+        self.assertIn(RelionPSubtomogramCompact.PACKED_ATTRIBUTE, labels)
+        self.assertNotIn('_rot', labels)
+        bulkSet.close()
+        self._assertSameItems(RelionSetOfPseudoSubtomograms, bulkSet.getFileName(), expectedSet.getFileName())
+
+    def test_compactRoundTrip(self):
+        """The particles of a compact set are read back from its sqlite and written to the same particles star
+        file as the ones of a regular set, as the protocols do with their output and input particles."""
+        nParticles = 4
+        classesDict = {**vars(pwobj), **vars(pwemobj), **vars(tomoobj), **vars(reliontomoobj)}
+        acq = tomoobj.TomoAcquisition()
+        acq.opticsGroupInfo = pwobj.String('data_optics\n\nloop_\n_rlnOpticsGroup #1\n'
+                                           '_rlnOpticsGroupName #2\n1 opticsGroup1\n\n')
+        starFiles = {}
+        for compact in [False, True]:
+            name = 'roundTrip%s' % ('Compact' if compact else '')
+            psubtomoSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath(name + '.sqlite'),
+                                                        compact=compact)
+            psubtomoSet.setSamplingRate(2.5)
+            psubtomoSet.setAcquisition(acq)
+            for i in range(nParticles):
+                # Without coordinates, as the writer would need their tomograms
+                psubtomoSet.append(self._genPSubtomo(i, itemType=psubtomoSet.getItemType(), withCoord=False,
+                                                     ctfFile='ctf%i.mrc' % i, tilt=90 - i, psi=-i, tiltPrior=90,
+                                                     psiPrior=0, xInImg=i, yInImg=i, zInImg=i,
+                                                     logLikeliCont=0.5 * i, maxValProbDist=0.1,
+                                                     noSignifSamples=i))
+            psubtomoSet.write()
+            psubtomoSet.close()
+
+            # Read back from the sqlite
+            readSet = RelionSetOfPseudoSubtomograms(filename=psubtomoSet.getFileName(), classesDict=classesDict)
+            readSet.loadAllProperties()
+            self.assertEqual(readSet.isCompact(), compact)
+            self.assertEqual(readSet.getSize(), nParticles)
+            psubtomo = readSet[4]  # i = 3
+            self.assertIsInstance(psubtomo, RelionPSubtomogramCompact if compact else RelionPSubtomogram)
+            self.assertEqual((psubtomo.getTilt(), psubtomo.getRdnSubset(), psubtomo.getNrOfSignificantSamples()),
+                             (87, 2, 3))
+
+            outPath = self.getOutputPath(name)
+            os.makedirs(outPath, exist_ok=True)
+            convert50_tomo.Writer().pseudoSubtomograms2Star(readSet, outPath)
+            starFiles[compact] = join(outPath, IN_PARTICLES_STAR)
+
+        self.assertEqual(getStarTableChanges(starFiles[False], starFiles[True], tableName=PARTICLES_TABLE), [])
+        with open(starFiles[False]) as f1, open(starFiles[True]) as f2:
+            self.assertEqual(f1.readlines()[1:], f2.readlines()[1:])  # The first line is a comment with the date
+
+    def test_pseudoSubtomograms2StarWidths(self):
+        """The particles streamed to the star file have the same column widths as the ones written by
+        Table.writeStar, also when the widest values are not in the first row."""
+        acq = tomoobj.TomoAcquisition()
+        acq.opticsGroupInfo = pwobj.String('data_optics\n\nloop_\n_rlnOpticsGroup #1\n'
+                                           '_rlnOpticsGroupName #2\n1 opticsGroup1\n\n')
+        psubtomoSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath('widths.sqlite'))
+        psubtomoSet.setSamplingRate(2.5)
+        psubtomoSet.setAcquisition(acq)
+        for i in [1, 2, 3, 4, 12345]:
+            psubtomoSet.append(self._genPSubtomo(i, withCoord=False, ctfFile='ctf%i.mrc' % i, tilt=90 - i, psi=-i,
+                                                 tiltPrior=90, psiPrior=0, xInImg=i, yInImg=i, zInImg=i,
+                                                 logLikeliCont=0.5 * i, maxValProbDist=0.1, noSignifSamples=i))
+        psubtomoSet.write()
+        psubtomoSet.close()
+        classesDict = {**vars(pwobj), **vars(pwemobj), **vars(tomoobj), **vars(reliontomoobj)}
+        psubtomoSet = RelionSetOfPseudoSubtomograms(filename=psubtomoSet.getFileName(), classesDict=classesDict)
+        psubtomoSet.loadAllProperties()
+        starFiles = {}
+        for flushChunk in [2, 10]:
+            outPath = self.getOutputPath('widths%i' % flushChunk)
+            os.makedirs(outPath, exist_ok=True)
+            convert50_tomo.Writer().pseudoSubtomograms2Star(psubtomoSet, outPath, flushChunk=flushChunk)
+            starFiles[flushChunk] = join(outPath, IN_PARTICLES_STAR)
+
+        # The values are the same whatever the size of the chunks
+        self.assertEqual(getStarTableChanges(starFiles[2], starFiles[10], tableName=PARTICLES_TABLE), [])
+        # The file is the same as the one written by Table.writeStar. The values are read as strings, so they are
+        # written with the same text
+        particlesTable = Table(fileName=starFiles[2], tableName=PARTICLES_TABLE, guessType=False)
+        expected = io.StringIO()
+        particlesTable.writeStar(expected, tableName=PARTICLES_TABLE)
+        for starFile in starFiles.values():
+            with open(starFile) as f:
+                content = f.read()
+            self.assertEqual(content[content.index('\ndata_%s' % PARTICLES_TABLE):], expected.getvalue())
+
+    def test_starFile2Coords3D(self):
+        sRate = 2.5
+        tomoSet = SetOfTomograms(filename=self.getOutputPath('tomograms.sqlite'))
+        tomoSet.setSamplingRate(sRate)
+        for tsId, dims in [('TS_1', (10, 20, 30)), ('TS_2', (12, 16, 8))]:
+            tomoFile = self.getOutputPath('%s.mrc' % tsId)
+            with mrcfile.new(tomoFile, overwrite=True) as mrc:
+                mrc.set_data(np.zeros(dims, dtype=np.float32))
+            tomo = Tomogram(location=tomoFile, tsId=tsId)
+            tomo.setSamplingRate(sRate)
+            tomoSet.append(tomo)
+        tomoSet.write()
+        starFile = self.getOutputPath('coordinates.star')
+        with open(starFile, 'w') as f:
+            f.write('data_particles\n\nloop_\n_rlnTomoName #1\n_rlnCoordinateX #2\n_rlnCoordinateY #3\n'
+                    '_rlnCoordinateZ #4\n_rlnTomoSubtomogramRot #5\n_rlnTomoSubtomogramTilt #6\n'
+                    '_rlnTomoSubtomogramPsi #7\n_rlnAngleRot #8\n'
+                    'TS_2 1.0 2.0 3.0 10.0 20.0 30.0 5.0\n'
+                    'TS_3 4.0 5.0 6.0 0.0 0.0 0.0 0.0\n'
+                    'TS_1 7.0 8.0 9.0 -40.0 90.0 170.0 -5.0\n\n')
+        scaleFactor = 2
+        reader = convert50_tomo.Reader(starFile, StarTable(fileName=starFile, tableName='particles'))
+        bulkSet = SetOfCoordinates3D(filename=self.getOutputPath('bulkCoordinates.sqlite'))
+        bulkSet.setSamplingRate(sRate)
+        reader.starFile2Coords3D(bulkSet, tomoSet, scaleFactor=scaleFactor, batchSize=1)
+        bulkSet.write()
+
+        # Coordinates generated one by one
+        expectedSet = SetOfCoordinates3D(filename=self.getOutputPath('expectedCoordinates.sqlite'))
+        expectedSet.setSamplingRate(sRate)
+        tomosDict = {tomo.getTsId(): tomo.clone() for tomo in tomoSet}
+        for tsId, coords, angles, rot in [('TS_2', (1, 2, 3), (10, 20, 30), 5),
+                                          ('TS_1', (7, 8, 9), (-40, 90, 170), -5)]:
+            coord = Coordinate3D()
+            coord.setVolume(tomosDict[tsId])
+            coord.setPosition(*[value * scaleFactor for value in coords], RELION_3D_COORD_ORIGIN)
+            coord.setMatrix(genTransformMatrix(0, 0, 0, *angles, sRate), convention=TR_RELION)
+            for attrName, value in zip([R5_ROT_ATTRIB, R5_TILT_ATTRIB, R5_PSI_ATTRIB, R5_TILT_PRIOR_ATTRIB,
+                                        R5_PSI_PRIO_ATTRIB], [rot, 0, 0, 0, 0]):
+                setattr(coord, attrName, pwobj.Float(value))
+            expectedSet.append(coord)
+        expectedSet.write()
+
+        self.assertEqual(bulkSet.getSize(), 2)
+        expectedRows = self._getRows(expectedSet.getFileName())
+        for bulkRow, expectedRow in zip(self._getRows(bulkSet.getFileName()), expectedRows):
+            self.assertEqual(bulkRow.keys(), expectedRow.keys())
+            for key, value in expectedRow.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(bulkRow[key], value)
+                elif isinstance(value, str) and value.startswith('[['):
+                    self.assertTrue(np.allclose(json.loads(bulkRow[key]), json.loads(value)))
+                else:
+                    self.assertEqual(bulkRow[key], value)
+        self._assertSameItems(SetOfCoordinates3D, bulkSet.getFileName(), expectedSet.getFileName())
+
+        # And back to a star file, grouped by tomogram in the order of the given dictionary
+        outPath = self.getOutputPath('coords2Star')
+        os.makedirs(outPath, exist_ok=True)
+        tomosDict = {'TS_1': tomosDict['TS_1'], 'TS_2': tomosDict['TS_2']}
+        convert50_tomo.Writer().coords2Star(bulkSet, tomosDict, outPath, coordsScale=1 / scaleFactor)
+        outTable = StarTable(fileName=join(outPath, IN_PARTICLES_STAR), tableName='particles')
+        self.assertEqual(outTable.getColumnValues('rlnTomoName'), ['TS_1', 'TS_2'])
+        self.assertTrue(np.allclose(outTable.getColumnValues('rlnCoordinateX'), [7, 1]))
+        self.assertTrue(np.allclose(outTable.getColumnValues('rlnCoordinateZ'), [9, 3]))
+        self.assertTrue(np.allclose(outTable.getColumnValues('rlnTomoSubtomogramTilt'), [90, 20]))
+
+    def _writeParticlesStar(self, name):
+        """Writes a Relion 4 particles star file with 6 particles, whose ids are 2, 5, 8, 11, 14 and 17."""
+        particlesStar = self.getOutputPath(name)
+        with open(particlesStar, 'w') as f:
+            f.write('data_particles\n\nloop_\n_rlnTomoName #1\n_rlnTomoParticleId #2\n_rlnImageName #3\n'
+                    '_rlnCtfImage #4\n_rlnCoordinateX #5\n_rlnCoordinateY #6\n_rlnCoordinateZ #7\n'
+                    '_rlnOriginXAngst #8\n_rlnAngleRot #9\n_rlnAngleTilt #10\n_rlnRandomSubset #11\n')
+            for i in range(6):
+                f.write('TS_%i %i p%i.mrc ctf%i.mrc %i %i %i %.1f %i %i %i\n' %
+                        (i // 3, 3 * i + 2, i, i, 10 * i, 20 * i, 5, i / 2, 10 * i, 90 - i, i % 2 + 1))
+            f.write('\n')
+        return particlesStar
+
+    def test_reuseParticlesStar(self):
+        particlesStar = self._writeParticlesStar('reusedParticles.star')
+        classesDict = {**vars(pwobj), **vars(pwemobj), **vars(tomoobj), **vars(reliontomoobj)}
+
+        fullSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath('reusedAll.sqlite'),
+                                                classesDict=classesDict)
+        fullSet.setSamplingRate(2.0)
+        fullSet.setParticles(particlesStar)
+        fullSet.setAreRe5Particles(False)
+        fullSet.appendFromColumns(*fullSet._readColumns())
+        fullSet.setNReParticles(6)
+        fullSet.write()
+
+        def createSet(name, objIds=None, modifiedId=None):
+            psubtomoSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath(name), classesDict=classesDict)
+            psubtomoSet.copyInfo(fullSet)
+            for psubtomo in fullSet.iterItems():
+                if objIds is None or psubtomo.getObjId() in objIds:
+                    psubtomo = psubtomo.clone()
+                    if psubtomo.getObjId() == modifiedId:
+                        psubtomo.getTransform().getMatrix()[0, 3] += 1  # Shifted 1 px in X
+                    psubtomoSet.append(psubtomo)
+            psubtomoSet.write()
+            return psubtomoSet
+
+        def reuse(psubtomoSet, name):
+            outStar = self.getOutputPath(name)
+            cleanPath(outStar)
+            return reuseParticlesStar(psubtomoSet, outStar), outStar
+
+        # All the particles, in the set read from the file or in a copy of it: the file is linked
+        for psubtomoSet in [fullSet, createSet('reusedCopy.sqlite')]:
+            reused, outStar = reuse(psubtomoSet, 'reusedAll.star')
+            self.assertTrue(reused)
+            self.assertEqual(os.path.realpath(outStar), os.path.realpath(particlesStar))
+
+        # Subset: the file is filtered
+        reused, outStar = reuse(createSet('reusedSubset.sqlite', objIds=[5, 11, 14]), 'reusedSubset.star')
+        self.assertTrue(reused)
+        self.assertFalse(os.path.islink(outStar))
+        self.assertEqual(StarTable(fileName=outStar, tableName=PARTICLES_TABLE).getColumnValues('rlnTomoParticleId'),
+                         [5, 11, 14])
+
+        # Modified particles, with and without the size of the star file: they have to be written
+        for name, objIds in [('reusedModified', None), ('reusedModifiedSubset', [5, 11, 14])]:
+            reused, outStar = reuse(createSet(name + '.sqlite', objIds=objIds, modifiedId=11), name + '.star')
+            self.assertFalse(reused)
+            self.assertFalse(os.path.exists(outStar))
+
+    def test_lazySet(self):
+        particlesStar = self._writeParticlesStar('lazyParticles.star')
+
+        def createSet(name, lazy=False):
+            psubtomoSet = RelionSetOfPseudoSubtomograms(filename=self.getOutputPath(name), lazy=lazy)
+            psubtomoSet.setSamplingRate(2.0)
+            psubtomoSet.setParticles(particlesStar)
+            psubtomoSet.setAreRe5Particles(False)
+            return psubtomoSet
+
+        # Particles in the sqlite
+        expectedSet = createSet('expectedLazy.sqlite')
+        expectedSet.appendFromColumns(*expectedSet._readColumns())
+        expectedSet.write()
+        expectedRows = self._getRows(expectedSet.getFileName())
+
+        # Particles read from the star file
+        lazySet = createSet('lazy.sqlite', lazy=True)
+        lazySet.appendFromColumns(*lazySet._readColumns())
+        lazySet.write()
+        self.assertEqual(lazySet.getSize(), 6)
+        lazySet.close()
+        lazySet.load()
+        self.assertTrue(lazySet.isLazy())
+        self.assertEqual(lazySet.getSize(), 6)
+        self.assertEqual(lazySet.getFirstItem().getObjId(), 2)
+        self.assertEqual([psubtomo.getObjId() for psubtomo in lazySet.iterItems(limit=2)], [2, 5])
+        itemsList = lazySet.iterItems(limit=2, iterate=False)
+        self.assertIsInstance(itemsList, list)
+        self.assertEqual([psubtomo.getObjId() for psubtomo in itemsList], [2, 5])
+        # As in the sets read from sqlite, the particles get the acquisition of the set
+        iteratedItems = [{key: value for key, value in psubtomo.getObjDict().items()
+                          if not key.startswith('_acquisition')} for psubtomo in lazySet]
+        with sqlite3.connect(expectedSet.getFileName()) as conn:
+            columnLabels = {column: label for label, column in
+                            conn.execute('SELECT label_property, column_name FROM Classes') if label != 'self'}
+        self.assertEqual(iteratedItems, [{columnLabels[key]: value for key, value in row.items() if key in columnLabels}
+                                         for row in expectedRows])
 
+        # Random access materializes the sqlite
+        # The plugin may not be registered in the test environment, so the classes are provided to the mapper
+        classesDict = {**vars(pwobj), **vars(pwemobj), **vars(tomoobj), **vars(reliontomoobj)}
+        lazySet.setClassesDict(classesDict)
+        self.assertIn(5, lazySet)
+        self.assertFalse(lazySet.isLazy())
+        self.assertEqual(lazySet.getSize(), 6)
+        self.assertEqual(self._getRows(lazySet.getFileName()), expectedRows)
+        self.assertEqual(lazySet[5].getFileName(), 'p1.mrc')
 
+        # Particles copied from another set
+        clonedSet = createSet('clonedLazy.sqlite')
+        clonedSet.setClassesDict(classesDict)
+        clonedSet.cloneItems(lazySet)
+        self.assertEqual(clonedSet.getSize(), 6)
+        self.assertEqual(self._getRows(clonedSet.getFileName()), expectedRows)
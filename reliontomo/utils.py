@@ -22,10 +22,22 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
+import functools
+import logging
+import os
+import threading
+import time
+import mrcfile
 import numpy as np
-import emtable
 from collections import OrderedDict
+from contextlib import contextmanager
 from os.path import isabs, join
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONVERT_TRACE_SAMPLING = 10000  # One of each these calls of the same site is traced by ConvertStats.trace
+COPY_BUFFER_SIZE = 64 * 1024 * 1024  # Size of the chunks of the buffered copies of copyFileBytes
 
 
 def getProgram(program, nMpi=1):
@@ -75,50 +87,259 @@ def genEnumParamDict(keyList):
 
 
 def generateProjections(particlesFilePath, tomogramsFilePath):
-    mdFileName = '%s@%s' % ('particles', particlesFilePath)
-    table = emtable.Table(fileName=particlesFilePath)
-    particles = []
-    tomoNames = []
-
-    for row in table.iterRows(mdFileName):
-        if not row.get('rlnTomoName') in tomoNames:
-            tomoNames.append(row.get('rlnTomoName'))
-        particles.append([row.get('rlnTomoName'),
-                          np.array([row.get('rlnCoordinateX'),
-                                    row.get('rlnCoordinateY'),
-                                    row.get('rlnCoordinateZ'), 1])])
-
+    """ Returns a dictionary with the projections of the particles on each tilt-image, grouped by tomoId. Each
+    projection is a list [tomoName, tiltId, partId, x, y]."""
+    # Imported here, as the convert package imports this module
+    from reliontomo.convert.convert50_tomo import StarTableGroups
+    from reliontomo.convert.starTable import readStarTable
+    particlesTable = readStarTable(particlesFilePath, tableName='particles')
+    particlesByTomo = StarTableGroups(particlesTable, 'rlnTomoName')
+    # Each tomogram table of the tomograms file is parsed only once, using the index of its data blocks
     tomograms = {}
-    for tomoName in tomoNames:
-        mdFileName = '%s@%s' % (tomoName, tomogramsFilePath)
-        table = emtable.Table(fileName=tomogramsFilePath)
-        tomoProjections = []
-        for row in table.iterRows(mdFileName):
-            tomoProjections.append(np.array([eval(row.get('rlnTomoProjX')),
-                                             eval(row.get('rlnTomoProjY')),
-                                             eval(row.get('rlnTomoProjZ')),
-                                             eval(row.get('rlnTomoProjW'))]))
-        tomograms[tomoName] = tomoProjections
-
-    return projectParticles(particles, tomograms)
-
-
-def projectParticles(particles, tomograms):
-    """ Returns a dictionary with the projections grouped by tomoId"""
-    projections = {}
+    for tomoName in particlesByTomo:
+        tomoTable = readStarTable(tomogramsFilePath, tableName=str(tomoName))
+        tomograms[tomoName] = np.stack([parseProjVectors(tomoTable.getColumnValues(label))
+                                        for label in ('rlnTomoProjX', 'rlnTomoProjY',
+                                                      'rlnTomoProjZ', 'rlnTomoProjW')], axis=1)
+    return projectParticles(particlesByTomo, tomograms)
 
-    for partId, particle in enumerate(particles):
-        tomoName = particle[0]
-        tomoProjections = tomograms[tomoName]
 
-        particleProjections = projections.get(tomoName, None)
+def parseProjVectors(values):
+    """ Converts a list of projection vectors, written as '[x,y,z,w]' in the Relion 4 tomograms star file, into an
+    (N, 4) array."""
+    return np.array([value.strip('[] ').split(',') for value in values], dtype=np.float64).reshape(-1, 4)
 
-        if particleProjections is None:
-            particleProjections = []
-            projections[tomoName] = particleProjections
 
-        for tiltId, tomoProjection in enumerate(tomoProjections):
-            multproj = tomoProjection.dot(particle[1])
-            particleProjections.append([tomoName, tiltId, partId, multproj[0], multproj[1]])
+def projectParticles(particlesByTomo, tomograms):
+    """ Returns a dictionary with the projections grouped by tomoId. The particles of each tomogram are projected
+    with the (T, 4, 4) array of projection matrices of its tilt-images all at once."""
+    projections = {}
+    for tomoName in particlesByTomo:
+        partIds = particlesByTomo.getIndices(tomoName)
+        coords = np.ones((len(partIds), 4))
+        coords[:, 0] = particlesByTomo.getColumn(tomoName, 'rlnCoordinateX')
+        coords[:, 1] = particlesByTomo.getColumn(tomoName, 'rlnCoordinateY')
+        coords[:, 2] = particlesByTomo.getColumn(tomoName, 'rlnCoordinateZ')
+        tomoProjections = tomograms[tomoName]
+        nTilts = len(tomoProjections)
+        # Particle x tilt-image x (x, y)
+        multProjs = np.einsum('tij,nj->nti', tomoProjections[:, :2, :], coords)
+        projections[tomoName] = [[tomoName, tiltId, int(partId), x, y]
+                                 for partId, particleProjs in zip(partIds, multProjs.tolist())
+                                 for tiltId, (x, y) in zip(range(nTilts), particleProjs)]
 
     return projections
+
+
+def mountMrcStack(imgFiles: List[str], outStackFile: str, voxelSize: float):
+    """ Writes the given 2D MRC images, in that order, into a new MRC stack. If all of them have the same shape and
+    data type, their data blocks are copied as they are, without decoding them (see _mountMrcStackRaw). If not, each
+    image is read and copied into its slice of the output file, so only one image is kept in memory at a time. In
+    both cases, the header stats are the same as the ones given by mrcfile's update_header_stats."""
+    layouts = [_getMrcRawLayout(imgFile) for imgFile in imgFiles]
+    if all(layouts) and len({(shape, dtype) for shape, dtype, _ in layouts}) == 1:
+        _mountMrcStackRaw(imgFiles, layouts, outStackFile, voxelSize)
+    else:
+        logger.info('The images have different shapes or data types. Decoding them to mount the stack')
+        _mountMrcStackDecoding(imgFiles, outStackFile, voxelSize)
+
+
+def _getMrcRawLayout(imgFile: str) -> Optional[Tuple[Tuple[int, int], np.dtype, int]]:
+    """ Returns the shape, data type and offset of the data block of the given MRC image, read from its header, or
+    None if its data block cannot be copied as it is into a stack written by mrcfile (it is not a single 2D image,
+    it is not in the native byte order or the file is truncated)."""
+    with mrcfile.open(imgFile, mode='r', header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        if header is None or int(header.nz) != 1:
+            return None
+        dtype = mrcfile.utils.data_dtype_from_header(header)
+        shape = (int(header.ny), int(header.nx))
+        offset = header.nbytes + int(header.nsymbt)
+    if not dtype.isnative or os.path.getsize(imgFile) < offset + shape[0] * shape[1] * dtype.itemsize:
+        return None
+    return shape, dtype.newbyteorder('='), offset
+
+
+def _getImgStats(img: np.ndarray) -> Tuple[int, float, float, float, float]:
+    """ Returns the stats (size, mean, sum of squared deviations, min, max) of the given image."""
+    return img.size, img.mean(dtype=np.float64), img.var(dtype=np.float64) * img.size, img.min(), img.max()
+
+
+def _mergeStats(stats, imgStats):
+    """ Merges the stats of an image into the accumulated ones, with the parallel algorithm of Chan et al."""
+    n, mean, m2, dMin, dMax = stats
+    imgN, imgMean, imgM2, imgMin, imgMax = imgStats
+    total = n + imgN
+    delta = imgMean - mean
+    return (total, mean + delta * imgN / total, m2 + imgM2 + delta ** 2 * n * imgN / total,
+            min(dMin, imgMin), max(dMax, imgMax))
+
+
+def _setHeaderStats(mrc, stats):
+    n, mean, m2, dMin, dMax = stats
+    mrc.header.dmin = np.float32(dMin)
+    mrc.header.dmax = np.float32(dMax)
+    mrc.header.dmean = np.float32(mean)
+    mrc.header.rms = np.float32(np.sqrt(m2 / n))
+
+
+def _mountMrcStackDecoding(imgFiles: List[str], outStackFile: str, voxelSize: float):
+    with mrcfile.mmap(imgFiles[0], mode='r') as mrc:
+        ny, nx = mrc.data.shape
+        dtype = mrc.data.dtype
+
+    with mrcfile.new_mmap(outStackFile, (len(imgFiles), ny, nx), mrc_mode=mrcfile.utils.mode_from_dtype(dtype),
+                          overwrite=True) as outMrc:
+        stats = (0, 0.0, 0.0, np.inf, -np.inf)
+        for i, imgFile in enumerate(imgFiles):
+            with mrcfile.mmap(imgFile, mode='r') as mrc:
+                logger.info(f'Inserting image - index [{i}], {imgFile}')
+                outMrc.data[i] = mrc.data
+                stats = _mergeStats(stats, _getImgStats(mrc.data))
+        outMrc.update_header_from_data()
+        _setHeaderStats(outMrc, stats)
+        outMrc.voxel_size = voxelSize
+
+
+def _mountMrcStackRaw(imgFiles: List[str], layouts, outStackFile: str, voxelSize: float):
+    """ Writes the header of the stack with mrcfile and then concatenates the data blocks of the images, copied by
+    the kernel when possible (see copyFileBytes). The stats of each image are taken from its header when they are
+    set, as Relion does, so the images are not read by Python at all in that case."""
+    (ny, nx), dtype, _ = layouts[0]
+    stats = (0, 0.0, 0.0, np.inf, -np.inf)
+    for imgFile in imgFiles:
+        with mrcfile.open(imgFile, mode='r', header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            # Headers without stats may have them set to -1 or 0 (see MRC2014)
+            hasStats = header.rms > 0 or header.dmax > header.dmin
+            imgStats = (nx * ny, float(header.dmean), float(header.rms) ** 2 * nx * ny,
+                        float(header.dmin), float(header.dmax)) if hasStats else None
+        if imgStats is None:
+            with mrcfile.mmap(imgFile, mode='r') as mrc:
+                imgStats = _getImgStats(mrc.data)
+        stats = _mergeStats(stats, imgStats)
+
+    with mrcfile.new_mmap(outStackFile, (len(imgFiles), ny, nx), mrc_mode=mrcfile.utils.mode_from_dtype(dtype),
+                          overwrite=True) as outMrc:
+        _setHeaderStats(outMrc, stats)
+        outMrc.voxel_size = voxelSize
+        outOffset = outMrc.header.nbytes + int(outMrc.header.nsymbt)
+
+    imgBytes = nx * ny * dtype.itemsize
+    dstFd = os.open(outStackFile, os.O_WRONLY)
+    try:
+        for i, (imgFile, (_, _, offset)) in enumerate(zip(imgFiles, layouts)):
+            logger.info(f'Inserting image - index [{i}], {imgFile}')
+            srcFd = os.open(imgFile, os.O_RDONLY)
+            try:
+                copyFileBytes(srcFd, offset, dstFd, outOffset + i * imgBytes, imgBytes)
+            finally:
+                os.close(srcFd)
+    finally:
+        os.close(dstFd)
+
+
+def copyFileBytes(srcFd: int, srcOffset: int, dstFd: int, dstOffset: int, nBytes: int):
+    """ Copies nBytes from the position srcOffset of a file into the position dstOffset of another one, given their
+    descriptors. The copy is done in the kernel with os.copy_file_range or os.sendfile where they are available and
+    supported by the filesystems, or with a buffered copy if not."""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < nBytes:
+                n = os.copy_file_range(srcFd, dstFd, nBytes - copied, srcOffset + copied, dstOffset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            logger.debug(f'copy_file_range not available: {e}')
+    if copied < nBytes and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dstFd, dstOffset + copied, os.SEEK_SET)
+            while copied < nBytes:
+                n = os.sendfile(dstFd, srcFd, srcOffset + copied, nBytes - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            logger.debug(f'sendfile not available: {e}')
+    while copied < nBytes:
+        buffer = os.pread(srcFd, min(COPY_BUFFER_SIZE, nBytes - copied), srcOffset + copied)
+        if not buffer:
+            raise EOFError(f'Unexpected end of file copying {nBytes} bytes from offset {srcOffset}')
+        copied += os.pwrite(dstFd, buffer, dstOffset + copied)
+
+
+class ConvertStats:
+    """Counters and timers of the conversion functions, aggregated by call site (e.g. the name of the function),
+    so the protocols can report them once per step instead of logging each converted item. It also provides a
+    sampled trace of the hot paths, which is only emitted if the DEBUG level is enabled for this module. The stats
+    are not separated by thread: popReport returns everything counted since the previous call in any thread."""
+
+    def __init__(self, traceSampling: int = CONVERT_TRACE_SAMPLING):
+        self.traceSampling = traceSampling
+        self._lock = threading.Lock()
+        self._sites = OrderedDict()  # Site --> [calls, items, seconds]
+        self._traceCalls = {}  # Site --> number of calls to trace
+
+    def _getSite(self, site: str) -> list:
+        return self._sites.setdefault(site, [0, 0, 0.0])
+
+    def count(self, site: str, items: int = 1):
+        """Adds the given number of items processed to the site."""
+        with self._lock:
+            self._getSite(site)[1] += items
+
+    @contextmanager
+    def measure(self, site: str):
+        """Context manager that adds a call and the time elapsed in it to the site."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._getSite(site)
+                stats[0] += 1
+                stats[2] += elapsed
+
+    def timed(self, site: str):
+        """Decorator version of measure."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.measure(site):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def trace(self, site: str, msg: str, *args):
+        """Logs the message in DEBUG level once every traceSampling calls of the same site."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        with self._lock:
+            nCalls = self._traceCalls.get(site, 0)
+            self._traceCalls[site] = nCalls + 1
+        if nCalls % self.traceSampling == 0:
+            logger.debug('[%s #%i] ' % (site, nCalls + 1) + msg, *args)
+
+    def popReport(self) -> List[str]:
+        """Returns a line describing the stats of each site and resets them. The calls and the time are only
+        reported for the measured sites and the items for the counted ones."""
+        with self._lock:
+            sites, self._sites = self._sites, OrderedDict()
+            self._traceCalls.clear()
+        report = []
+        for site, (calls, items, seconds) in sites.items():
+            stats = []
+            if calls:
+                stats.append('%i calls' % calls)
+            if items:
+                stats.append('%i items' % items)
+            if calls:
+                stats.append('%.3f s' % seconds)
+            report.append('%s: %s' % (site, ', '.join(stats)))
+        return report
+
+
+convertStats = ConvertStats()  # Stats of the conversions done in the current process